@@ -0,0 +1,137 @@
+"""
+Ledger analytics: monthly flows, fee totals, top accounts and balances by
+account type.
+
+Every report is a GROUP BY that runs in the database, so Python only ever
+sees one row per group (a month, an account, an account type), never one
+per transaction. A full-bank monthly rollup is a single scan of
+transactions with a handful of running sums per month; the database does
+that far faster than any loop over fetched rows could, and the result is
+a few dozen rows however large the ledger is.
+
+Credits are the types in models.CREDIT_TYPES (deposits, including the
+incoming leg of a transfer); everything else is an outflow. Reports read
+the live transactions table only, not months moved out by archive.py.
+"""
+from __future__ import annotations
+from datetime import date, datetime, timedelta
+from sqlalchemy import Numeric, String, case, func, literal, select, type_coerce
+from models import Account, Transaction, TransactionType, CREDIT_TYPES
+
+STREAM_ROWS = 5000
+
+_CREATED = type_coerce(Transaction.created_at, String)
+_MONEY = Numeric(18, 2)
+
+def _bound(value) -> str:
+    """A date or datetime as comparable stored text."""
+    if isinstance(value, datetime):
+        return value.isoformat(" ", "microseconds")
+    return value.isoformat()
+
+def _in_range(stmt, since=None, until=None):
+    """Limit ``stmt`` to transactions created in [since, until); a date ``until`` includes that day."""
+    if since is not None:
+        stmt = stmt.where(_CREATED >= _bound(since))
+    if until is not None:
+        if isinstance(until, date) and not isinstance(until, datetime):
+            until += timedelta(days=1)
+        stmt = stmt.where(_CREATED < _bound(until))
+    return stmt
+
+def _month(session):
+    """created_at as 'YYYY-MM'."""
+    if session.get_bind().dialect.name == "sqlite":
+        return func.substr(_CREATED, 1, 7)  # stored as 'YYYY-MM-DD HH:MM:SS...'
+    return func.to_char(Transaction.created_at, "YYYY-MM")
+
+def _sum(expr):
+    return type_coerce(func.coalesce(func.sum(expr), 0), _MONEY)
+
+_IS_CREDIT = Transaction.type.in_(CREDIT_TYPES)
+_INFLOW = _sum(case((_IS_CREDIT, Transaction.amount), else_=literal(0)))
+_OUTFLOW = _sum(case((_IS_CREDIT, literal(0)), else_=Transaction.amount))
+
+def monthly_flows(session, account_id=None, since=None, until=None) -> list:
+    """
+    (month, inflow, outflow, transactions) per month, for one account or
+    the whole bank, oldest month first.
+    """
+    month = _month(session).label("month")
+    stmt = select(month, _INFLOW.label("inflow"), _OUTFLOW.label("outflow"), func.count().label("transactions"))
+    if account_id is not None:
+        stmt = stmt.where(Transaction.account_id == account_id)
+    stmt = _in_range(stmt, since, until).group_by(month).order_by(month)
+    return session.execute(stmt).all()
+
+def account_monthly_flows(session, since=None, until=None):
+    """
+    Yield (account_number, month, inflow, outflow, transactions) for every
+    account and month with activity, in account order. Streamed, since
+    there is a row per account per month.
+    """
+    month = _month(session).label("month")
+    flows = _in_range(
+        select(Transaction.account_id, month, _INFLOW.label("inflow"), _OUTFLOW.label("outflow"),
+               func.count().label("transactions")),
+        since, until,
+    ).group_by(Transaction.account_id, month).subquery()
+    stmt = (
+        select(Account.account_number, flows.c.month, flows.c.inflow, flows.c.outflow, flows.c.transactions)
+        .join(Account, Account.id == flows.c.account_id)
+        .order_by(Account.account_number, flows.c.month)
+        .execution_options(yield_per=STREAM_ROWS)
+    )
+    yield from session.execute(stmt)
+
+def fee_totals(session, since=None, until=None) -> list:
+    """(month, total, fees, accounts charged) for FEE transactions, oldest month first."""
+    month = _month(session).label("month")
+    stmt = _in_range(
+        select(month, _sum(Transaction.amount).label("total"), func.count().label("fees"),
+               func.count(Transaction.account_id.distinct()).label("accounts"))
+        .where(Transaction.type == TransactionType.FEE),
+        since, until,
+    ).group_by(month).order_by(month)
+    return session.execute(stmt).all()
+
+def top_accounts(session, limit=10, since=None, until=None) -> list:
+    """
+    (account_number, type, volume, inflow, outflow, transactions) for the
+    ``limit`` accounts that moved the most money, largest first.
+    """
+    volume = _sum(Transaction.amount).label("volume")
+    ranked = (
+        _in_range(
+            select(Transaction.account_id, volume, _INFLOW.label("inflow"), _OUTFLOW.label("outflow"),
+                   func.count().label("transactions")),
+            since, until,
+        )
+        .group_by(Transaction.account_id)
+        .order_by(volume.desc())
+        .limit(limit)
+        .subquery()
+    )
+    stmt = (
+        select(Account.account_number, Account.type, ranked.c.volume, ranked.c.inflow, ranked.c.outflow,
+               ranked.c.transactions)
+        .join(Account, Account.id == ranked.c.account_id)
+        .order_by(ranked.c.volume.desc())
+    )
+    return session.execute(stmt).all()
+
+def balances_by_type(session) -> list:
+    """(type, accounts, total, average, lowest, highest) balance per AccountType."""
+    stmt = (
+        select(
+            Account.type,
+            func.count().label("accounts"),
+            _sum(Account.balance).label("total"),
+            type_coerce(func.avg(Account.balance), _MONEY).label("average"),
+            type_coerce(func.min(Account.balance), _MONEY).label("lowest"),
+            type_coerce(func.max(Account.balance), _MONEY).label("highest"),
+        )
+        .group_by(Account.type)
+        .order_by(Account.type)
+    )
+    return session.execute(stmt).all()
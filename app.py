@@ -1,15 +1,21 @@
+import argparse
 import getpass
-from decimal import Decimal
-from models import (
-    Session,
-    engine,
-    User,
-    Account,
-    Transaction,
-    AccountType,
-    TransactionType,
-    gen_uuid
-)
+import metrics
+from config import BULK_BATCH_SIZE, DASHBOARD_PREVIEW_SIZE, HISTORY_PAGE_SIZE, JOB_CHUNK_SIZE
+
+# The menus, argument parsing and --help must not pay for importing
+# SQLAlchemy and building the mappers, so the database layer (database,
+# models, postings, ...) is imported inside the functions that use it.
+
+# The operations below are timed by metrics.operation(); time spent at a
+# prompt is left out of their latency
+def ask(prompt):
+    with metrics.paused():
+        return input(prompt)
+
+def ask_secret(prompt):
+    with metrics.paused():
+        return getpass.getpass(prompt)
 
 def main_menu():
     while True:
@@ -24,6 +30,8 @@ def main_menu():
         elif choice == "2":
             user = login_menu()
             if user:
+                import recipients
+                recipients.start_preload()
                 user_menu(user)
         elif choice == "3":
             print("Goodbye!")
@@ -32,6 +40,12 @@ def main_menu():
             print("Invalid choice. Try again.")
 
 def create_user_menu():
+    import audit
+    import cache
+    from database import Session
+    from models import User, gen_uuid
+    from passwords import hash_password
+
     email = input("Email: ")
     password = getpass.getpass("Password: ")
     full_name = input("Full Name (optional): ")
@@ -46,19 +60,25 @@ def create_user_menu():
             id=gen_uuid(),
             email=email,
             phone=phone,
-            hashed_password=password,
+            hashed_password=hash_password(password),
             full_name=full_name
         )
         session.add(user)
         session.commit()
+        cache.invalidate_user(email)
+        audit.record("User", user.id, "CREATE", email=email)
         print(f"User '{email}' created successfully!")
 
+@metrics.timed("login_menu")
 def login_menu():
-    email = input("Email: ")
-    password = getpass.getpass("Password: ")
+    from database import Session
+    from passwords import authenticate
+
+    email = ask("Email: ")
+    password = ask_secret("Password: ")
 
     with Session() as session:
-        user = session.query(User).filter_by(email=email, hashed_password=password).first()
+        user = authenticate(session, email, password)
         if user:
             print(f"Welcome {user.full_name or user.email}!")
             return user
@@ -75,7 +95,8 @@ def user_menu(user):
         print("4. Withdraw")
         print("5. Transfer")
         print("6. Transaction history")
-        print("7. Logout")
+        print("7. Overview")
+        print("8. Logout")
         choice = input("Enter choice: ")
 
         if choice == "1":
@@ -91,11 +112,20 @@ def user_menu(user):
         elif choice == "6":
             transaction_history(user)
         elif choice == "7":
+            overview(user)
+        elif choice == "8":
             break
         else:
             print("Invalid choice. Try again.")
 
 def create_account_menu(user):
+    from decimal import Decimal
+    import audit
+    import cache
+    import recipients
+    from database import Session, note_write
+    from models import Account, AccountType, gen_uuid
+
     acc_number = input("Enter new account number: ")
     acc_type_input = input("Account type (savings/checking/credit) [checking]: ").lower()
     acc_type = AccountType(acc_type_input) if acc_type_input in AccountType._value2member_map_ else AccountType.CHECKING
@@ -110,11 +140,19 @@ def create_account_menu(user):
         )
         session.add(account)
         session.commit()
+        note_write(user.id)
+        cache.invalidate_owner(user.id)
+        recipients.note_account(acc_number, account.id)
+        audit.record("Account", account.id, "CREATE", owner_id=user.id, account_number=acc_number, type=acc_type.name)
         print(f"{acc_type.value.title()} account '{acc_number}' created!")
 
+@metrics.timed("select_account")
 def select_account(user):
-    with Session() as session:
-        accounts = session.query(Account).filter_by(owner_id=user.id).all()
+    import cache
+    from database import read_session
+
+    with read_session(user.id) as session:
+        accounts = cache.get_accounts_for_owner(session, user.id)
         if not accounts:
             print("No accounts found. Please create an account first.")
             return None
@@ -122,7 +160,7 @@ def select_account(user):
         print("Select account:")
         for idx, acc in enumerate(accounts, start=1):
             print(f"{idx}. {acc.account_number} ({acc.type.value}, Balance: {acc.balance})")
-        choice = input("Enter number: ")
+        choice = ask("Enter number: ")
         try:
             idx = int(choice) - 1
             return accounts[idx]
@@ -135,112 +173,651 @@ def check_balance(user):
     if acc:
         print(f"Account {acc.account_number} balance: {acc.balance}")
 
+@metrics.timed("deposit")
 def deposit(user):
+    import postings
+    from database import Session, note_write
+
     acc = select_account(user)
     if acc:
-        amount_input = input("Enter amount to deposit: ")
-        try:
-            amount = Decimal(amount_input)
-        except:
-            print("Invalid amount.")
-            return
+        amount_input = ask("Enter amount to deposit: ")
         with Session() as session:
-            acc = session.query(Account).filter_by(id=acc.id).first()
-            acc.balance += amount
-            transaction = Transaction(
-                id=gen_uuid(),
-                account_id=acc.id,
-                amount=amount,
-                type=TransactionType.DEPOSIT,
-                reference="deposit"
-            )
-            session.add(transaction)
-            session.commit()
-            print(f"Deposited {amount}. New balance: {acc.balance}")
+            try:
+                amount = postings.validate_amount(amount_input)
+                result = postings.deposit(session, acc.id, amount)
+            except postings.PostingError as e:
+                print(e)
+                return
+            note_write(user.id)
+            print(f"Deposited {amount}. New balance: {result.balances[acc.id]}")
 
+@metrics.timed("withdraw")
 def withdraw(user):
+    import postings
+    from database import Session, note_write
+
     acc = select_account(user)
     if acc:
-        amount_input = input("Enter amount to withdraw: ")
-        try:
-            amount = Decimal(amount_input)
-        except:
-            print("Invalid amount.")
-            return
-        if acc.balance < amount:
-            print("Insufficient funds.")
-            return
+        amount_input = ask("Enter amount to withdraw: ")
         with Session() as session:
-            acc = session.query(Account).filter_by(id=acc.id).first()
-            acc.balance -= amount
-            transaction = Transaction(
-                id=gen_uuid(),
-                account_id=acc.id,
-                amount=amount,
-                type=TransactionType.WITHDRAWAL,
-                reference="withdraw"
-            )
-            session.add(transaction)
-            session.commit()
-            print(f"Withdrew {amount}. New balance: {acc.balance}")
+            try:
+                amount = postings.validate_amount(amount_input)
+                result = postings.withdraw(session, acc.id, amount)
+            except postings.PostingError as e:
+                print(e)
+                return
+            note_write(user.id)
+            print(f"Withdrew {amount}. New balance: {result.balances[acc.id]}")
 
+@metrics.timed("transfer")
 def transfer(user):
+    import postings
+    import recipients
+    from database import Session, note_write
+
     from_acc = select_account(user)
     if not from_acc:
         return
-    to_acc_number = input("Enter recipient account number: ")
-    amount_input = input("Enter amount to transfer: ")
+    to_acc_number = ask("Enter recipient account number: ")
+    amount_input = ask("Enter amount to transfer: ")
     try:
-        amount = Decimal(amount_input)
-    except:
-        print("Invalid amount.")
+        amount = postings.validate_amount(amount_input)
+    except postings.PostingError as e:
+        print(e)
         return
 
     with Session() as session:
-        to_acc = session.query(Account).filter_by(account_number=to_acc_number).first()
-        if not to_acc:
-            print("Recipient account not found.")
+        try:
+            recipient = recipients.resolve(session, to_acc_number, owner_id=user.id)
+        except postings.AccountNotFoundError as e:
+            print(e)
             return
-        if from_acc.balance < amount:
-            print("Insufficient funds.")
+        if not recipient.internal:
+            print(f"{recipient.name} ({recipient.bank_name or 'another bank'}) is an external beneficiary; "
+                  "external transfers are not supported yet.")
             return
-
-        # Update balances
-        from_acc_db = session.query(Account).filter_by(id=from_acc.id).first()
-        to_acc_db = session.query(Account).filter_by(id=to_acc.id).first()
-        from_acc_db.balance -= amount
-        to_acc_db.balance += amount
-
-        # Transactions
-        t1 = Transaction(
-            id=gen_uuid(),
-            account_id=from_acc_db.id,
-            amount=amount,
-            type=TransactionType.TRANSFER,
-            reference=f"transfer to {to_acc_number}"
-        )
-        t2 = Transaction(
-            id=gen_uuid(),
-            account_id=to_acc_db.id,
-            amount=amount,
-            type=TransactionType.DEPOSIT,
-            reference=f"transfer from {from_acc.account_number}"
-        )
-        session.add_all([t1, t2])
-        session.commit()
+        try:
+            postings.transfer(session, from_acc.id, recipient.account_id, amount)
+        except postings.PostingError as e:
+            print(e)
+            return
+        note_write(user.id)
         print(f"Transferred {amount} from {from_acc.account_number} to {to_acc_number}")
 
+@metrics.timed("transaction_history")
 def transaction_history(user):
+    from database import read_session
+    from history import fetch_page
+
     acc = select_account(user)
-    if acc:
-        with Session() as session:
-            transactions = session.query(Transaction).filter_by(account_id=acc.id).order_by(Transaction.created_at.desc()).all()
-            if not transactions:
-                print("No transactions found.")
-                return
-            print(f"Transaction history for {acc.account_number}:")
-            for t in transactions:
+    if not acc:
+        return
+    with read_session(user.id) as session:
+        page = fetch_page(session, acc.id, page_size=HISTORY_PAGE_SIZE)
+        if not page.rows:
+            print("No transactions found.")
+            return
+        print(f"Transaction history for {acc.account_number}:")
+        while True:
+            for t in page.rows:
                 print(f"{t.created_at} | {t.type.value} | {t.amount} | {t.reference}")
 
+            options = []
+            if page.has_next:
+                options.append("[n]ext")
+            if page.has_previous:
+                options.append("[p]revious")
+            if not options:
+                return
+            choice = ask(f"{', '.join(options)}, [q]uit: ").lower()
+            if choice == "n" and page.has_next:
+                page = fetch_page(session, acc.id, page_size=HISTORY_PAGE_SIZE, after=page.next_cursor)
+            elif choice == "p" and page.has_previous:
+                page = fetch_page(session, acc.id, page_size=HISTORY_PAGE_SIZE, before=page.previous_cursor)
+            elif choice == "q":
+                return
+            else:
+                print("Invalid choice. Try again.")
+
+@metrics.timed("overview")
+def overview(user):
+    from dashboard import overview as load_overview
+    from database import read_session
+
+    with read_session(user.id) as session:
+        board = load_overview(session, user.id)
+    if board is None or not board.accounts:
+        print("No accounts found. Please create an account first.")
+        return
+    for item in board.accounts:
+        acc = item.account
+        print(f"\n{acc.account_number} ({acc.type.value}) Balance: {acc.balance} {acc.currency}")
+        for t in item.recent:
+            print(f"  {t.created_at} | {t.type.value} | {t.amount} | {t.reference}")
+    print("\nTotal: " + ", ".join(f"{total} {currency}" for currency, total in board.totals.items()))
+    if board.cards:
+        print("Cards:")
+        for c in board.cards:
+            print(f"  {c.card_mask} expires {c.expiry_month:02d}/{c.expiry_year}{'' if c.is_active else ' (inactive)'}")
+    if board.beneficiaries:
+        print("Beneficiaries:")
+        for b in board.beneficiaries:
+            print(f"  {b.name} {b.account_number}{f' ({b.bank_name})' if b.bank_name else ''}")
+
+def bulk_post_command(args):
+    from database import Session
+    from ingest import bulk_post
+
+    if args.workers > 1:
+        return parallel_post_command(args)
+    with Session() as session:
+        report = bulk_post(
+            session,
+            args.file,
+            batch_size=args.batch_size,
+            rejects_path=args.rejects,
+            fmt=args.format,
+        )
+    print(
+        f"Posted {report.posted} rows, rejected {report.rejected} "
+        f"in {report.elapsed:.2f}s ({report.rate:,.0f} postings/s)"
+    )
+
+def parallel_post_command(args):
+    from parallel import parallel_post
+
+    report = parallel_post(
+        args.file,
+        workers=args.workers,
+        partitions=args.partitions,
+        batch_size=args.batch_size,
+        window_size=args.window,
+        rejects_path=args.rejects,
+        fmt=args.format,
+    )
+    print(
+        f"Posted {report.posted} rows, rejected {report.rejected} "
+        f"in {report.elapsed:.2f}s ({report.rate:,.0f} postings/s) "
+        f"across {len(report.workers)} workers and {report.partitions} partitions in {report.windows} windows"
+    )
+    if report.collapsed:
+        print(
+            f"  {report.collapsed} of {report.windows} windows posted as a single partition: "
+            f"transfers linked all of their accounts, so one worker posted each"
+        )
+    for pid, stats in sorted(report.workers.items()):
+        rate = stats["posted"] / stats["seconds"] if stats["seconds"] else 0.0
+        print(
+            f"  worker {pid}: {stats['partitions']} partitions, {stats['posted']} posted, "
+            f"{stats['rejected']} rejected, {stats['seconds']:.2f}s busy ({rate:,.0f} postings/s)"
+        )
+
+def _add_primary(parser):
+    parser.add_argument("--primary", action="store_true",
+                        help="read from the primary database, not a replica (see DATABASE_READ_URLS)")
+
+def operation_command(args):
+    from database import Session, read_session
+    import commands
+
+    params = {k: v for k, v in vars(args).items() if k not in ("func", "command", "profile_startup", "primary")}
+    params.setdefault("op", args.command)
+    reads = params["op"] in commands.READ_OPERATIONS and not getattr(args, "primary", False)
+    new_session = read_session if reads else Session
+    with metrics.operation(f"command.{params['op']}"), new_session() as session:
+        response = commands.execute(session, params)
+    print(commands.to_json(response))
+    if not response["ok"]:
+        raise SystemExit(1)
+
+def batch_command(args):
+    import sys
+    from database import Session
+    import commands
+    import recipients
+
+    recipients.start_preload()
+    source = open(args.input, encoding="utf-8") if args.input else sys.stdin
+    with source, Session() as session:
+        failures = commands.run_batch(session, source, sys.stdout)
+    if failures:
+        raise SystemExit(1)
+
+def snapshot_command(args):
+    from datetime import date
+    from database import Session
+    from snapshots import refresh_snapshots
+
+    through = date.fromisoformat(args.through) if args.through else None
+    with Session() as session:
+        written = refresh_snapshots(session, through=through)
+    print(f"Wrote {written} balance snapshots.")
+
+def verify_ledger_command(args):
+    import cache
+    from database import Session
+    from ledger import verify_ledger
+
+    with Session() as session:
+        account_id = None
+        if args.account:
+            account_id = cache.get_account_id(session, args.account)
+            if not account_id:
+                print(f"Account {args.account} not found.")
+                raise SystemExit(1)
+        report = verify_ledger(session, account_id=account_id, full=args.full)
+    print(
+        f"Checked {report.entries} entries in {report.accounts} accounts and {report.journals} journals "
+        f"(through entry {report.through_entry_id})."
+    )
+    for error in report.errors:
+        print(f"  {error}")
+    if not report.ok:
+        raise SystemExit(1)
+
+def export_command(args):
+    import sys
+    import cache
+    import commands
+    from database import Session, read_session
+    from export import detect_format, export_to_path, export_transactions
+
+    fmt = args.format or (detect_format(args.output) if args.output else "csv")
+    try:
+        filters = {
+            "since": commands.parse_when(args.since) if args.since else None,
+            "until": commands.parse_when(args.until) if args.until else None,
+        }
+    except commands.CommandError as e:
+        print(e)
+        raise SystemExit(1)
+    with (Session() if args.primary else read_session()) as session:
+        if args.account:
+            filters["account_id"] = cache.get_account_id(session, args.account)
+            if not filters["account_id"]:
+                print(f"Account {args.account} not found.")
+                raise SystemExit(1)
+        if args.output:
+            count = export_to_path(session, args.output, fmt, **filters)
+            print(f"Exported {count} transactions to {args.output}.")
+        else:
+            out = sys.stdout.buffer if fmt == "columnar" else sys.stdout
+            export_transactions(session, out, fmt, **filters)
+
+def _print_table(headers, rows):
+    rows = [["" if v is None else getattr(v, "value", v) for v in row] for row in rows]
+    widths = [max([len(str(h))] + [len(str(row[i])) for row in rows]) for i, h in enumerate(headers)]
+    print("  ".join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+
+def report_command(args):
+    import analytics
+    import cache
+    import commands
+    from database import Session, read_session
+
+    try:
+        since = commands.parse_when(args.since) if args.since else None
+        until = commands.parse_when(args.until) if args.until else None
+    except commands.CommandError as e:
+        print(e)
+        raise SystemExit(1)
+    with (Session() if args.primary else read_session()) as session:
+        account_id = None
+        if args.account:
+            account_id = cache.get_account_id(session, args.account)
+            if not account_id:
+                print(f"Account {args.account} not found.")
+                raise SystemExit(1)
+        if args.report == "monthly" and args.by_account:
+            # One line per account and month; printed as it streams
+            print("account,month,inflow,outflow,transactions")
+            for row in analytics.account_monthly_flows(session, since=since, until=until):
+                print(",".join(str(v) for v in row))
+        elif args.report == "monthly":
+            _print_table(("month", "inflow", "outflow", "transactions"),
+                         analytics.monthly_flows(session, account_id=account_id, since=since, until=until))
+        elif args.report == "fees":
+            _print_table(("month", "fees total", "fees", "accounts"), analytics.fee_totals(session, since=since, until=until))
+        elif args.report == "top-accounts":
+            _print_table(("account", "type", "volume", "inflow", "outflow", "transactions"),
+                         analytics.top_accounts(session, limit=args.limit, since=since, until=until))
+        else:
+            _print_table(("type", "accounts", "total", "average", "lowest", "highest"), analytics.balances_by_type(session))
+
+def prune_keys_command(args):
+    from database import Session
+    import idempotency
+
+    with Session() as session:
+        if args.ttl is None:
+            deleted = idempotency.prune(session)
+        else:
+            deleted = idempotency.prune(session, ttl=args.ttl)
+    print(f"Deleted {deleted} expired idempotency keys.")
+
+def archive_command(args):
+    from datetime import date
+    import archive
+    from database import Session
+
+    with Session() as session:
+        if args.status:
+            _print_table(("month", "transactions", "first", "last", "location"), [
+                (p.month, p.transaction_count, p.first_created, p.last_created, p.location)
+                for p in archive.status(session)
+            ])
+            return
+        before = date.fromisoformat(args.before) if args.before else None
+        try:
+            report = archive.archive(session, before=before, dry_run=args.dry_run)
+        except archive.ArchiveError as e:
+            print(e)
+            raise SystemExit(1)
+        verb = "Would move" if args.dry_run else "Moved"
+        print(f"{verb} {report.moved} transactions of {report.accounts} accounts created before {report.horizon}.")
+        for month, count in sorted(report.months.items()):
+            print(f"  {month}: {count}")
+        if args.vacuum and not args.dry_run and session.get_bind().dialect.name == "sqlite":
+            session.connection().exec_driver_sql("VACUUM")
+            print("Vacuumed the database.")
+
+def run_job_command(args):
+    import jobs
+    from database import Session
+
+    with Session() as session:
+        if args.status:
+            _print_table(("job", "period", "status", "accounts", "total", "started", "completed"), [
+                (r.job, r.period, r.status, r.accounts, r.total, r.started_at, r.completed_at)
+                for r in jobs.status(session, None if args.job == "all" else args.job)
+            ])
+            return
+        if args.job == "all":
+            print("Choose a job to run: interest or fees.")
+            raise SystemExit(1)
+        try:
+            report = jobs.run_job(session, args.job, period=args.period, chunk_size=args.chunk_size, dry_run=args.dry_run)
+        except jobs.JobError as e:
+            print(e)
+            raise SystemExit(1)
+    if report.already_completed:
+        print(f"{report.job} for {report.period} has already been posted.")
+    elif args.dry_run:
+        print(f"Would post {report.job} for {report.period} to {report.accounts} accounts, "
+              f"{report.total} in total ({report.skipped} not eligible).")
+    else:
+        print(f"Posted {report.job} for {report.period} to {report.accounts} accounts, "
+              f"{report.total} in total, in {report.chunks} chunks.")
+
+def _limit(limit):
+    if limit is None:
+        return "-"
+    count = "-" if limit.count is None else limit.count
+    amount = "-" if limit.cents is None else f"{limit.cents / 100:.2f}"
+    return f"{count}/{amount}"
+
+def limits_command(args):
+    import cache
+    import limits
+    from database import Session
+
+    with Session() as session:
+        account = cache.get_account_by_number(session, args.account)
+        if account is None:
+            print(f"Account {args.account} not found.")
+            raise SystemExit(1)
+        limiter = limits.limiter(session)
+        usage = limiter.usage(str(account.id), str(account.owner_id))
+    account_limits = {limit.window: limit for limit in limiter.account_limits}
+    user_limits = {limit.window: limit for limit in limiter.user_limits}
+    _print_table(("window", "account", "account limit", "user", "user limit"), [
+        (window, f"{count}/{cents / 100:.2f}", _limit(account_limits.get(window)),
+         f"{user_count}/{user_cents / 100:.2f}", _limit(user_limits.get(window)))
+        for window, (count, cents, user_count, user_cents) in usage.items()
+    ])
+
+def replica_copy_command(args):
+    from database import copy_sqlite
+
+    copy_sqlite(args.path)
+    print(f"Copied the database to {args.path}; add sqlite+pysqlite:///{args.path} to DATABASE_READ_URLS to read from it.")
+
+def _ms(seconds):
+    if seconds is None:
+        return ""
+    return ">10s" if seconds == float("inf") else f"{seconds * 1000:.1f}"
+
+def stats_command(args):
+    if args.reset:
+        metrics.reset()
+        print("Metrics reset.")
+        return
+    if not metrics.METRICS_FILE:
+        print("METRICS_FILE is not set, so no totals are kept between runs; set it to collect them.")
+        return
+    metrics.flush()
+    data = metrics.load()
+    if args.prometheus:
+        print(metrics.prometheus(data), end="")
+        return
+    if not data["operations"] and not data["sql"]:
+        print(f"No metrics recorded yet in {metrics.METRICS_FILE}.")
+        return
+    rows = []
+    for name, op in sorted(data["operations"].items()):
+        latency = metrics.Histogram.from_dict(op["latency"])
+        statements = metrics.Histogram.from_dict(op["statements"])
+        calls = latency.count
+        rows.append((
+            name, calls, _ms(latency.quantile(0.5)), _ms(latency.quantile(0.95)), _ms(latency.quantile(0.99)),
+            _ms(latency.sum / calls), f"{statements.sum / calls:.1f}", f"{op['rows'] / calls:.1f}",
+            _ms(op["sql_seconds"] / calls), op["errors"],
+        ))
+    print("Operations (latency percentiles are bucket upper bounds):")
+    _print_table(("operation", "calls", "p50 ms", "p95 ms", "p99 ms", "mean ms", "statements", "rows", "sql ms", "errors"), rows)
+
+    print("\nSlowest statements by total time:")
+    print(f"{'calls':>8} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'rows':>9}  statement")
+    for text, calls, seconds, longest, rows in metrics.slowest(data, args.limit):
+        print(f"{calls:>8} {_ms(seconds):>10} {_ms(seconds / calls):>9} {_ms(longest):>9} {rows:>9}  {text[:args.width]}")
+
+    repeats = sorted(data["repeats"], key=lambda r: (r[3], r[2]), reverse=True)[:args.limit]
+    if repeats:
+        print("\nStatements run repeatedly within one call (possible N+1 queries):")
+        print(f"{'calls':>8} {'most':>6}  operation: statement")
+        for name, text, calls, most in repeats:
+            print(f"{calls:>8} {most:>6}  {name}: {text[:args.width]}")
+
+def init_db_command(args):
+    from database import init_db
+
+    init_db()
+    print("Database schema is up to date.")
+
+def _parse_importtime(lines):
+    """Return (module, self_us, cumulative_us) for the top-level imports in -X importtime output."""
+    entries = []
+    for line in lines:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        if module.startswith("  ") or not self_us.strip().isdigit():
+            continue  # nested import, or the header row
+        entries.append((module.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+def profile_startup(limit=15):
+    """Print where cold-start time goes, using a fresh interpreter with -X importtime."""
+    import os
+    import subprocess
+    import sys
+
+    marker = "-- database layer --"
+    code = (
+        "import sys; import app; app.build_parser(); "
+        f"sys.stderr.write({marker!r} + '\\n'); "
+        "import database, models, postings, history"
+    )
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=here, capture_output=True, text=True,
+    )
+    lines = proc.stderr.splitlines()
+    split = lines.index(marker) if marker in lines else len(lines)
+
+    for title, section in (("CLI entry point", lines[:split]), ("Database layer (loaded on first use)", lines[split + 1:])):
+        entries = _parse_importtime(section)
+        total = sum(cumulative for _, _, cumulative in entries)
+        print(f"\n{title}: {total / 1000:.1f} ms")
+        print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+        for module, self_us, cumulative_us in sorted(entries, key=lambda e: e[2], reverse=True)[:limit]:
+            print(f"{cumulative_us / 1000:>16.1f} {self_us / 1000:>10.1f}  {module}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="bank", description="CLI Bank")
+    parser.add_argument("--profile-startup", action="store_true", help="print an import-time breakdown of a cold start and exit")
+    commands = parser.add_subparsers(dest="command")
+
+    for name, verb in (("deposit", "deposit into"), ("withdraw", "withdraw from")):
+        op = commands.add_parser(name, help=f"{verb} an account")
+        op.add_argument("--account", required=True, help="account number")
+        op.add_argument("--amount", required=True)
+        op.add_argument("--reference")
+        op.add_argument("--idempotency-key", dest="idempotency_key", help="retrying with the same key does not post again")
+        op.set_defaults(func=operation_command)
+
+    op = commands.add_parser("transfer", help="transfer between two accounts")
+    op.add_argument("--from", required=True, help="source account number")
+    op.add_argument("--to", required=True, help="recipient account number")
+    op.add_argument("--amount", required=True)
+    op.add_argument("--idempotency-key", dest="idempotency_key", help="retrying with the same key does not post again")
+    op.set_defaults(func=operation_command)
+
+    op = commands.add_parser("balance", help="show an account's balance")
+    op.add_argument("--account", required=True, help="account number")
+    _add_primary(op)
+    op.set_defaults(func=operation_command)
+
+    op = commands.add_parser("history", help="show an account's most recent transactions")
+    op.add_argument("--account", required=True, help="account number")
+    op.add_argument("--limit", type=int, default=HISTORY_PAGE_SIZE)
+    _add_primary(op)
+    op.set_defaults(func=operation_command)
+
+    op = commands.add_parser("balance-at", help="show an account's balance at a past date or time")
+    op.add_argument("--account", required=True, help="account number")
+    op.add_argument("--at", required=True, help="YYYY-MM-DD (end of day) or an ISO datetime")
+    _add_primary(op)
+    op.set_defaults(func=operation_command, op="balance_at")
+
+    op = commands.add_parser("dashboard", help="show a user's accounts, cards, beneficiaries and recent transactions")
+    op.add_argument("--email", required=True, help="the user's email")
+    op.add_argument("--preview", type=int, default=DASHBOARD_PREVIEW_SIZE, help="latest transactions per account")
+    _add_primary(op)
+    op.set_defaults(func=operation_command)
+
+    op = commands.add_parser("audit", help="show audit events, newest first")
+    op.add_argument("--account", help="events for this account number")
+    op.add_argument("--entity", help="entity type, e.g. User or Account")
+    op.add_argument("--entity-id", dest="entity_id", help="entity id (with --entity)")
+    op.add_argument("--action", help="e.g. LOGIN, DEPOSIT, TRANSFER_OUT")
+    op.add_argument("--since", help="YYYY-MM-DD or an ISO datetime")
+    op.add_argument("--until", help="YYYY-MM-DD or an ISO datetime (exclusive)")
+    op.add_argument("--limit", type=int, default=50)
+    _add_primary(op)
+    op.set_defaults(func=operation_command)
+
+    export = commands.add_parser("export", help="stream transactions to CSV, JSONL or a binary columnar file")
+    export.add_argument("--account", help="only this account number (a statement)")
+    export.add_argument("--since", help="YYYY-MM-DD or an ISO datetime")
+    export.add_argument("--until", help="YYYY-MM-DD (inclusive) or an ISO datetime (exclusive)")
+    export.add_argument("--format", choices=["csv", "jsonl", "columnar"], help="default: from --output's extension, else csv")
+    export.add_argument("--output", "-o", help="file to write (default: stdout)")
+    _add_primary(export)
+    export.set_defaults(func=export_command)
+
+    report = commands.add_parser("report", help="ledger analytics computed in the database")
+    report.add_argument("report", choices=["monthly", "fees", "top-accounts", "balances"])
+    report.add_argument("--account", help="monthly: only this account number")
+    report.add_argument("--by-account", action="store_true", help="monthly: one CSV line per account and month")
+    report.add_argument("--since", help="YYYY-MM-DD or an ISO datetime")
+    report.add_argument("--until", help="YYYY-MM-DD (inclusive) or an ISO datetime (exclusive)")
+    report.add_argument("--limit", type=int, default=10, help="top-accounts: how many")
+    _add_primary(report)
+    report.set_defaults(func=report_command)
+
+    snapshot = commands.add_parser("snapshot", help="update end-of-day balance snapshots")
+    snapshot.add_argument("--through", help="last day to snapshot, YYYY-MM-DD (default: yesterday, UTC)")
+    snapshot.set_defaults(func=snapshot_command)
+
+    verify = commands.add_parser("verify-ledger", help="check running balances against the journal")
+    verify.add_argument("--account", help="check only this account number")
+    verify.add_argument("--full", action="store_true", help="check every entry, not just those since the last clean run")
+    verify.set_defaults(func=verify_ledger_command)
+
+    prune = commands.add_parser("prune-keys", help="delete expired idempotency keys")
+    prune.add_argument("--ttl", type=float, help="delete keys older than this many seconds (default: IDEMPOTENCY_KEY_TTL)")
+    prune.set_defaults(func=prune_keys_command)
+
+    arch = commands.add_parser("archive", help="move old transactions into monthly archive partitions")
+    arch.add_argument("--before", help="move transactions created before this date, YYYY-MM-DD (default: ARCHIVE_AFTER_DAYS ago)")
+    arch.add_argument("--dry-run", action="store_true", help="only count what would be moved")
+    arch.add_argument("--vacuum", action="store_true", help="SQLite: give the freed space back to the filesystem afterwards")
+    arch.add_argument("--status", action="store_true", help="list the archive partitions")
+    arch.set_defaults(func=archive_command)
+
+    job = commands.add_parser("run-job", help="post month-end savings interest or checking maintenance fees")
+    job.add_argument("job", choices=["interest", "fees", "all"], help="the job to run (all: with --status only)")
+    job.add_argument("--period", help="month to post for, YYYY-MM (default: last month)")
+    job.add_argument("--dry-run", action="store_true", help="only add up what would be posted")
+    job.add_argument("--chunk-size", type=int, default=JOB_CHUNK_SIZE, help="accounts posted per transaction")
+    job.add_argument("--status", action="store_true", help="list runs of the job and their checkpoints")
+    job.set_defaults(func=run_job_command)
+
+    lim = commands.add_parser("limits", help="show an account's and its owner's debits against the velocity limits")
+    lim.add_argument("--account", required=True, help="account number")
+    lim.set_defaults(func=limits_command)
+
+    batch = commands.add_parser("batch", help="run newline-delimited JSON commands from stdin")
+    batch.add_argument("--input", help="read commands from this file instead of stdin")
+    batch.set_defaults(func=batch_command)
+
+    stats = commands.add_parser("stats", help="show operation latency and SQL statement stats")
+    stats.add_argument("--limit", type=int, default=10, help="statements to list")
+    stats.add_argument("--width", type=int, default=100, help="characters of each statement to show")
+    stats.add_argument("--prometheus", action="store_true", help="print the Prometheus text format instead")
+    stats.add_argument("--reset", action="store_true", help="clear the recorded metrics")
+    stats.set_defaults(func=stats_command)
+
+    init = commands.add_parser("init-db", help="create the database tables and indexes")
+    init.set_defaults(func=init_db_command)
+
+    replica = commands.add_parser("replica-copy", help="copy the SQLite database to a file for use as a local read replica")
+    replica.add_argument("path")
+    replica.set_defaults(func=replica_copy_command)
+
+    bulk = commands.add_parser("bulk-post", aliases=["bulk_post"], help="post a CSV/JSONL file of transactions")
+    bulk.add_argument("file", help="input file with type,account,to_account,amount,reference columns")
+    bulk.add_argument("--format", choices=["csv", "jsonl"], help="input format (default: from file extension)")
+    bulk.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE, help="rows per committed batch")
+    bulk.add_argument("--rejects", help="where to write rejected rows (default: <file>.rejects.jsonl)")
+    bulk.add_argument("--workers", type=int, default=1, help="posting processes; rows are partitioned by account")
+    bulk.add_argument("--partitions", type=int, help="account partitions to spread over the workers (default: 4 per worker)")
+    bulk.add_argument("--window", type=int, help="rows partitioned and posted per round with --workers (default: one batch per partition)")
+    bulk.set_defaults(func=bulk_post_command)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.profile_startup:
+        profile_startup()
+    elif args.command is None:
+        main_menu()
+    else:
+        args.func(args)
+
 if __name__ == "__main__":
-    main_menu()
+    main()
@@ -0,0 +1,305 @@
+"""
+Hot/cold tiering of transactions.
+
+archive() moves transactions created before a horizon (by default
+ARCHIVE_AFTER_DAYS ago) out of the transactions table into one partition
+per month, so the live table and its index only hold the recent working
+set. On SQLite a partition is a file, ARCHIVE_DIR/transactions_YYYY_MM.db,
+ATTACHed to a connection only when a query needs it; on PostgreSQL it is a
+table, transactions_archive_YYYY_MM. Partitions have the live table's
+columns and (account_id, created_at, id) index.
+
+Two tables in the main database describe the archive: archive_partitions
+(one row per month) and archived_ranges, the first and last created_at of
+each account in each month. Readers use them to pick the partitions that
+can hold matching rows and skip the rest: history.fetch_page() only looks
+past the live table when a page runs out there, and then only at the
+account's months, newest first; exports and snapshots.balance_at() do the
+same for their date range. Analytics reports cover the live table only.
+
+Accounts are moved in chunks of ARCHIVE_CHUNK_SIZE: copy into the
+partitions, check that every row to be removed is there (row count and
+sum of amounts, joined by id), then delete from the live table and update
+the ranges. On PostgreSQL that is one transaction. On SQLite a commit that
+spans ATTACHed files is not atomic in WAL mode, so the copy commits first
+(partition files use synchronous=FULL) and the check, delete and range
+update follow in a second transaction on the main file alone. A crash in
+between leaves rows in both places, which readers never see as the
+ranges do not point at them yet; rows are copied with INSERT OR IGNORE
+(ON CONFLICT DO NOTHING), so the run is simply repeated.
+Balance snapshots are brought up to the horizon first, since an archived
+day can then only be needed inside one of balance_at()'s partial days.
+"""
+from __future__ import annotations
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from sqlalchemy import Column, Index, MetaData, String, Table, delete, func, insert, select, type_coerce
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_CHUNK_SIZE, ARCHIVE_DIR, ARCHIVE_MAX_ATTACHED
+from models import Account, ArchivedRange, ArchivePartition, SnapshotCheckpoint, Transaction, now_utc
+from postings import begin_write
+
+LIVE = Transaction.__table__
+_CREATED = type_coerce(Transaction.created_at, String)
+
+class ArchiveError(RuntimeError):
+    pass
+
+@dataclass
+class ArchiveReport:
+    horizon: date
+    moved: int = 0
+    accounts: int = 0
+    months: dict = field(default_factory=dict)  # 'YYYY-MM' -> rows moved this run
+
+def _is_sqlite(session) -> bool:
+    return session.get_bind().dialect.name == "sqlite"
+
+def as_datetime(value) -> datetime:
+    """A stored created_at (text on SQLite) as a datetime."""
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+def month_bounds(month):
+    """[start, end) of 'YYYY-MM' as comparable stored text."""
+    year, number = int(month[:4]), int(month[5:7])
+    end = date(year + 1, 1, 1) if number == 12 else date(year, number + 1, 1)
+    return f"{month}-01", end.isoformat()
+
+def _name(month) -> str:
+    return month.replace("-", "_")
+
+def _path(month) -> Path:
+    return Path(ARCHIVE_DIR) / f"transactions_{_name(month)}.db"
+
+def _table(name, schema=None) -> Table:
+    """A table with the live transactions table's columns and history index."""
+    columns = [Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable) for c in LIVE.columns]
+    return Table(
+        name, MetaData(), *columns,
+        Index(f"ix_{name}_account_created_id", "account_id", "created_at", "id"),
+        schema=schema,
+    )
+
+# (dialect, month) -> Table
+_tables = {}
+
+def _attach(session, month, create):
+    """Attach the month's SQLite file to the session's connection (at most ARCHIVE_MAX_ATTACHED at once)."""
+    conn = session.connection()
+    attached = conn.connection.info.setdefault("archive_attached", OrderedDict())
+    alias = f"archive_{_name(month)}"
+    if alias in attached:
+        attached.move_to_end(alias)
+        return alias
+    path = _path(month)
+    if not path.exists():
+        if not create:
+            raise ArchiveError(f"Archive file {path} for {month} is missing.")
+        path.parent.mkdir(parents=True, exist_ok=True)
+    while len(attached) >= ARCHIVE_MAX_ATTACHED:
+        oldest, _ = attached.popitem(last=False)
+        conn.exec_driver_sql(f"DETACH DATABASE {oldest}")
+    conn.exec_driver_sql(f"ATTACH DATABASE ? AS {alias}", (str(path),))
+    # The live rows are deleted once this file has committed a copy; it must survive a power cut
+    conn.exec_driver_sql(f"PRAGMA {alias}.synchronous=FULL")
+    attached[alias] = str(path)
+    return alias
+
+def partition(session, month, create=False) -> Table:
+    """The archive table for 'YYYY-MM', attached (SQLite) and, with ``create``, created if missing."""
+    sqlite = _is_sqlite(session)
+    if sqlite:
+        alias = _attach(session, month, create)
+    key = (sqlite, month)
+    table = _tables.get(key)
+    if table is None:
+        table = _tables[key] = _table("transactions", alias) if sqlite else _table(f"transactions_archive_{_name(month)}")
+    if create:
+        table.create(session.connection(), checkfirst=True)
+    return table
+
+def _overlaps(first, last, since=None, until=None) -> bool:
+    """Whether [first, last] can hold rows created in [since, until) (stored text or datetimes)."""
+    if since is not None and as_datetime(last) < as_datetime(since):
+        return False
+    return until is None or as_datetime(first) < as_datetime(until)
+
+def account_months(session, account_id) -> list:
+    """(month, first_created, last_created) of the account's archived months, oldest first."""
+    return session.execute(
+        select(ArchivedRange.month, ArchivedRange.first_created, ArchivedRange.last_created)
+        .where(ArchivedRange.account_id == account_id)
+        .order_by(ArchivedRange.month)
+    ).all()
+
+def months_for(session, account_id=None, since=None, until=None) -> list:
+    """
+    Archived months that can hold transactions of ``account_id`` (or of any
+    account) created in [since, until), oldest first. ``since`` and
+    ``until`` are datetimes or stored created_at text. Get each month's
+    table with partition() just before querying it: attaching more than
+    ARCHIVE_MAX_ATTACHED files detaches the least recently used.
+    """
+    if account_id is not None:
+        months = account_months(session, account_id)
+    else:
+        months = session.execute(
+            select(ArchivePartition.month, ArchivePartition.first_created, ArchivePartition.last_created)
+            .order_by(ArchivePartition.month)
+        ).all()
+    return [month for month, first, last in months if _overlaps(first, last, since, until)]
+
+def _ensure_snapshots(session, horizon):
+    from snapshots import CHECKPOINT, refresh_snapshots
+
+    checkpoint = session.get(SnapshotCheckpoint, CHECKPOINT)
+    if checkpoint is None or checkpoint.completed_through < horizon - timedelta(days=1):
+        refresh_snapshots(session, through=horizon - timedelta(days=1))
+    session.commit()
+
+def _moving(account_ids, start, end):
+    return Transaction.account_id.in_(account_ids), _CREATED >= start, _CREATED < end
+
+def _copy(session, table, account_ids, start, end):
+    rows = select(*LIVE.columns).where(*_moving(account_ids, start, end))
+    if _is_sqlite(session):
+        stmt = insert(table).prefix_with("OR IGNORE")
+    else:
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        stmt = pg_insert(table).on_conflict_do_nothing()
+    session.execute(stmt.from_select([c.name for c in LIVE.columns], rows))
+
+def _verify(session, table, month, account_ids, start, end):
+    """Raise ArchiveError unless every live row in the range is in ``table`` with the same amount."""
+    live = session.execute(select(func.count(), func.sum(LIVE.c.amount)).where(*_moving(account_ids, start, end))).one()
+    copied = session.execute(
+        select(func.count(), func.sum(table.c.amount))
+        .select_from(LIVE.join(table, table.c.id == LIVE.c.id))
+        .where(*_moving(account_ids, start, end))
+    ).one()
+    if tuple(live) != tuple(copied):
+        raise ArchiveError(
+            f"Archive for {month} holds {copied[0]} of {live[0]} transactions being moved "
+            f"(amounts {copied[1]} vs {live[1]}); nothing was deleted from the live table."
+        )
+
+def _record(session, months, spans):
+    """Fold this chunk's (account, first, last, rows) per month into archived_ranges and archive_partitions."""
+    account_ids = {account_id for month in months for account_id, _, _, _ in spans[month]}
+    existing = {
+        (r.account_id, r.month): r
+        for r in session.scalars(
+            select(ArchivedRange).where(ArchivedRange.account_id.in_(account_ids), ArchivedRange.month.in_(months))
+        )
+    }
+    for month in months:
+        for account_id, first, last, count in spans[month]:
+            first, last = as_datetime(first), as_datetime(last)
+            found = existing.get((account_id, month))
+            if found is None:
+                session.add(ArchivedRange(account_id=account_id, month=month, first_created=first,
+                                          last_created=last, transaction_count=count))
+            else:
+                found.first_created = min(found.first_created, first)
+                found.last_created = max(found.last_created, last)
+                found.transaction_count += count
+        first = min(as_datetime(span[1]) for span in spans[month])
+        last = max(as_datetime(span[2]) for span in spans[month])
+        count = sum(span[3] for span in spans[month])
+        found = session.get(ArchivePartition, month)
+        if found is None:
+            location = str(_path(month)) if _is_sqlite(session) else f"transactions_archive_{_name(month)}"
+            session.add(ArchivePartition(month=month, location=location, transaction_count=count,
+                                         first_created=first, last_created=last))
+        else:
+            found.first_created = min(found.first_created, first)
+            found.last_created = max(found.last_created, last)
+            found.transaction_count += count
+
+def archive(session, before=None, chunk_size=ARCHIVE_CHUNK_SIZE, dry_run=False) -> ArchiveReport:
+    """
+    Move transactions created before ``before`` (a date; default
+    ARCHIVE_AFTER_DAYS ago) into the monthly partitions. With ``dry_run``
+    only count what would move.
+    """
+    horizon = before or now_utc().date() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    cutoff = horizon.isoformat()
+    report = ArchiveReport(horizon)
+    if not dry_run:
+        _ensure_snapshots(session, horizon)
+    month = func.substr(_CREATED, 1, 7) if _is_sqlite(session) else func.to_char(Transaction.created_at, "YYYY-MM")
+
+    last_id = None
+    while True:
+        stmt = select(Account.id).order_by(Account.id).limit(chunk_size)
+        if last_id is not None:
+            stmt = stmt.where(Account.id > last_id)
+        account_ids = session.scalars(stmt).all()
+        if not account_ids:
+            break
+        last_id = account_ids[-1]
+        spans = defaultdict(list)
+        for account_id, txn_month, first, last, count in session.execute(
+            select(Transaction.account_id, month, func.min(_CREATED), func.max(_CREATED), func.count())
+            .where(Transaction.account_id.in_(account_ids), _CREATED < cutoff)
+            .group_by(Transaction.account_id, month)
+        ):
+            spans[txn_month].append((account_id, first, last, count))
+        # Nothing is written yet, so SQLite can attach partitions outside a transaction
+        session.commit()
+        if not spans:
+            continue
+        report.accounts += len({span[0] for chunk in spans.values() for span in chunk})
+        for txn_month, chunk in spans.items():
+            moved = sum(span[3] for span in chunk)
+            report.months[txn_month] = report.months.get(txn_month, 0) + moved
+            report.moved += moved
+        if dry_run:
+            continue
+
+        months = sorted(spans)
+        for start in range(0, len(months), ARCHIVE_MAX_ATTACHED):
+            group = months[start:start + ARCHIVE_MAX_ATTACHED]
+            tables = {m: partition(session, m, create=True) for m in group}
+            ids = sorted({span[0] for m in group for span in spans[m]})
+            ranges = {m: (month_bounds(m)[0], min(month_bounds(m)[1], cutoff)) for m in group}
+            for m in group:
+                _copy(session, tables[m], ids, *ranges[m])
+            if _is_sqlite(session):
+                # Make the copies durable on their own before anything leaves the live table
+                session.commit()
+                # The next transaction may run on another pooled connection; attach there before it begins
+                tables = {m: partition(session, m) for m in group}
+                begin_write(session)
+            try:
+                for m in group:
+                    _verify(session, tables[m], m, ids, *ranges[m])
+            except ArchiveError:
+                session.rollback()
+                raise
+            session.execute(delete(LIVE).where(*_moving(ids, ranges[group[0]][0], ranges[group[-1]][1])))
+            _record(session, group, spans)
+            session.commit()
+    return report
+
+def status(session) -> list:
+    """ArchivePartition rows, oldest month first."""
+    return session.scalars(select(ArchivePartition).order_by(ArchivePartition.month)).all()
+
+def clear(session):
+    """Drop every partition and forget the archive (used when the database is reseeded)."""
+    for p in status(session):
+        if _is_sqlite(session):
+            conn = session.connection()
+            attached = conn.connection.info.get("archive_attached", {})
+            alias = f"archive_{_name(p.month)}"
+            if alias in attached:
+                conn.exec_driver_sql(f"DETACH DATABASE {alias}")
+                del attached[alias]
+            Path(p.location).unlink(missing_ok=True)
+        else:
+            partition(session, p.month).drop(session.connection(), checkfirst=True)
+    session.execute(delete(ArchivedRange))
+    session.execute(delete(ArchivePartition))
+    session.commit()
@@ -0,0 +1,97 @@
+"""
+Asynchronous service layer for account operations.
+
+AsyncBank mirrors deposit, withdraw, transfer, balance, history and the
+dashboard on top of AsyncSession (aiosqlite for SQLite, asyncpg for
+PostgreSQL), so one process can keep many operations in flight while each
+waits on the database. It shares the models with the rest of the
+application, and postings run the same code as postings.py through
+AsyncSession.run_sync(), keeping one implementation of the locking and
+balance rules.
+
+A semaphore caps how many operations run at once; callers can simply
+asyncio.gather() as many coroutines as they like. Entering the AsyncBank
+loads the velocity-limit counters (see limits.py), so the first
+withdrawal or transfer does not stall the event loop building them;
+after that the limit store, if any, is read and written by its own
+thread. Password checks run on the passwords module's thread pool, and
+audit events that find the audit queue full are written on the loop's
+default executor, rather than on the event loop.
+
+Requires the optional async driver for the configured database
+(``pip install aiosqlite`` or ``pip install asyncpg``).
+"""
+from __future__ import annotations
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+import audit
+import dashboard
+import history
+import limits
+import passwords
+import postings
+from cache import USER_COLUMNS
+from config import ASYNC_MAX_CONCURRENCY, DASHBOARD_PREVIEW_SIZE, HISTORY_PAGE_SIZE
+from database import build_async_engine
+from models import Account, User
+
+class AsyncBank:
+    def __init__(self, url=None, max_concurrency=ASYNC_MAX_CONCURRENCY, **engine_kwargs):
+        self.engine = build_async_engine(url, **engine_kwargs)
+        self.Session = async_sessionmaker(self.engine, autoflush=False, expire_on_commit=False)
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        async with self.Session() as session:
+            await session.run_sync(limits.prepare)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def _run_sync(self, fn, *args, **kwargs):
+        async with self._slots, self.Session() as session:
+            return await session.run_sync(fn, *args, **kwargs)
+
+    async def deposit(self, account_id, amount, reference="deposit", idempotency_key=None) -> postings.PostingResult:
+        return await self._run_sync(postings.deposit, account_id, amount, reference=reference, idempotency_key=idempotency_key)
+
+    async def withdraw(self, account_id, amount, reference="withdraw", idempotency_key=None) -> postings.PostingResult:
+        return await self._run_sync(postings.withdraw, account_id, amount, reference=reference, idempotency_key=idempotency_key)
+
+    async def transfer(self, from_account_id, to_account_id, amount, idempotency_key=None) -> postings.PostingResult:
+        return await self._run_sync(postings.transfer, from_account_id, to_account_id, amount, idempotency_key=idempotency_key)
+
+    async def balance(self, account_id):
+        """Current balance of ``account_id``, or None if it does not exist."""
+        async with self._slots, self.Session() as session:
+            return await session.scalar(select(Account.balance).where(Account.id == account_id))
+
+    async def account_id(self, account_number):
+        async with self._slots, self.Session() as session:
+            return await session.scalar(select(Account.id).where(Account.account_number == account_number))
+
+    async def history(self, account_id, page_size=HISTORY_PAGE_SIZE, after=None, before=None) -> history.HistoryPage:
+        """One keyset page of history; see history.fetch_page()."""
+        return await self._run_sync(history.fetch_page, account_id, page_size=page_size, after=after, before=before)
+
+    async def dashboard(self, user_id, preview=DASHBOARD_PREVIEW_SIZE) -> dashboard.Dashboard | None:
+        """Accounts, cards, beneficiaries and recent transactions; see dashboard.overview()."""
+        return await self._run_sync(dashboard.overview, user_id, preview=preview)
+
+    async def authenticate(self, email, password):
+        """The user row for ``email`` if ``password`` matches, else None; see passwords.authenticate()."""
+        async with self._slots, self.Session() as session:
+            user = (await session.execute(select(*USER_COLUMNS).where(User.email == email))).first()
+        ok, new_hash = await passwords.verify_user_async(user, password)
+        if not ok:
+            audit.record("User", user.id if user else None, "LOGIN_FAILED", email=email)
+            return None
+        if new_hash:
+            await self._run_sync(passwords.store_rehash, user.id, user.hashed_password, new_hash)
+        audit.record("User", user.id, "LOGIN", rehashed=bool(new_hash))
+        return user
@@ -0,0 +1,233 @@
+"""
+Write-behind audit log.
+
+record() only builds a small tuple and puts it on a bounded in-memory
+queue; a background thread drains the queue and writes audit_logs rows
+with one executemany per batch of AUDIT_BATCH_SIZE events, or after
+AUDIT_FLUSH_INTERVAL seconds, whichever comes first. Postings therefore pay
+microseconds for auditing instead of an extra INSERT in their transaction.
+
+When the writer falls behind and the queue stays full for
+AUDIT_ENQUEUE_TIMEOUT seconds, the caller writes its own event directly:
+producers slow down to the database's pace rather than dropping events.
+A caller on an event loop (AsyncBank) never waits: when the queue is full
+its event is written on the loop's default executor instead.
+The queue is drained on interpreter exit (and by flush()/close()), so
+events are only lost if the process is killed outright. An event records
+the time it happened, not the time it was written.
+
+query() reads the log back through the (entity, entity_id, created_at, id)
+and (created_at, id) indexes, newest first, with keyset paging on
+(created_at, id).
+"""
+from __future__ import annotations
+import asyncio
+import atexit
+import json
+import os
+import queue
+import threading
+from datetime import datetime
+from sqlalchemy import String, and_, insert, or_, select, type_coerce
+from config import (
+    AUDIT_BATCH_SIZE,
+    AUDIT_ENABLED,
+    AUDIT_ENQUEUE_TIMEOUT,
+    AUDIT_FLUSH_INTERVAL,
+    AUDIT_QUEUE_SIZE,
+)
+from models import AuditLog, now_utc
+
+PAYLOAD_LIMIT = 2000
+_STOP = object()
+
+# Compare created_at as stored, as history.py does: SQLite keeps it as text
+_CREATED_KEY = type_coerce(AuditLog.created_at, String)
+
+AUDIT_COLUMNS = (
+    AuditLog.id,
+    AuditLog.entity,
+    AuditLog.entity_id,
+    AuditLog.action,
+    AuditLog.payload,
+    AuditLog.created_at,
+    _CREATED_KEY.label("created_key"),
+)
+
+def _bound(value) -> str:
+    """A date or datetime as comparable stored text."""
+    if isinstance(value, datetime):
+        return value.isoformat(" ", "microseconds")
+    return value.isoformat()
+
+def _row(entity, entity_id, action, payload, created_at) -> dict:
+    text = json.dumps(payload, default=str, separators=(",", ":")) if payload else None
+    return {
+        "entity": entity,
+        "entity_id": None if entity_id is None else str(entity_id),
+        "action": action,
+        "payload": text[:PAYLOAD_LIMIT] if text else None,
+        "created_at": created_at,
+    }
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def write_events(events):
+    """Insert (entity, entity_id, action, payload, created_at) tuples with one executemany."""
+    import database
+
+    if events:
+        with database.engine.begin() as conn:
+            conn.execute(insert(AuditLog.__table__), [_row(*event) for event in events])
+
+class AuditWriter:
+    """A bounded queue of audit events and the thread that writes them in batches."""
+
+    def __init__(self, maxsize=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 interval=AUDIT_FLUSH_INTERVAL, enqueue_timeout=AUDIT_ENQUEUE_TIMEOUT):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.enqueue_timeout = enqueue_timeout
+        self.pid = os.getpid()
+        self.written = 0
+        self.direct_writes = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, entity, entity_id, action, payload=None):
+        event = (entity, entity_id, action, payload, now_utc())
+        if self._closed:
+            write_events([event])
+            return
+        loop = _running_loop()
+        try:
+            self._queue.put(event, block=loop is None, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self.direct_writes += 1
+            if loop is None:
+                # Backpressure: the writer is behind, so this caller pays for its own insert
+                write_events([event])
+            else:
+                loop.run_in_executor(None, self._write_direct, event)
+
+    def _write_direct(self, event):
+        try:
+            write_events([event])
+        except Exception:
+            self.failed += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    self._queue.task_done()
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            write_events(batch)
+            self.written += len(batch)
+        except Exception:
+            # A failed batch must not kill the writer; the events are counted as lost
+            self.failed += len(batch)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every event queued so far has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Write everything still queued and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "direct_writes": self.direct_writes,
+            "failed": self.failed,
+        }
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def writer() -> AuditWriter:
+    """This process's writer, started on first use (and again after a fork)."""
+    global _writer
+    if _writer is None or _writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = AuditWriter()
+                atexit.register(_writer.close)
+    return _writer
+
+def record(entity, entity_id, action, **payload):
+    """Queue an audit event; ``payload`` is stored as JSON."""
+    if AUDIT_ENABLED:
+        writer().record(entity, entity_id, action, payload)
+
+def flush():
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+def stats() -> dict:
+    if _writer is None or _writer.pid != os.getpid():
+        return {"queued": 0, "written": 0, "direct_writes": 0, "failed": 0}
+    return _writer.stats()
+
+def row_key(row):
+    """Keyset cursor (created_at, id) of a query() row."""
+    return (row.created_key, row.id)
+
+def query(session, entity=None, entity_id=None, action=None, since=None, until=None,
+          limit=100, after=None) -> list:
+    """
+    Audit rows matching the filters, newest first. Pass row_key() of the
+    last row as ``after`` for the next page. ``entity_id`` requires
+    ``entity``, so the lookup can use the entity index.
+    """
+    if entity_id is not None and entity is None:
+        raise ValueError("entity_id requires entity.")
+    stmt = select(*AUDIT_COLUMNS)
+    if entity is not None:
+        stmt = stmt.where(AuditLog.entity == entity)
+    if entity_id is not None:
+        stmt = stmt.where(AuditLog.entity_id == str(entity_id))
+    if action is not None:
+        stmt = stmt.where(AuditLog.action == action)
+    if since is not None:
+        stmt = stmt.where(_CREATED_KEY >= _bound(since))
+    if until is not None:
+        stmt = stmt.where(_CREATED_KEY < _bound(until))
+    if after is not None:
+        created, audit_id = after
+        stmt = stmt.where(or_(_CREATED_KEY < created, and_(_CREATED_KEY == created, AuditLog.id < audit_id)))
+    return session.execute(stmt.order_by(_CREATED_KEY.desc(), AuditLog.id.desc()).limit(limit)).all()
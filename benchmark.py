@@ -0,0 +1,330 @@
+"""
+Benchmarks for the ledger hot paths.
+
+Builds a throwaway database with seed_data.generate_data(), times login
+lookup, select_account, deposit, withdraw, transfer, history on the deepest
+accounts, bulk seeding, transfers between a few hot accounts from several
+worker threads at once, and password verification (logins/sec) for each
+hash cost setting in --hash-costs. Results (p50/p95/p99 latency in ms and
+ops/sec per path) are printed as JSON.
+
+    python benchmark.py --users 1000 --accounts 3000 --transactions 200000
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.25
+
+Every path but bulk seeding is run --repeat times and each figure is the
+median over those rounds. With --baseline the run exits with status 1 if
+any path's p95 latency rose, or its throughput fell, by more than
+--threshold against the stored run. The change also has to exceed
+--min-delta-ms (in p95, or in time per operation), and p95 is only judged
+for paths timed over at least --min-samples operations, so that
+sub-millisecond jitter and the tail of a few dozen samples do not fail the
+gate.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+def summarize(samples, elapsed=None) -> dict:
+    """Latency percentiles (ms) and throughput for a list of per-op seconds."""
+    elapsed = elapsed if elapsed is not None else sum(samples)
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = samples[0] if samples else 0.0
+    return {
+        "ops": len(samples),
+        "ops_per_sec": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(p50 * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "p99_ms": round(p99 * 1000, 3),
+    }
+
+def run_path(op, n, warmup=0) -> dict:
+    """Call ``op()`` ``warmup`` + ``n`` times and summarize the last ``n``."""
+    for _ in range(warmup):
+        op()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        op()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples, time.perf_counter() - started)
+
+def build_context(session, rng, sample_size=1000, deep_accounts=5, deep_pages=50):
+    from sqlalchemy import func, select
+    from history import fetch_page
+    from models import Account, Transaction, User
+
+    ctx = {
+        "emails": session.execute(select(User.email).limit(sample_size)).scalars().all(),
+        "owners": session.execute(select(User.id).limit(sample_size)).scalars().all(),
+        "accounts": session.execute(select(Account.id).limit(sample_size)).scalars().all(),
+    }
+    deep = session.execute(
+        select(Transaction.account_id)
+        .group_by(Transaction.account_id)
+        .order_by(func.count().desc())
+        .limit(deep_accounts)
+    ).scalars().all()
+    # Cursors far into each deep account's history, to show page cost does not grow with depth
+    ctx["deep"] = []
+    for account_id in deep:
+        cursor = None
+        for _ in range(deep_pages):
+            page = fetch_page(session, account_id, page_size=20, after=cursor)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        ctx["deep"].append((account_id, cursor))
+    return ctx
+
+def single_threaded(session, ctx, rng, n, warmup) -> dict:
+    import cache
+    import postings
+    from history import fetch_page
+
+    def login():
+        cache.clear()
+        return cache.get_user_by_email(session, rng.choice(ctx["emails"])) is not None
+
+    def select_account():
+        cache.clear()
+        cache.get_accounts_for_owner(session, rng.choice(ctx["owners"]))
+
+    def posting(fn, *accounts):
+        try:
+            fn(session, *accounts, rng.randint(100, 10_000) / 100)
+        except postings.PostingError:
+            session.rollback()
+
+    def transfer():
+        a, b = rng.sample(ctx["accounts"], 2)
+        posting(postings.transfer, a, b)
+
+    def history_first_page():
+        account_id, _ = rng.choice(ctx["deep"])
+        fetch_page(session, account_id, page_size=20)
+
+    def history_deep_page():
+        account_id, cursor = rng.choice(ctx["deep"])
+        fetch_page(session, account_id, page_size=20, after=cursor)
+
+    paths = {
+        "login_lookup": login,
+        "select_account": select_account,
+        "deposit": lambda: posting(postings.deposit, rng.choice(ctx["accounts"])),
+        "withdraw": lambda: posting(postings.withdraw, rng.choice(ctx["accounts"])),
+        "transfer": transfer,
+        "history_first_page": history_first_page,
+        "history_deep_page": history_deep_page,
+    }
+    return {name: run_path(op, n, warmup) for name, op in paths.items()}
+
+def contention(ctx, workers, n, hot_accounts=10, seed=0) -> dict:
+    """Transfers among a few hot accounts from ``workers`` threads, each with its own session."""
+    import postings
+    from database import Session
+
+    hot = ctx["accounts"][:hot_accounts]
+    per_worker = max(1, n // workers)
+    samples = []
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        local = []
+        with Session() as session:
+            for _ in range(per_worker):
+                a, b = rng.sample(hot, 2)
+                t0 = time.perf_counter()
+                try:
+                    postings.transfer(session, a, b, rng.randint(100, 1_000) / 100)
+                except postings.PostingError:
+                    pass
+                local.append(time.perf_counter() - t0)
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(samples, time.perf_counter() - started)
+
+def parse_hash_cost(spec) -> tuple:
+    """``scrypt:n=16384,r=8,p=1`` -> ("scrypt", {"n": 16384, "r": 8, "p": 1})."""
+    scheme, _, params = spec.partition(":")
+    return scheme, {k: int(v) for k, v in (item.split("=") for item in params.split(",") if item)}
+
+def password_hashing(costs, n, workers) -> dict:
+    """Logins/sec for each hash cost setting, verifying on ``workers`` threads."""
+    from concurrent.futures import ThreadPoolExecutor
+    from passwords import hash_password, verify_password
+
+    results = {}
+    for spec in costs:
+        scheme, params = parse_hash_cost(spec)
+        stored = hash_password("password123", scheme, **params)
+
+        def verify(_):
+            t0 = time.perf_counter()
+            # Uncached, so every call pays for the key derivation like a first login
+            verify_password("password123", stored, cached=False)
+            return time.perf_counter() - t0
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            started = time.perf_counter()
+            samples = list(pool.map(verify, range(n)))
+            elapsed = time.perf_counter() - started
+        name = "password_" + "_".join([scheme] + [f"{k}{v}" for k, v in params.items()])
+        results[name] = summarize(samples, elapsed)
+    return results
+
+def median_results(rounds) -> dict:
+    """Per path, the median of every figure over a list of result dicts."""
+    merged = {}
+    for name in rounds[0]:
+        runs = [results[name] for results in rounds]
+        merged[name] = {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]}
+        merged[name]["ops"] = runs[0]["ops"]
+    return merged
+
+def compare(results, baseline, threshold, min_delta_ms=0.0, min_samples=0) -> list:
+    """
+    Describe every path that regressed by more than ``threshold`` against
+    ``baseline``. A p95 rise must also be over ``min_delta_ms``, and is not
+    judged on paths timed over fewer than ``min_samples`` operations; a
+    throughput drop must add over ``min_delta_ms`` to each operation.
+    """
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        p95, base_p95 = current.get("p95_ms", 0), base.get("p95_ms")
+        if (base_p95 and min(current.get("ops", 0), base.get("ops", 0)) >= min_samples
+                and p95 > base_p95 * (1 + threshold) and p95 - base_p95 > min_delta_ms):
+            regressions.append(f"{name}: p95 {current['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+        rate, base_rate = current.get("ops_per_sec", 0), base.get("ops_per_sec")
+        # For timed paths the slowdown per operation must clear min_delta_ms too; bulk_seed has no per-op timings
+        slower_ms = (1000 / rate if rate else float("inf")) - (1000 / base_rate if base_rate else 0)
+        if (base_rate and rate < base_rate * (1 - threshold)
+                and (base_p95 is None or slower_ms > min_delta_ms)):
+            regressions.append(f"{name}: {current['ops_per_sec']} ops/s vs baseline {base['ops_per_sec']} ops/s")
+    return regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the ledger hot paths.")
+    parser.add_argument("--url", help="database URL to benchmark (default: a temporary SQLite file)")
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--accounts", type=int, default=3_000)
+    parser.add_argument("--transactions", type=int, default=100_000)
+    parser.add_argument("--ops", type=int, default=1_000, help="timed operations per path")
+    parser.add_argument("--warmup", type=int, default=50, help="untimed operations per path")
+    parser.add_argument("--workers", default="1,4,8", help="comma-separated worker counts for the contention run")
+    parser.add_argument("--hash-costs", default="scrypt:n=16384,r=8,p=1;scrypt:n=32768,r=8,p=1;pbkdf2_sha256:i=210000;pbkdf2_sha256:i=600000",
+                        help="semicolon-separated password hash settings to time logins for")
+    parser.add_argument("--hash-ops", type=int, default=50, help="password verifications per hash setting")
+    parser.add_argument("--hash-workers", type=int, default=4, help="threads verifying passwords at once")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds per path; each figure is the median over rounds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --save-baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression, as a fraction")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="smallest p95 rise (ms) that counts as a regression")
+    parser.add_argument("--min-samples", type=int, default=100, help="fewest timed operations for a path's p95 to be judged")
+    parser.add_argument("--save-baseline", help="write the results to this file as the new baseline")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    import audit
+    import database
+    import limits
+    from seed_data import generate_data
+
+    tmpdir = None
+    url = args.url
+    if not url:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bank-bench-")
+        url = f"sqlite+pysqlite:///{os.path.join(tmpdir.name, 'bench.db')}"
+    database.configure(url, echo=False)
+    database.init_db()
+    # Count debits as usual, but reject none and keep them out of the shared store
+    limits.configure(enabled=True, account_limits="", user_limits="", store="")
+
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        with database.Session() as session:
+            rows = args.users + args.accounts + args.transactions
+            t0 = time.perf_counter()
+            generate_data(session, args.users, args.accounts, args.transactions, seed=args.seed)
+            seconds = time.perf_counter() - t0
+            results["bulk_seed"] = {"ops": rows, "ops_per_sec": round(rows / seconds, 1), "seconds": round(seconds, 3)}
+
+            ctx = build_context(session, rng)
+
+        costs = [spec.strip() for spec in args.hash_costs.split(";") if spec.strip()]
+        rounds = []
+        for round_no in range(max(1, args.repeat)):
+            timed = {}
+            with database.Session() as session:
+                timed.update(single_threaded(session, ctx, rng, args.ops, args.warmup))
+            for workers in (int(w) for w in args.workers.split(",") if w.strip()):
+                timed[f"transfer_contention_{workers}w"] = contention(ctx, workers, args.ops, seed=args.seed + round_no)
+            timed.update(password_hashing(costs, args.hash_ops, args.hash_workers))
+            rounds.append(timed)
+        results.update(median_results(rounds))
+    finally:
+        audit.flush()
+        database.engine.dispose()
+        if tmpdir:
+            tmpdir.cleanup()
+
+    report = {
+        "meta": {
+            "url": database.engine.url.render_as_string(hide_password=True),
+            "users": args.users,
+            "accounts": args.accounts,
+            "transactions": args.transactions,
+            "ops": args.ops,
+            "repeat": max(1, args.repeat),
+            "seed": args.seed,
+            "python": sys.version.split()[0],
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms, args.min_samples)
+        if regressions:
+            print("\nRegressions:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+In-process read-through cache for account and user lookups.
+
+Accounts are cached by id, account number and owner, and users by email.
+Entries are immutable result rows, evicted least-recently-used once a cache
+is full and expired after CACHE_TTL_SECONDS. Writers in this process
+invalidate what they change (postings evict every account whose balance
+moved); writes made by other processes become visible within the TTL.
+"""
+from __future__ import annotations
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import select
+from config import CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS
+from models import Account, User
+
+_MISSING = object()
+
+class TTLCache:
+    """Size-bounded LRU mapping whose entries expire ``ttl`` seconds after being set."""
+
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self._clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
+
+ACCOUNT_COLUMNS = (
+    Account.id,
+    Account.owner_id,
+    Account.account_number,
+    Account.type,
+    Account.balance,
+    Account.currency,
+)
+USER_COLUMNS = (
+    User.id,
+    User.email,
+    User.full_name,
+    User.phone,
+    User.hashed_password,
+    User.is_active,
+)
+
+accounts_by_id = TTLCache()
+account_ids_by_number = TTLCache()
+account_ids_by_owner = TTLCache()
+users_by_email = TTLCache()
+
+def _remember(rows):
+    for row in rows:
+        accounts_by_id.set(row.id, row)
+        account_ids_by_number.set(row.account_number, row.id)
+    return rows
+
+def get_account(session, account_id):
+    """Return the account row for ``account_id``, or None."""
+    row = accounts_by_id.get(account_id)
+    if row is None:
+        row = session.execute(select(*ACCOUNT_COLUMNS).where(Account.id == account_id)).first()
+        if row is not None:
+            _remember([row])
+    return row
+
+def get_account_id(session, account_number):
+    """Resolve an account number to its id, or None. Numbers are never reassigned."""
+    account_id = account_ids_by_number.get(account_number)
+    if account_id is None:
+        account_id = session.execute(select(Account.id).where(Account.account_number == account_number)).scalar()
+        if account_id is not None:
+            account_ids_by_number.set(account_number, account_id)
+    return account_id
+
+def get_account_by_number(session, account_number):
+    """Return the account row for ``account_number``, or None."""
+    account_id = account_ids_by_number.get(account_number)
+    row = accounts_by_id.get(account_id) if account_id is not None else None
+    if row is None:
+        row = session.execute(select(*ACCOUNT_COLUMNS).where(Account.account_number == account_number)).first()
+        if row is not None:
+            _remember([row])
+    return row
+
+def get_accounts_for_owner(session, owner_id) -> list:
+    """Return a user's account rows, loading any that are not cached in one query."""
+    ids = account_ids_by_owner.get(owner_id)
+    if ids is None:
+        rows = session.execute(
+            select(*ACCOUNT_COLUMNS).where(Account.owner_id == owner_id).order_by(Account.created_at, Account.account_number)
+        ).all()
+        _remember(rows)
+        account_ids_by_owner.set(owner_id, tuple(row.id for row in rows))
+        return rows
+
+    cached = {account_id: accounts_by_id.get(account_id) for account_id in ids}
+    missing = [account_id for account_id, row in cached.items() if row is None]
+    if missing:
+        for row in _remember(session.execute(select(*ACCOUNT_COLUMNS).where(Account.id.in_(missing))).all()):
+            cached[row.id] = row
+    return [cached[account_id] for account_id in ids if cached[account_id] is not None]
+
+def get_user_by_email(session, email):
+    """Return the user row for ``email``, or None. Unknown emails are not cached."""
+    row = users_by_email.get(email)
+    if row is None:
+        row = session.execute(select(*USER_COLUMNS).where(User.email == email)).first()
+        if row is not None:
+            users_by_email.set(email, row)
+    return row
+
+def invalidate_accounts(account_ids):
+    """Forget cached rows for accounts whose balance or details changed."""
+    for account_id in account_ids:
+        accounts_by_id.pop(account_id)
+
+def invalidate_owner(owner_id):
+    """Forget a user's account list, e.g. after they open an account."""
+    account_ids_by_owner.pop(owner_id)
+
+def invalidate_user(email):
+    users_by_email.pop(email)
+
+def clear():
+    for c in (accounts_by_id, account_ids_by_number, account_ids_by_owner, users_by_email):
+        c.clear()
+
+def stats() -> dict:
+    """Hit/miss counters and sizes for each cache."""
+    return {
+        "accounts_by_id": accounts_by_id.stats(),
+        "account_ids_by_number": account_ids_by_number.stats(),
+        "account_ids_by_owner": account_ids_by_owner.stats(),
+        "users_by_email": users_by_email.stats(),
+    }
@@ -0,0 +1,255 @@
+"""
+Non-interactive banking operations for scripts and batch jobs.
+
+Every operation takes a session and a dict of parameters and returns a
+JSON-serialisable dict, so the single-shot subcommands in app.py and the
+newline-delimited JSON ``batch`` mode share one implementation. Accounts are
+addressed by account number.
+"""
+from __future__ import annotations
+import json
+from datetime import date, datetime
+import cache
+import postings
+import recipients
+from config import DASHBOARD_PREVIEW_SIZE
+from history import fetch_page
+from models import Account
+
+class CommandError(ValueError):
+    pass
+
+def _optional(params, key, default=None):
+    """A string or number parameter, or ``default`` when it is absent or empty."""
+    value = params.get(key)
+    if value in (None, ""):
+        return default
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise CommandError(f"'{key}' must be a string or a number.")
+    return value
+
+def _required(params, key):
+    value = _optional(params, key)
+    if value is None:
+        raise CommandError(f"Missing '{key}'.")
+    return value
+
+def _int(params, key, default):
+    value = _optional(params, key)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise CommandError(f"'{key}' must be a whole number.")
+    if number < 0 or number != float(value):
+        raise CommandError(f"'{key}' must be a whole number.")
+    return number
+
+def _cursor(params, key):
+    """A keyset cursor as returned in ``next_cursor``: a two-item list, or None."""
+    value = params.get(key)
+    if value in (None, ""):
+        return None
+    if (not isinstance(value, (list, tuple)) or len(value) != 2
+            or not all(isinstance(v, (str, int)) and not isinstance(v, bool) for v in value)):
+        raise CommandError(f"'{key}' must be a cursor as returned in next_cursor.")
+    return tuple(value)
+
+def _account_id(session, number):
+    account_id = cache.get_account_id(session, str(number))
+    if not account_id:
+        raise postings.AccountNotFoundError(f"Account {number} not found.")
+    return account_id
+
+def deposit(session, params):
+    account_id = _account_id(session, _required(params, "account"))
+    result = postings.deposit(session, account_id, _required(params, "amount"), reference=str(_optional(params, "reference", "deposit")),
+                              idempotency_key=_optional(params, "idempotency_key"))
+    return {"transaction_ids": result.transaction_ids, "balance": result.balances[account_id]}
+
+def withdraw(session, params):
+    account_id = _account_id(session, _required(params, "account"))
+    result = postings.withdraw(session, account_id, _required(params, "amount"), reference=str(_optional(params, "reference", "withdraw")),
+                               idempotency_key=_optional(params, "idempotency_key"))
+    return {"transaction_ids": result.transaction_ids, "balance": result.balances[account_id]}
+
+def transfer(session, params):
+    from_id = _account_id(session, _required(params, "from"))
+    to_id = recipients.resolve(session, _required(params, "to")).account_id
+    result = postings.transfer(session, from_id, to_id, _required(params, "amount"), idempotency_key=_optional(params, "idempotency_key"))
+    return {
+        "transaction_ids": result.transaction_ids,
+        "from_balance": result.balances[from_id],
+        "to_balance": result.balances[to_id],
+    }
+
+def balance(session, params):
+    number = _required(params, "account")
+    row = session.query(Account.balance, Account.currency).filter_by(account_number=str(number)).first()
+    if row is None:
+        raise postings.AccountNotFoundError(f"Account {number} not found.")
+    return {"account": number, "balance": row.balance, "currency": row.currency}
+
+def history(session, params):
+    account_id = _account_id(session, _required(params, "account"))
+    page = fetch_page(session, account_id, page_size=_int(params, "limit", 20) or 20, after=_cursor(params, "after"))
+    return {
+        "transactions": [
+            {"id": t.id, "created_at": t.created_at, "type": t.type.value, "amount": t.amount, "reference": t.reference}
+            for t in page.rows
+        ],
+        "next_cursor": list(page.next_cursor) if page.has_next else None,
+    }
+
+def parse_when(value):
+    """Parse YYYY-MM-DD as a date and anything longer as an ISO datetime."""
+    value = str(value)
+    try:
+        return date.fromisoformat(value) if len(value) == 10 else datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date {value!r}; use YYYY-MM-DD or an ISO datetime.")
+
+def balance_at(session, params):
+    from snapshots import balance_at as snapshot_balance_at
+
+    number = _required(params, "account")
+    at = str(_required(params, "at"))
+    return {"account": number, "at": at, "balance": snapshot_balance_at(session, _account_id(session, number), parse_when(at))}
+
+def audit_log(session, params):
+    import audit
+
+    entity, entity_id = _optional(params, "entity"), _optional(params, "entity_id")
+    account = _optional(params, "account")
+    if account is not None:
+        entity, entity_id = "Account", _account_id(session, account)
+    limit = _int(params, "limit", 50) or 50
+    since, until = _optional(params, "since"), _optional(params, "until")
+    rows = audit.query(
+        session,
+        entity=entity,
+        entity_id=entity_id,
+        action=_optional(params, "action"),
+        since=parse_when(since) if since is not None else None,
+        until=parse_when(until) if until is not None else None,
+        limit=limit,
+        after=_cursor(params, "after"),
+    )
+    return {
+        "events": [
+            {
+                "id": r.id,
+                "created_at": r.created_at,
+                "entity": r.entity,
+                "entity_id": r.entity_id,
+                "action": r.action,
+                "payload": json.loads(r.payload) if r.payload else None,
+            }
+            for r in rows
+        ],
+        "next_cursor": list(audit.row_key(rows[-1])) if len(rows) == limit else None,
+    }
+
+def dashboard(session, params):
+    from dashboard import overview
+
+    email = _required(params, "email")
+    preview = _int(params, "preview", DASHBOARD_PREVIEW_SIZE)
+    user = cache.get_user_by_email(session, str(email))
+    board = overview(session, user.id, preview=preview) if user else None
+    if board is None:
+        raise CommandError(f"User {email} not found.")
+    return {
+        "user": {"email": board.user.email, "full_name": board.user.full_name},
+        "totals": board.totals,
+        "accounts": [
+            {
+                "account": item.account.account_number,
+                "type": item.account.type.value,
+                "balance": item.account.balance,
+                "currency": item.account.currency,
+                "recent": [
+                    {"id": t.id, "created_at": t.created_at, "type": t.type.value, "amount": t.amount, "reference": t.reference}
+                    for t in item.recent
+                ],
+            }
+            for item in board.accounts
+        ],
+        "cards": [
+            {"card": c.card_mask, "expiry": f"{c.expiry_month:02d}/{c.expiry_year}", "active": c.is_active}
+            for c in board.cards
+        ],
+        "beneficiaries": [
+            {"name": b.name, "account": b.account_number, "bank_name": b.bank_name}
+            for b in board.beneficiaries
+        ],
+    }
+
+def cache_stats(session, params):
+    return {"cache": cache.stats(), "recipients": recipients.stats()}
+
+OPERATIONS = {
+    "deposit": deposit,
+    "withdraw": withdraw,
+    "transfer": transfer,
+    "balance": balance,
+    "history": history,
+    "balance_at": balance_at,
+    "audit": audit_log,
+    "dashboard": dashboard,
+    "cache_stats": cache_stats,
+}
+
+# Operations that never write, and so can run on a read replica
+READ_OPERATIONS = frozenset({"balance", "history", "balance_at", "audit", "dashboard", "cache_stats"})
+
+def execute(session, params: dict) -> dict:
+    """Run one operation and return its result, or an error, as a dict."""
+    op = params.get("op")
+    handler = OPERATIONS.get(op) if isinstance(op, str) else None
+    response = {"op": op}
+    if "id" in params:
+        response["id"] = params["id"]
+    if handler is None:
+        response.update(ok=False, error=f"Unknown operation {op!r}.")
+        return response
+    try:
+        response.update(ok=True, **handler(session, params))
+    except (postings.PostingError, CommandError, ValueError) as e:
+        session.rollback()
+        response.update(ok=False, error=str(e))
+    except Exception as e:
+        # Anything else (a lock timeout, say) fails this command only, not the rest of a batch
+        session.rollback()
+        message = str(e).splitlines()[0] if str(e) else ""
+        response.update(ok=False, error=f"{type(e).__name__}: {message}".rstrip(": "))
+    return response
+
+def to_json(response: dict) -> str:
+    return json.dumps(response, default=str)
+
+def run_batch(session, lines, out) -> int:
+    """
+    Execute newline-delimited JSON commands from ``lines`` on one session,
+    writing one JSON result per command to ``out``. Returns the number of
+    commands that failed.
+    """
+    failures = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            params = json.loads(line)
+            if not isinstance(params, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            response = {"op": None, "ok": False, "error": f"Invalid command: {e}"}
+        else:
+            response = execute(session, params)
+        if not response["ok"]:
+            failures += 1
+        out.write(to_json(response) + "\n")
+        out.flush()
+    return failures
@@ -9,14 +9,108 @@ BASE_DIR = Path(__file__).resolve().parent
 
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+pysqlite:///./bank.db")
+# Read replicas for balance/history/report queries, comma-separated (default: none, reads use DATABASE_URL)
+DATABASE_READ_URLS = [url.strip() for url in os.getenv("DATABASE_READ_URLS", "").split(",") if url.strip()]
+# After a user's own posting, their reads stay on the primary this long, until replicas have caught up
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
 
 # Application settings
 APP_NAME = os.getenv("APP_NAME", "CLI Bank")
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 
-# Security settings (for future implementation)
+# Security settings
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key-change-in-production")
-PASSWORD_SALT = os.getenv("PASSWORD_SALT", "dev-salt-change-in-production")
+PASSWORD_SALT = os.getenv("PASSWORD_SALT", "dev-salt-change-in-production")  # Pepper mixed into every password hash
+
+# Password hashing ("scrypt" or "pbkdf2_sha256"); hashes made with other settings are upgraded on login
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "scrypt")
+SCRYPT_N = int(os.getenv("SCRYPT_N", str(2**14)))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+PBKDF2_ITERATIONS = int(os.getenv("PBKDF2_ITERATIONS", "600000"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_VERIFY_CACHE_TTL = float(os.getenv("PASSWORD_VERIFY_CACHE_TTL", "60"))  # 0 disables
 
 # Database settings
-DB_ECHO = DEBUG  # Echo SQL queries in debug mode
+DB_ECHO = os.getenv("DB_ECHO", str(DEBUG)).lower() == "true"  # Echo SQL queries (off unless debugging)
+
+# Connection pool (server databases such as PostgreSQL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "True").lower() == "true"
+
+# SQLite pragmas applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Transaction history settings
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
+# Bulk posting settings
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "5000"))
+
+# Lookup cache settings (accounts and users)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+
+# Balance snapshot job settings
+SNAPSHOT_CHUNK_SIZE = int(os.getenv("SNAPSHOT_CHUNK_SIZE", "1000"))
+
+# Async service settings
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", "100"))
+
+# Ledger verification settings (accounts per query; two bound parameters each)
+LEDGER_VERIFY_CHUNK_SIZE = int(os.getenv("LEDGER_VERIFY_CHUNK_SIZE", "400"))
+# Entry ids below the last checkpoint checked again on each run (not SQLite), for entries that committed late
+LEDGER_VERIFY_MARGIN = int(os.getenv("LEDGER_VERIFY_MARGIN", "10000"))
+
+# Audit log settings (events are queued and written in batches by a background thread)
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "True").lower() == "true"
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))  # Seconds
+AUDIT_ENQUEUE_TIMEOUT = float(os.getenv("AUDIT_ENQUEUE_TIMEOUT", "0.5"))  # Seconds to wait on a full queue
+
+# Idempotency keys (retried postings with the same key return the first result)
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", str(24 * 3600)))  # Seconds kept before prune() may delete a key
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_CACHE_TTL = float(os.getenv("IDEMPOTENCY_CACHE_TTL", "300"))
+
+# Transaction export settings
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "10000"))  # Rows fetched and written at a time
+EXPORT_BUFFER_BYTES = int(os.getenv("EXPORT_BUFFER_BYTES", str(1024 * 1024)))
+
+# Recipient index (seconds between incremental refreshes triggered by unknown account numbers)
+RECIPIENT_REFRESH_INTERVAL = float(os.getenv("RECIPIENT_REFRESH_INTERVAL", "5"))
+
+# Instrumentation (operation latency and SQL statement stats; see metrics.py)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() == "true"
+METRICS_FILE = os.getenv("METRICS_FILE", "")  # Totals shared by every process; empty keeps them in memory
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", "")  # Rewritten with METRICS_FILE; empty to skip
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "60"))  # Seconds between merges into METRICS_FILE
+METRICS_REPEAT_THRESHOLD = int(os.getenv("METRICS_REPEAT_THRESHOLD", "3"))  # Same statement this often in one call: likely N+1
+
+# Transaction archive (see archive.py): transactions older than ARCHIVE_AFTER_DAYS move to per-month partitions
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")  # SQLite: one transactions_YYYY_MM.db file per month
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", "500"))  # Accounts moved per transaction
+ARCHIVE_MAX_ATTACHED = int(os.getenv("ARCHIVE_MAX_ATTACHED", "8"))  # SQLite allows 10 attached databases by default
+
+# Month-end jobs (python app.py run-job interest|fees)
+INTEREST_RATE = os.getenv("INTEREST_RATE", "0.04")  # Annual rate on savings balances, paid monthly
+MONTHLY_FEE = os.getenv("MONTHLY_FEE", "100.00")  # Maintenance fee on checking accounts
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "5000"))  # Accounts posted per transaction
+
+# Velocity limits on withdrawals and outgoing transfers, as window=count/amount
+# (either side may be left empty; an empty setting means no limit). Off by default.
+LIMITS_ENABLED = os.getenv("LIMITS_ENABLED", "False").lower() == "true"
+ACCOUNT_LIMITS = os.getenv("ACCOUNT_LIMITS", "minute=5/200000,hour=20/500000,day=50/1000000")
+USER_LIMITS = os.getenv("USER_LIMITS", "minute=10/300000,hour=40/1000000,day=100/2000000")
+LIMITS_STORE = os.getenv("LIMITS_STORE", "")  # A SQLite file shared by every process; empty for per-process memory only
+
+# Dashboard
+DASHBOARD_PREVIEW_SIZE = int(os.getenv("DASHBOARD_PREVIEW_SIZE", "5"))  # Latest transactions shown per account
@@ -0,0 +1,85 @@
+"""
+A user's overview: accounts with balances, cards, beneficiaries and each
+account's latest transactions.
+
+overview() costs the same handful of queries however many accounts and
+cards a user has: the user, then their accounts, cards and beneficiaries
+with selectinload (one IN query per relationship), then the latest
+transactions of every account at once, numbered per account with
+ROW_NUMBER() OVER (PARTITION BY account_id ...) and cut at ``preview``.
+
+Preview rows have history.fetch_page()'s columns, so the last one's
+row_key() is the cursor for the rest of that account's history. They come
+from the live table only, which the archive keeps to recent activity.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from sqlalchemy import String, func, select, type_coerce
+from sqlalchemy.orm import selectinload
+import archive
+from config import DASHBOARD_PREVIEW_SIZE
+from history import HISTORY_COLUMNS
+from models import User
+
+@dataclass
+class AccountOverview:
+    account: object
+    recent: list = field(default_factory=list)  # newest first, as history rows
+
+@dataclass
+class Dashboard:
+    user: object
+    accounts: list = field(default_factory=list)
+    cards: list = field(default_factory=list)
+    beneficiaries: list = field(default_factory=list)
+
+    @property
+    def totals(self) -> dict:
+        """Total balance per currency."""
+        totals = {}
+        for item in self.accounts:
+            totals[item.account.currency] = totals.get(item.account.currency, 0) + item.account.balance
+        return totals
+
+def recent_transactions(session, account_ids, preview=DASHBOARD_PREVIEW_SIZE) -> dict:
+    """{account_id: up to ``preview`` latest transactions, newest first}, in one query."""
+    found = {account_id: [] for account_id in account_ids}
+    if not found or preview <= 0:
+        return found
+    table = archive.LIVE
+    ranked = (
+        select(
+            table.c.account_id,
+            *HISTORY_COLUMNS,
+            func.row_number().over(
+                partition_by=table.c.account_id,
+                order_by=(type_coerce(table.c.created_at, String).desc(), table.c.id.desc()),
+            ).label("position"),
+        )
+        .where(table.c.account_id.in_(list(found)))
+        .subquery()
+    )
+    rows = session.execute(
+        select(ranked).where(ranked.c.position <= preview).order_by(ranked.c.account_id, ranked.c.position)
+    )
+    for row in rows:
+        found[row.account_id].append(row)
+    return found
+
+def overview(session, user_id, preview=DASHBOARD_PREVIEW_SIZE) -> Dashboard | None:
+    """The dashboard of ``user_id``, or None if there is no such user."""
+    user = session.scalars(
+        select(User)
+        .where(User.id == user_id)
+        .options(selectinload(User.accounts), selectinload(User.cards), selectinload(User.beneficiaries))
+    ).one_or_none()
+    if user is None:
+        return None
+    accounts = sorted(user.accounts, key=lambda a: (a.created_at, a.account_number))
+    recent = recent_transactions(session, [a.id for a in accounts], preview)
+    return Dashboard(
+        user=user,
+        accounts=[AccountOverview(a, recent[a.id]) for a in accounts],
+        cards=sorted(user.cards, key=lambda c: (not c.is_active, c.expiry_year, c.expiry_month)),
+        beneficiaries=sorted(user.beneficiaries, key=lambda b: (b.name.lower(), b.account_number)),
+    )
@@ -0,0 +1,194 @@
+"""
+Engine and session factories.
+
+The engine is built from the settings in config.py. Creating it does not
+connect to the database, and nothing here touches the schema: tables are
+created explicitly with ``python app.py init-db``.
+
+Writes always go through Session, on the primary engine. Pure reads can
+use read_session() instead, which hands out read-only sessions on the
+replicas listed in DATABASE_READ_URLS, in turn. After note_write(key), reads
+for that key (a user id, say) stay on the primary for
+READ_YOUR_WRITES_SECONDS, so users see their own postings straight away
+even while the replicas catch up. With no replicas configured, reads use
+the primary.
+"""
+from __future__ import annotations
+import itertools
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import sessionmaker
+import config
+import metrics
+
+class ReadOnlySessionError(RuntimeError):
+    """A read session was asked to write."""
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+    finally:
+        cursor.close()
+
+def _read_only_listener(backend):
+    statement = "PRAGMA query_only=ON" if backend == "sqlite" else "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY"
+
+    def set_read_only(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+    return set_read_only
+
+def _engine_options(url, echo, kwargs):
+    options = {"echo": config.DB_ECHO if echo is None else echo}
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=config.DB_POOL_PRE_PING,
+        )
+    options.update(kwargs)
+    return options
+
+def build_engine(url=None, echo=None, read_only=False, **kwargs) -> Engine:
+    """
+    Create an engine for ``url`` (default: config.DATABASE_URL).
+
+    SQLite connections get the WAL/synchronous/busy_timeout/mmap pragmas from
+    config.py; server databases get a sized connection pool with pre-ping.
+    With ``read_only`` the database itself refuses writes on its connections
+    (PRAGMA query_only, or READ ONLY transactions on PostgreSQL). Statements
+    are timed by metrics.py unless METRICS_ENABLED is off.
+    Extra keyword arguments are passed straight to create_engine().
+    """
+    url = make_url(url or config.DATABASE_URL)
+    engine = create_engine(url, **_engine_options(url, echo, kwargs))
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    if read_only:
+        event.listen(engine, "connect", _read_only_listener(url.get_backend_name()))
+    metrics.instrument_engine(engine)
+    return engine
+
+# Async drivers used in place of the configured sync driver
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def async_url(url=None):
+    """Return ``url`` (default: config.DATABASE_URL) with its async driver."""
+    url = make_url(url or config.DATABASE_URL)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend!r} databases.")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+def build_async_engine(url=None, echo=None, **kwargs):
+    """Async counterpart of build_engine(), with the same pool and pragma settings."""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = async_url(url)
+    engine = create_async_engine(url, **_engine_options(url, echo, kwargs))
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+    metrics.instrument_engine(engine.sync_engine)
+    return engine
+
+engine = build_engine()
+Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+read_engines = [build_engine(url, read_only=True) for url in config.DATABASE_READ_URLS]
+_replicas = itertools.cycle(read_engines)
+_replicas_lock = threading.Lock()
+ReadSession = sessionmaker(autoflush=False, autocommit=False)
+
+@event.listens_for(ReadSession, "do_orm_execute")
+def _refuse_writes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        raise ReadOnlySessionError("This session is read-only; use database.Session to write.")
+
+@event.listens_for(ReadSession, "before_flush")
+def _refuse_flush(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        raise ReadOnlySessionError("This session is read-only; use database.Session to write.")
+
+# key -> time.monotonic() until which that key's reads stay on the primary
+_sticky = {}
+
+def note_write(key):
+    """Route reads for ``key`` to the primary for the next READ_YOUR_WRITES_SECONDS."""
+    if read_engines and key is not None:
+        now = time.monotonic()
+        if len(_sticky) > 10_000:
+            for stale in [k for k, until in list(_sticky.items()) if until <= now]:
+                _sticky.pop(stale, None)
+        _sticky[key] = now + config.READ_YOUR_WRITES_SECONDS
+
+def read_engine(key=None) -> Engine:
+    """The engine reads for ``key`` should use: the primary if ``key`` wrote recently, else the next replica."""
+    if not read_engines or _sticky.get(key, 0) > time.monotonic():
+        return engine
+    with _replicas_lock:
+        return next(_replicas)
+
+def read_session(key=None):
+    """A read-only session for ``key`` (see read_engine())."""
+    return ReadSession(bind=read_engine(key))
+
+def configure(url=None, read_urls=None, **kwargs) -> Engine:
+    """Point the shared engine and Session (and, given ``read_urls``, the read replicas) at other databases."""
+    global engine, read_engines, _replicas
+    engine.dispose()
+    engine = build_engine(url, **kwargs)
+    Session.configure(bind=engine)
+    if read_urls is not None:
+        for replica in read_engines:
+            replica.dispose()
+        read_engines = [build_engine(read_url, read_only=True, **kwargs) for read_url in read_urls]
+        _replicas = itertools.cycle(read_engines)
+        _sticky.clear()
+    return engine
+
+def copy_sqlite(path, bind=None):
+    """
+    Copy the primary SQLite database to ``path`` with SQLite's online backup
+    (WAL contents included), e.g. to serve as a local read replica.
+    """
+    import sqlite3
+
+    bind = bind or engine
+    if bind.dialect.name != "sqlite":
+        raise ValueError("Only SQLite databases can be copied this way.")
+    with bind.connect() as conn:
+        target = sqlite3.connect(path)
+        try:
+            conn.connection.driver_connection.backup(target)
+        finally:
+            target.close()
+
+def init_db(bind=None):
+    """Create any missing tables and indexes, and drop constraints the models no longer declare."""
+    from models import Base
+    bind = bind or engine
+    Base.metadata.create_all(bind)
+    # create_all() only builds indexes along with new tables
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        if conn.dialect.name == "postgresql":
+            # Databases created before transactions could be archived still enforce this one
+            conn.exec_driver_sql(
+                "ALTER TABLE journal_entries DROP CONSTRAINT IF EXISTS journal_entries_transaction_id_fkey"
+            )
@@ -0,0 +1,264 @@
+"""
+Streaming exports of transactions: statements for one account or full dumps.
+
+Rows are read as plain Core columns with ``yield_per`` (a server-side
+cursor on PostgreSQL), one chunk of EXPORT_CHUNK_SIZE rows at a time, and
+each chunk is written to the output in one call, so memory stays flat no
+matter how many rows are exported. Rows come in (account, created_at, id)
+order along ix_transactions_account_created_id. Archived months that can
+hold rows in the requested range are read first, oldest first and each in
+that order, then the live table; a statement for one account is therefore
+in time order from start to end.
+
+Formats:
+
+csv       header row, then id,account,created_at,type,amount,reference
+jsonl     one JSON object per line with the same fields
+columnar  a compact binary file, one block of columns per chunk (below)
+
+The columnar format is built from the standard library's struct and array
+modules, all little-endian:
+
+    b"BANKCOL1"  u32 header length  header (JSON: columns and type names)
+    blocks:      u32 row count, then per column u32 byte length + data
+    end:         u32 0
+
+created_at is int64 microseconds since 1970-01-01 (UTC), amount is int64
+cents and type is a uint8 index into the header's type names. String
+columns (id, account, reference) are rows + 1 uint32 offsets followed by
+the UTF-8 bytes; a missing reference is stored as an empty string.
+read_columnar() reads such a file back one block at a time.
+"""
+from __future__ import annotations
+import csv
+import itertools
+import json
+import struct
+import sys
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from sqlalchemy import String, cast, select, type_coerce
+from config import EXPORT_BUFFER_BYTES, EXPORT_CHUNK_SIZE
+import archive
+from models import Account, TransactionType
+
+FORMATS = ("csv", "jsonl", "columnar")
+FIELDS = ("id", "account", "created_at", "type", "amount", "reference")
+
+MAGIC = b"BANKCOL1"
+COLUMNS = (
+    ("id", "str"),
+    ("account", "str"),
+    ("created_at", "i64"),
+    ("type", "u8"),
+    ("amount", "i64"),
+    ("reference", "str"),
+)
+TYPE_NAMES = [t.value for t in TransactionType]
+_U32 = struct.Struct("<I")
+_ARRAY_CODES = {"i64": "q", "u8": "B"}
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_SWAP = sys.byteorder == "big"
+
+# Keyed by the stored name, and by value for a database that stores those
+_TYPE_VALUES = {key: t.value for t in TransactionType for key in (t.name, t.value)}
+_TYPE_CODES = {key: i for i, t in enumerate(TransactionType) for key in (t.name, t.value)}
+
+def _columns(table):
+    # Text from the database, without UUID/DateTime/Enum processing: ids as 32
+    # hex digits (SQLite) or dashed (PostgreSQL), created_at as 'YYYY-MM-DD
+    # HH:MM:SS[.ffffff]' and type as the enum's name. CAST, not type_coerce, so
+    # a driver that decodes uuid and timestamp columns hands back strings too.
+    return (
+        cast(table.c.id, String).label("id"),
+        Account.account_number,
+        cast(table.c.created_at, String).label("created_at"),
+        cast(table.c.type, String).label("type"),
+        table.c.amount,
+        table.c.reference,
+    )
+
+EXPORT_COLUMNS = _columns(archive.LIVE)
+
+def detect_format(path) -> str:
+    suffix = Path(path).suffix.lower()
+    if suffix in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    if suffix in (".col", ".bin"):
+        return "columnar"
+    return "csv"
+
+def _dashed(text) -> str:
+    """Stored id in its canonical 8-4-4-4-12 form, far cheaper than uuid.UUID()."""
+    if not isinstance(text, str) or len(text) != 32:
+        return str(text)  # already dashed, or a driver's uuid.UUID
+    return f"{text[:8]}-{text[8:12]}-{text[12:16]}-{text[16:20]}-{text[20:]}"
+
+def _bound(value) -> str:
+    """A date or datetime as comparable stored text."""
+    if isinstance(value, datetime):
+        return value.isoformat(" ", "microseconds")
+    return value.isoformat()
+
+def _range(since=None, until=None):
+    """[since, until) as stored text bounds (or None); a date ``until`` includes the whole day."""
+    if until is not None and isinstance(until, date) and not isinstance(until, datetime):
+        until += timedelta(days=1)
+    return (
+        _bound(since) if since is not None else None,
+        _bound(until) if until is not None else None,
+    )
+
+def export_query(account_id=None, since=None, until=None, table=archive.LIVE):
+    """Transactions of one account (or all), created in [since, until), from ``table`` (live or an archived month)."""
+    created = type_coerce(table.c.created_at, String)
+    stmt = select(*_columns(table)).join(Account, Account.id == table.c.account_id)
+    if account_id is not None:
+        stmt = stmt.where(table.c.account_id == account_id)
+    since, until = _range(since, until)
+    if since is not None:
+        stmt = stmt.where(created >= since)
+    if until is not None:
+        stmt = stmt.where(created < until)
+    return stmt.order_by(table.c.account_id, created, table.c.id)
+
+def _write_csv(out, chunks) -> int:
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(FIELDS)
+    count = 0
+    for rows in chunks:
+        writer.writerows((_dashed(r[0]), r[1], r[2], _TYPE_VALUES[r[3]], r[4], r[5]) for r in rows)
+        count += len(rows)
+    return count
+
+def _write_jsonl(out, chunks) -> int:
+    dumps = json.JSONEncoder(separators=(",", ":")).encode
+    count = 0
+    for rows in chunks:
+        out.write("".join(
+            dumps({
+                "id": _dashed(r[0]), "account": r[1], "created_at": r[2], "type": _TYPE_VALUES[r[3]],
+                "amount": str(r[4]), "reference": r[5],
+            }) + "\n"
+            for r in rows
+        ))
+        count += len(rows)
+    return count
+
+def _strings(values) -> bytes:
+    encoded = [value.encode() for value in values]
+    offsets = array("I", [0])
+    total = 0
+    for item in encoded:
+        total += len(item)
+        offsets.append(total)
+    if _SWAP:
+        offsets.byteswap()
+    return offsets.tobytes() + b"".join(encoded)
+
+def _numbers(kind, values) -> bytes:
+    data = array(_ARRAY_CODES[kind], values)
+    if _SWAP:
+        data.byteswap()
+    return data.tobytes()
+
+def _micros(value) -> int:
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // _MICROSECOND
+
+def _write_columnar(out, chunks) -> int:
+    header = json.dumps({"columns": COLUMNS, "types": TYPE_NAMES}).encode()
+    out.write(MAGIC + _U32.pack(len(header)) + header)
+    count = 0
+    for rows in chunks:
+        ids, numbers, created, types, amounts, references = zip(*rows)
+        block = [
+            _strings(map(_dashed, ids)),
+            _strings(numbers),
+            _numbers("i64", map(_micros, created)),
+            _numbers("u8", map(_TYPE_CODES.__getitem__, types)),
+            _numbers("i64", (int(amount.scaleb(2)) for amount in amounts)),
+            _strings(reference or "" for reference in references),
+        ]
+        out.write(_U32.pack(len(rows)) + b"".join(_U32.pack(len(column)) + column for column in block))
+        count += len(rows)
+    out.write(_U32.pack(0))
+    return count
+
+_WRITERS = {"csv": _write_csv, "jsonl": _write_jsonl, "columnar": _write_columnar}
+
+def export_transactions(session, out, fmt="csv", account_id=None, since=None, until=None,
+                        chunk_size=EXPORT_CHUNK_SIZE) -> int:
+    """
+    Stream transactions to ``out`` (a text stream for csv/jsonl, a binary
+    stream for columnar) and return how many were written. ``since`` and
+    ``until`` are dates or datetimes; a date ``until`` includes that day.
+    """
+    if fmt not in _WRITERS:
+        raise ValueError(f"Unknown export format {fmt!r}; use one of {', '.join(FORMATS)}.")
+
+    def chunks():
+        months = archive.months_for(session, account_id, *_range(since, until))
+        for table in itertools.chain((archive.partition(session, month) for month in months), [archive.LIVE]):
+            # Core rows straight from the cursor; no ORM result processing
+            result = session.connection().execute(
+                export_query(account_id, since, until, table).execution_options(yield_per=chunk_size)
+            )
+            with result:
+                yield from result.partitions()
+
+    return _WRITERS[fmt](out, chunks())
+
+def export_to_path(session, path, fmt=None, **filters) -> int:
+    """export_transactions() into ``path`` through an EXPORT_BUFFER_BYTES buffer."""
+    fmt = fmt or detect_format(path)
+    if fmt == "columnar":
+        with open(path, "wb", buffering=EXPORT_BUFFER_BYTES) as out:
+            return export_transactions(session, out, fmt, **filters)
+    with open(path, "w", newline="", encoding="utf-8", buffering=EXPORT_BUFFER_BYTES) as out:
+        return export_transactions(session, out, fmt, **filters)
+
+def _read_exact(f, size) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated columnar export.")
+    return data
+
+def _decode(kind, data, rows):
+    if kind == "str":
+        offsets = array("I")
+        offsets.frombytes(data[:(rows + 1) * 4])
+        if _SWAP:
+            offsets.byteswap()
+        blob = data[(rows + 1) * 4:]
+        return [blob[offsets[i]:offsets[i + 1]].decode() for i in range(rows)]
+    values = array(_ARRAY_CODES[kind])
+    values.frombytes(data)
+    if _SWAP:
+        values.byteswap()
+    return values
+
+def read_columnar(f):
+    """
+    Yield the blocks of a columnar export from the binary stream ``f`` as
+    {column: values} dicts: lists of str, or arrays of int (created_at in
+    microseconds, amount in cents, type as an index into TYPE_NAMES).
+    """
+    if _read_exact(f, len(MAGIC)) != MAGIC:
+        raise ValueError("Not a columnar export.")
+    (size,) = _U32.unpack(_read_exact(f, 4))
+    columns = json.loads(_read_exact(f, size))["columns"]
+    while True:
+        (rows,) = _U32.unpack(_read_exact(f, 4))
+        if rows == 0:
+            return
+        block = {}
+        for name, kind in columns:
+            (size,) = _U32.unpack(_read_exact(f, 4))
+            block[name] = _decode(kind, _read_exact(f, size), rows)
+        yield block
@@ -0,0 +1,113 @@
+"""
+Keyset-paginated access to an account's transaction history.
+
+Pages are addressed by the (created_at, id) of their boundary rows rather than
+by OFFSET, so every page is a bounded range scan of the
+ix_transactions_account_created_id index no matter how deep it is.
+
+Transactions moved to the archive (archive.py) are older than everything
+left in the live table, so a page that runs out of live rows continues
+into the account's archived months, newest first, with the same cursor.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from sqlalchemy import String, and_, or_, select, type_coerce
+import archive
+
+def _columns(table):
+    # Raw stored value of created_at. SQLite keeps timestamps as text and rows
+    # written by CURRENT_TIMESTAMP have no microseconds, so a cursor re-bound
+    # through DateTime would no longer compare equal to the row it came from.
+    created_key = type_coerce(table.c.created_at, String)
+    return created_key, (
+        table.c.id,
+        table.c.created_at,
+        table.c.type,
+        table.c.amount,
+        table.c.reference,
+        created_key.label("created_key"),
+    )
+
+HISTORY_COLUMNS = _columns(archive.LIVE)[1]
+
+@dataclass
+class HistoryPage:
+    """One page of history, newest first, plus the cursors around it."""
+    rows: list = field(default_factory=list)
+    has_next: bool = False
+    has_previous: bool = False
+
+    @property
+    def next_cursor(self):
+        """Cursor for the page of older transactions."""
+        return row_key(self.rows[-1]) if self.rows else None
+
+    @property
+    def previous_cursor(self):
+        """Cursor for the page of newer transactions."""
+        return row_key(self.rows[0]) if self.rows else None
+
+def row_key(row):
+    """Return the keyset cursor (created_at, id) of a history row."""
+    return (row.created_key, row.id)
+
+def _query(table, account_id, after=None, before=None):
+    created_key, columns = _columns(table)
+    stmt = select(*columns).where(table.c.account_id == account_id)
+    if before is not None:
+        created, txn_id = before
+        stmt = stmt.where(or_(created_key > created, and_(created_key == created, table.c.id > txn_id)))
+        return stmt.order_by(created_key.asc(), table.c.id.asc())
+    if after is not None:
+        created, txn_id = after
+        stmt = stmt.where(or_(created_key < created, and_(created_key == created, table.c.id < txn_id)))
+    return stmt.order_by(created_key.desc(), table.c.id.desc())
+
+def _tables(session, account_id, after=None, before=None):
+    """The tables a page is read from, in page order; the archive is only looked up once reached."""
+    if before is None:
+        yield archive.LIVE
+    months = archive.account_months(session, account_id)
+    if before is not None:
+        # Newer rows, oldest first: archived months from the cursor's on, then the live table
+        cursor = archive.as_datetime(before[0])
+        for month, first, last in months:
+            if last >= cursor:
+                yield archive.partition(session, month)
+        yield archive.LIVE
+    else:
+        cursor = archive.as_datetime(after[0]) if after is not None else None
+        for month, first, last in reversed(months):
+            if cursor is None or first <= cursor:
+                yield archive.partition(session, month)
+
+def fetch_page(session, account_id, page_size=20, after=None, before=None):
+    """
+    Fetch one page of an account's history.
+
+    Pass ``after`` (a page's next_cursor) to move to older transactions or
+    ``before`` (a page's previous_cursor) to move back to newer ones.
+    """
+    want = page_size + 1
+    rows = []
+    for table in _tables(session, account_id, after, before):
+        rows += session.execute(_query(table, account_id, after, before).limit(want - len(rows))).all()
+        if len(rows) >= want:
+            break
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if before is not None:
+        rows.reverse()
+        return HistoryPage(rows=rows, has_next=True, has_previous=more)
+    return HistoryPage(rows=rows, has_next=more, has_previous=after is not None)
+
+def iter_history(session, account_id, page_size=500):
+    """Yield an account's transactions newest first, one page in memory at a time."""
+    cursor = None
+    while True:
+        page = fetch_page(session, account_id, page_size=page_size, after=cursor)
+        yield from page.rows
+        if not page.has_next:
+            return
+        cursor = page.next_cursor
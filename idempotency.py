@@ -0,0 +1,95 @@
+"""
+Idempotency keys for postings.
+
+A client that may retry a deposit, withdrawal or transfer sends the same
+key with every attempt. The first attempt stores the key, a fingerprint of
+the request and its PostingResult in idempotency_keys, inside the posting's
+own transaction, so the key exists exactly when the posting does. Later
+attempts get the stored result back instead of posting again, and a key
+reused for a different request is refused (see postings.py).
+
+Keys used recently in this process are also cached, so a retry that lands
+on the same process is answered without a database round-trip. Keys are
+kept for at least IDEMPOTENCY_KEY_TTL seconds; prune() deletes older ones.
+"""
+from __future__ import annotations
+import hashlib
+import json
+from datetime import timedelta
+from decimal import Decimal
+from sqlalchemy import delete, insert, select
+from cache import TTLCache
+from config import IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_CACHE_TTL, IDEMPOTENCY_KEY_TTL
+from models import IdempotencyKey, now_utc
+
+PRUNE_CHUNK_SIZE = 5000
+
+# key -> (request_hash, PostingResult) for keys whose posting has committed
+recent = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_CACHE_TTL)
+
+def fingerprint(operation, arguments: dict) -> str:
+    """sha256 of an operation name and its (JSON-serialisable) arguments."""
+    text = json.dumps([operation, arguments], default=str, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _dump(result) -> str:
+    return json.dumps({
+        "transaction_ids": result.transaction_ids,
+        "balances": {account_id: str(balance) for account_id, balance in result.balances.items()},
+        "journal_id": result.journal_id,
+    })
+
+def _load(text):
+    from postings import PostingResult
+
+    data = json.loads(text)
+    return PostingResult(
+        transaction_ids=data["transaction_ids"],
+        balances={account_id: Decimal(balance) for account_id, balance in data["balances"].items()},
+        journal_id=data["journal_id"],
+    )
+
+def cached(key):
+    """(request_hash, PostingResult) for a key committed in this process recently, or None."""
+    return recent.get(key)
+
+def lookup(session, key):
+    """(request_hash, PostingResult) for a stored key, or None."""
+    row = session.execute(
+        select(IdempotencyKey.request_hash, IdempotencyKey.result).where(IdempotencyKey.key == key)
+    ).first()
+    if row is None:
+        return None
+    found = (row.request_hash, _load(row.result))
+    recent.set(key, found)
+    return found
+
+def save(session, key, operation, request_hash, result):
+    """Store ``key`` in the session's current transaction; a duplicate raises IntegrityError."""
+    session.execute(insert(IdempotencyKey.__table__).values(
+        key=key,
+        operation=operation,
+        request_hash=request_hash,
+        journal_id=result.journal_id,
+        result=_dump(result),
+        created_at=now_utc(),
+    ))
+
+def remember(key, request_hash, result):
+    recent.set(key, (request_hash, result))
+
+def prune(session, ttl=IDEMPOTENCY_KEY_TTL, chunk_size=PRUNE_CHUNK_SIZE) -> int:
+    """Delete keys older than ``ttl`` seconds, a chunk per transaction. Returns how many."""
+    cutoff = now_utc() - timedelta(seconds=ttl)
+    deleted = 0
+    while True:
+        expired = select(IdempotencyKey.key).where(IdempotencyKey.created_at < cutoff).limit(chunk_size)
+        count = session.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.key.in_(expired.scalar_subquery()))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        session.commit()
+        deleted += count
+        if count < chunk_size:
+            return deleted
@@ -0,0 +1,248 @@
+"""
+Bulk posting of deposit, withdrawal and transfer files.
+
+Input is streamed row by row (CSV with a header, or JSON lines) using the
+columns ``type``, ``account``, ``to_account`` (transfers only), ``amount``
+and an optional ``reference``. Rows are validated and applied in batches:
+each batch resolves its accounts with one query, checks funds against the
+running balances in memory, then writes one executemany UPDATE of net
+balance deltas and executemany INSERTs of the transactions and their
+journals (see ledger.py) before committing.
+Rows that cannot be posted are written to a rejects file instead, one JSON
+object per line with the input ``line`` number first, in input order.
+"""
+from __future__ import annotations
+import csv
+import json
+import time
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from sqlalchemy import bindparam, insert, select, update
+import audit
+import cache
+import ledger
+from models import Account, Transaction, TransactionType, gen_uuid
+from postings import PostingError, begin_write, validate_amount
+
+ROW_TYPES = {
+    "deposit": TransactionType.DEPOSIT,
+    "withdrawal": TransactionType.WITHDRAWAL,
+    "withdraw": TransactionType.WITHDRAWAL,
+    "transfer": TransactionType.TRANSFER,
+}
+
+# Keeps IN lists under the bound-parameter limit of older SQLite builds
+_LOOKUP_CHUNK = 900
+
+class RowError(ValueError):
+    pass
+
+@dataclass
+class BulkPostReport:
+    posted: int = 0
+    rejected: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Postings per second."""
+        return self.posted / self.elapsed if self.elapsed else 0.0
+
+def detect_format(path) -> str:
+    suffix = Path(path).suffix.lower()
+    return "jsonl" if suffix in (".jsonl", ".ndjson", ".json") else "csv"
+
+def read_rows(path, fmt=None):
+    """Yield (line_number, row_dict) from a CSV or JSON lines file."""
+    fmt = fmt or detect_format(path)
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_no, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield line_no, json.loads(line)
+                except json.JSONDecodeError:
+                    yield line_no, {"_raw": line}
+
+def parse_row(row: dict):
+    """Validate a raw row and return (type, account, to_account, amount, reference)."""
+    if "_raw" in row:
+        raise RowError("malformed JSON")
+    txn_type = ROW_TYPES.get(str(row.get("type") or "").strip().lower())
+    if txn_type is None:
+        raise RowError(f"unknown type {row.get('type')!r}")
+    account = str(row.get("account") or "").strip()
+    if not account:
+        raise RowError("missing account")
+    to_account = str(row.get("to_account") or "").strip() or None
+    if txn_type is TransactionType.TRANSFER:
+        if not to_account:
+            raise RowError("missing to_account")
+        if to_account == account:
+            raise RowError("cannot transfer to the same account")
+    try:
+        amount = validate_amount(row.get("amount"))
+    except PostingError as e:
+        raise RowError(str(e))
+    reference = str(row.get("reference") or "").strip() or None
+    return txn_type, account, to_account, amount, reference
+
+def _load_accounts(session, numbers) -> dict:
+    """
+    Lock the accounts with these numbers and return {account_number: [id, balance]}
+    for those that exist.
+
+    Numbers are resolved to ids first, then every row is locked in one pass in
+    id order, the order postings.lock_accounts() uses, so a bulk post and
+    concurrent postings always take their locks in the same order.
+    """
+    numbers = sorted(numbers)
+    ids = {}
+    for i in range(0, len(numbers), _LOOKUP_CHUNK):
+        ids.update(session.execute(
+            select(Account.id, Account.account_number)
+            .where(Account.account_number.in_(numbers[i:i + _LOOKUP_CHUNK]))
+        ).all())
+    ordered = sorted(ids)
+    lock = session.get_bind().dialect.name != "sqlite"
+    found = {}
+    for i in range(0, len(ordered), _LOOKUP_CHUNK):
+        stmt = (
+            select(Account.id, Account.balance)
+            .where(Account.id.in_(ordered[i:i + _LOOKUP_CHUNK]))
+            .order_by(Account.id)
+        )
+        if lock:
+            stmt = stmt.with_for_update()
+        for account_id, balance in session.execute(stmt):
+            found[ids[account_id]] = [account_id, balance]
+    return found
+
+_apply_deltas = (
+    update(Account.__table__)
+    .where(Account.__table__.c.id == bindparam("account_id"))
+    .values(balance=Account.__table__.c.balance + bindparam("delta", type_=Account.__table__.c.balance.type))
+)
+
+def post_batch(session, batch, reject):
+    """
+    Apply one batch of parsed rows in a single transaction.
+
+    ``batch`` holds (line_number, raw_row, parsed_row) tuples; rows that fail
+    are passed to ``reject(line_number, raw_row, reason)``. Returns the number
+    of rows posted.
+    """
+    begin_write(session)
+    numbers = {p[1] for _, _, p in batch} | {p[2] for _, _, p in batch if p[2]}
+    accounts = _load_accounts(session, numbers)
+
+    deltas = {}
+    txns = []
+    journals = []
+    posted = 0
+    for line_no, raw, (txn_type, number, to_number, amount, reference) in batch:
+        source = accounts.get(number)
+        target = accounts.get(to_number) if to_number else None
+        if source is None:
+            reject(line_no, raw, f"account {number} not found")
+            continue
+        if to_number and target is None:
+            reject(line_no, raw, f"account {to_number} not found")
+            continue
+        if txn_type is not TransactionType.DEPOSIT and source[1] < amount:
+            reject(line_no, raw, "insufficient funds")
+            continue
+
+        if txn_type is TransactionType.DEPOSIT:
+            source[1] += amount
+            deltas[source[0]] = deltas.get(source[0], 0) + amount
+            reference = reference or "deposit"
+            legs = [(source[0], amount, txn_type, reference, amount, source[1])]
+        elif txn_type is TransactionType.WITHDRAWAL:
+            source[1] -= amount
+            deltas[source[0]] = deltas.get(source[0], 0) - amount
+            reference = reference or "withdraw"
+            legs = [(source[0], amount, txn_type, reference, -amount, source[1])]
+        else:
+            source[1] -= amount
+            target[1] += amount
+            deltas[source[0]] = deltas.get(source[0], 0) - amount
+            deltas[target[0]] = deltas.get(target[0], 0) + amount
+            legs = [
+                (source[0], amount, TransactionType.TRANSFER, reference or f"transfer to {to_number}", -amount, source[1]),
+                (target[0], amount, TransactionType.DEPOSIT, reference or f"transfer from {number}", amount, target[1]),
+            ]
+            reference = reference or f"transfer {number} to {to_number}"
+        entries = []
+        for account_id, leg_amount, leg_type, leg_reference, signed, balance_after in legs:
+            txn_id = gen_uuid()
+            txns.append({"id": txn_id, "account_id": account_id, "amount": leg_amount, "type": leg_type, "reference": leg_reference})
+            entries.append((account_id, txn_id, signed, balance_after))
+        journals.append((txn_type, reference, entries))
+        posted += 1
+
+    # Net deltas: a hot account is updated once per batch, not once per row
+    updates = [{"account_id": account_id, "delta": delta} for account_id, delta in sorted(deltas.items()) if delta]
+    if updates:
+        session.execute(_apply_deltas, updates)
+    if txns:
+        # Core insert on the table skips the ORM bulk-persistence layer
+        session.execute(insert(Transaction.__table__), txns)
+        ledger.post_journals(session, journals)
+    session.commit()
+    cache.invalidate_accounts(deltas)
+    return posted
+
+def write_rejects(out, entries):
+    """Write rejected rows in input line order (chunks arrive in order, so each only needs sorting)."""
+    entries.sort(key=lambda entry: entry["line"])
+    for entry in entries:
+        out.write(json.dumps(entry, default=str) + "\n")
+    entries.clear()
+
+def bulk_post(session, path, batch_size=5000, rejects_path=None, fmt=None) -> BulkPostReport:
+    """Stream ``path`` into the ledger in batches of ``batch_size`` rows."""
+    report = BulkPostReport()
+    rejects_path = rejects_path or f"{path}.rejects.jsonl"
+    started = time.perf_counter()
+
+    with open(rejects_path, "w", encoding="utf-8") as rejects:
+        pending = []
+
+        def reject(line_no, raw, reason):
+            report.rejected += 1
+            pending.append({"line": line_no, "reason": reason, "row": raw})
+
+        rows = read_rows(path, fmt)
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                break
+            batch = []
+            for line_no, raw in chunk:
+                try:
+                    batch.append((line_no, raw, parse_row(raw)))
+                except RowError as e:
+                    reject(line_no, raw, str(e))
+            try:
+                if batch:
+                    report.posted += post_batch(session, batch, reject)
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                write_rejects(rejects, pending)
+            report.batches += 1
+
+    report.elapsed = time.perf_counter() - started
+    audit.record("BulkPost", Path(path).name[:64], "POST", posted=report.posted, rejected=report.rejected,
+                 batches=report.batches, seconds=round(report.elapsed, 3))
+    return report
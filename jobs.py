@@ -0,0 +1,262 @@
+"""
+Month-end batch jobs: savings interest and checking maintenance fees.
+
+run_job() posts one job for one period ('YYYY-MM') to every eligible
+account of the job's type, walking accounts in id order, JOB_CHUNK_SIZE
+at a time. Each chunk is a handful of set-based statements in a single
+transaction, whatever its size:
+
+    INSERT INTO job_postings SELECT ... FROM accounts     (what to post)
+    INSERT INTO transactions SELECT ... FROM job_postings
+    UPDATE accounts ... FROM job_postings                 (the balances)
+    INSERT INTO journal_entries SELECT ...                (one journal per chunk)
+    DELETE FROM job_postings
+
+job_postings is a staging table: its rows only live inside the chunk's
+transaction, and give the transaction ids that link the rows above.
+
+The run's checkpoint (job_runs.last_account_id) moves in the same
+transaction as the chunk it covers, so a run that is interrupted simply
+resumes after its last committed chunk, and a period that has completed
+is never posted again. Amounts come from the balance when the chunk is
+posted; accounts opened after the period are left out.
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import String, delete, func, insert, literal, select, type_coerce, update
+from sqlalchemy.exc import IntegrityError
+import audit
+import cache
+from config import INTEREST_RATE, JOB_CHUNK_SIZE, MONTHLY_FEE
+from models import (
+    Account,
+    AccountType,
+    Journal,
+    JournalEntry,
+    JobPosting,
+    JobRun,
+    Transaction,
+    TransactionType,
+    CREDIT_TYPES,
+    gen_uuid,
+    now_utc,
+)
+from postings import begin_write
+
+_CREATED = type_coerce(Account.created_at, String)
+
+class JobError(RuntimeError):
+    pass
+
+@dataclass(frozen=True)
+class Job:
+    name: str
+    account_type: AccountType
+    txn_type: TransactionType
+    description: str
+
+    def amount(self):
+        """What to post to each account, as a SQL expression over accounts."""
+        if self.name == "interest":
+            return func.round(Account.balance * Decimal(INTEREST_RATE) / 12, 2)
+        return literal(Decimal(MONTHLY_FEE))
+
+    def eligible(self):
+        """Accounts that get a posting. A fee the balance cannot cover is skipped, not overdrawn."""
+        if self.name == "interest":
+            return self.amount() >= Decimal("0.01")
+        return Account.balance >= Decimal(MONTHLY_FEE)
+
+JOBS = {
+    "interest": Job("interest", AccountType.SAVINGS, TransactionType.DEPOSIT, "Savings interest"),
+    "fees": Job("fees", AccountType.CHECKING, TransactionType.FEE, "Monthly maintenance fee"),
+}
+
+@dataclass
+class JobReport:
+    job: str
+    period: str
+    status: str = "running"
+    accounts: int = 0  # posted this run (or, with dry_run, that would be)
+    total: Decimal = Decimal("0.00")
+    skipped: int = 0  # dry_run only: accounts of the type that are not eligible
+    chunks: int = 0
+    already_completed: bool = False
+
+def previous_period(today=None) -> str:
+    """'YYYY-MM' of the month before ``today``."""
+    today = today or now_utc().date()
+    year, month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    return f"{year:04d}-{month:02d}"
+
+def _period_end(period) -> str:
+    """The first day after 'YYYY-MM', as comparable stored text."""
+    try:
+        year, month = int(period[:4]), int(period[5:7])
+        start = date(year, month, 1)
+    except ValueError:
+        raise JobError(f"{period!r} is not a period; use YYYY-MM.")
+    if period != start.isoformat()[:7]:
+        raise JobError(f"{period!r} is not a period; use YYYY-MM.")
+    return (date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)).isoformat()
+
+def _scope(job, period, after):
+    """Conditions for the job's accounts after the checkpoint ``after``."""
+    conditions = [Account.type == job.account_type, _CREATED < _period_end(period)]
+    if after is not None:
+        conditions.append(Account.id > after)
+    return conditions
+
+def _new_id(session):
+    """A fresh UUID per row, generated by the database in its stored form."""
+    if session.get_bind().dialect.name == "sqlite":
+        return func.lower(func.hex(func.randomblob(16)))
+    return func.gen_random_uuid()
+
+def _start(session, job, period) -> JobRun:
+    run = session.get(JobRun, (job.name, period))
+    if run is not None:
+        return run
+    try:
+        session.add(JobRun(job=job.name, period=period, status="running"))
+        session.commit()
+    except IntegrityError:
+        # Another process started the same run first
+        session.rollback()
+    return session.get(JobRun, (job.name, period))
+
+def _post_chunk(session, job, period, chunk_size):
+    """
+    Post the next chunk of accounts after the run's checkpoint and move the
+    checkpoint past it. Returns (accounts, total), or None when no accounts
+    are left.
+    """
+    conn = begin_write(session)
+    # Re-read under the write lock: a concurrent run of the same job may have moved on
+    stmt = select(JobRun).where(JobRun.job == job.name, JobRun.period == period).execution_options(populate_existing=True)
+    if conn.dialect.name != "sqlite":
+        stmt = stmt.with_for_update()
+    run = session.scalars(stmt).one()
+    if run.status == "completed":
+        return None
+
+    scope = _scope(job, period, run.last_account_id)
+    upper = session.scalar(select(Account.id).where(*scope).order_by(Account.id).offset(chunk_size - 1).limit(1))
+    if upper is None:
+        upper = session.scalar(select(func.max(Account.id)).where(*scope))
+        if upper is None:
+            return None
+    scope.append(Account.id <= upper)
+    if conn.dialect.name != "sqlite":
+        session.execute(select(Account.id).where(*scope).order_by(Account.id).with_for_update())
+
+    key = f"{job.name}:{period}"
+    reference = f"{job.description} {period}"
+    staged = JobPosting.run == key
+    session.execute(insert(JobPosting).from_select(
+        ["transaction_id", "run", "account_id", "amount"],
+        select(_new_id(session), literal(key), Account.id, job.amount()).where(*scope, job.eligible()),
+    ))
+    session.execute(insert(Transaction).from_select(
+        ["id", "account_id", "amount", "type", "reference"],
+        select(JobPosting.transaction_id, JobPosting.account_id, JobPosting.amount,
+               literal(job.txn_type, Transaction.type.type), literal(reference)).where(staged),
+    ))
+    signed = JobPosting.amount if job.txn_type in CREDIT_TYPES else -JobPosting.amount
+    session.execute(
+        update(Account)
+        .where(Account.id == JobPosting.account_id, staged)
+        .values(balance=Account.balance + signed)
+        .execution_options(synchronize_session=False)
+    )
+    accounts, total = session.execute(select(func.count(), func.sum(JobPosting.amount)).where(staged)).one()
+    posted = session.scalars(select(JobPosting.account_id).where(staged)).all()
+    if accounts:
+        journal_id = gen_uuid()
+        session.execute(insert(Journal).values(id=journal_id, kind=job.txn_type, reference=reference))
+        previous = (
+            select(func.coalesce(func.max(JournalEntry.sequence), 0))
+            .where(JournalEntry.account_id == JobPosting.account_id)
+            .scalar_subquery()
+        )
+        session.execute(insert(JournalEntry).from_select(
+            ["journal_id", "account_id", "transaction_id", "sequence", "amount", "balance_after"],
+            select(literal(journal_id, Journal.id.type), JobPosting.account_id, JobPosting.transaction_id,
+                   previous + 1, signed, Account.balance)
+            .join(Account, Account.id == JobPosting.account_id)
+            .where(staged),
+        ))
+    session.execute(delete(JobPosting).where(staged))
+
+    total = Decimal(str(total or 0)).quantize(Decimal("0.01"))
+    run.last_account_id = upper
+    run.accounts += accounts
+    run.total = Decimal(str(run.total)) + total
+    session.commit()
+    cache.invalidate_accounts(posted)
+    return accounts, total
+
+def _dry_run(session, job, period, report):
+    run = session.get(JobRun, (job.name, period))
+    if run is not None and run.status == "completed":
+        report.status, report.already_completed = run.status, True
+        return report
+    scope = _scope(job, period, run.last_account_id if run else None)
+    eligible = job.eligible()
+    accounts, total, skipped = session.execute(
+        select(
+            func.count().filter(eligible),
+            func.sum(job.amount()).filter(eligible),
+            func.count().filter(~eligible),
+        ).where(*scope)
+    ).one()
+    report.accounts, report.skipped = accounts, skipped
+    report.total = Decimal(str(total or 0)).quantize(Decimal("0.01"))
+    report.status = "dry-run"
+    return report
+
+def run_job(session, name, period=None, chunk_size=JOB_CHUNK_SIZE, dry_run=False) -> JobReport:
+    """
+    Post job ``name`` ('interest' or 'fees') for ``period`` ('YYYY-MM';
+    default the previous month), resuming an interrupted run. A completed
+    run is left alone. With ``dry_run`` only add up what would be posted.
+    """
+    job = JOBS.get(name)
+    if job is None:
+        raise JobError(f"Unknown job {name!r}; choose from {', '.join(JOBS)}.")
+    period = period or previous_period()
+    _period_end(period)
+    report = JobReport(name, period)
+    if dry_run:
+        return _dry_run(session, job, period, report)
+
+    run = _start(session, job, period)
+    if run.status == "completed":
+        report.status, report.already_completed = run.status, True
+        return report
+    while True:
+        posted = _post_chunk(session, job, period, chunk_size)
+        if posted is None:
+            break
+        report.chunks += 1
+        report.accounts += posted[0]
+        report.total += posted[1]
+
+    run = session.get(JobRun, (job.name, period), populate_existing=True)
+    if run.status != "completed":
+        run.status = "completed"
+        run.completed_at = now_utc()
+        session.commit()
+        audit.record("Job", f"{job.name}:{period}", "completed",
+                     accounts=run.accounts, total=str(Decimal(str(run.total)).quantize(Decimal("0.01"))))
+    report.status = run.status
+    return report
+
+def status(session, name=None) -> list:
+    """JobRun rows, newest period first."""
+    stmt = select(JobRun).order_by(JobRun.period.desc(), JobRun.job)
+    if name is not None:
+        stmt = stmt.where(JobRun.job == name)
+    return session.scalars(stmt).all()
@@ -0,0 +1,210 @@
+"""
+Double-entry journal and incremental ledger verification.
+
+Every posting writes a journal (one per deposit, withdrawal or transfer)
+with one signed entry per account it touched. Each entry carries the
+account's next sequence number and its balance after the posting, so an
+account's entries form a chain: every balance_after is the previous one
+plus the entry's amount, and the last equals Account.balance. The two legs
+of a transfer share a journal and sum to zero.
+
+verify_ledger() walks that chain in (account_id, sequence) index order,
+holding one previous entry per account in memory, and records the last
+entry it checked. The next run starts from there, looking up one
+predecessor per touched account, so routine checks cost in proportion to
+new postings rather than to the size of the ledger.
+
+Entry ids are only a safe watermark where writers are serialized, as on
+SQLite. On PostgreSQL ids are drawn when a row is inserted but become
+visible when its transaction commits, so an entry can appear below a
+checkpoint that has already passed it. There each run starts
+LEDGER_VERIFY_MARGIN ids below the checkpoint and checks that stretch
+again; an entry whose transaction stayed open while more than that many
+later entries were written would still be missed by incremental runs, and
+is caught by ``--full``.
+
+Balances that predate the journal (or were loaded by seed_data's
+generator) are taken as the opening balance of an account's first entry.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from decimal import Decimal
+from itertools import groupby
+from operator import attrgetter
+from sqlalchemy import and_, func, insert, or_, select
+from config import LEDGER_VERIFY_CHUNK_SIZE, LEDGER_VERIFY_MARGIN
+from models import Account, Journal, JournalEntry, LedgerCheckpoint, TransactionType, gen_uuid
+
+CHECKPOINT = "ledger"
+STREAM_ROWS = 5000
+
+def last_sequences(session, account_ids) -> dict:
+    """{account_id: last sequence} for the accounts that have entries."""
+    ids = list(account_ids)
+    found = {}
+    # Stay well under SQLite's bound-parameter limit
+    for start in range(0, len(ids), 900):
+        found.update(session.execute(
+            select(JournalEntry.account_id, func.max(JournalEntry.sequence))
+            .where(JournalEntry.account_id.in_(ids[start:start + 900]))
+            .group_by(JournalEntry.account_id)
+        ).all())
+    return found
+
+def post_journals(session, journals) -> list:
+    """
+    Write ``journals`` and their entries; returns the new journal ids.
+
+    Each journal is (kind, reference, legs), each leg (account_id,
+    transaction_id, signed amount, balance after). Legs of one account must
+    come in posting order, and the caller must hold the account locks, as
+    postings.lock_accounts() does.
+    """
+    sequences = last_sequences(session, {leg[0] for _, _, legs in journals for leg in legs})
+    journal_rows = []
+    entry_rows = []
+    for kind, reference, legs in journals:
+        journal_id = gen_uuid()
+        journal_rows.append({"id": journal_id, "kind": kind, "reference": reference})
+        for account_id, transaction_id, amount, balance_after in legs:
+            sequences[account_id] = sequences.get(account_id, 0) + 1
+            entry_rows.append({
+                "journal_id": journal_id,
+                "account_id": account_id,
+                "transaction_id": transaction_id,
+                "sequence": sequences[account_id],
+                "amount": amount,
+                "balance_after": balance_after,
+            })
+    if journal_rows:
+        session.execute(insert(Journal.__table__), journal_rows)
+        session.execute(insert(JournalEntry.__table__), entry_rows)
+    return [row["id"] for row in journal_rows]
+
+@dataclass
+class LedgerReport:
+    """What a verify_ledger() run covered and any breaks it found."""
+    entries: int = 0
+    accounts: int = 0
+    journals: int = 0
+    through_entry_id: int = 0
+    errors: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+def _money(value) -> Decimal:
+    return Decimal(str(value)).quantize(Decimal("0.01"))
+
+def _check_account(report, account_id, rows, first_new):
+    """Check one account's chain; ``rows`` start at its predecessor, if any. Returns the last row."""
+    prev = None
+    for row in rows:
+        if prev is None and row.sequence < first_new:
+            prev = row  # already verified; only anchors the chain
+            continue
+        report.entries += 1
+        if prev is None:
+            if row.sequence != 1:
+                report.errors.append(f"account {account_id}: entry {row.sequence - 1} is missing")
+        elif row.sequence != prev.sequence + 1:
+            report.errors.append(f"account {account_id}: entries {prev.sequence + 1}..{row.sequence - 1} are missing")
+        elif _money(row.balance_after) != _money(prev.balance_after) + _money(row.amount):
+            report.errors.append(
+                f"account {account_id}: entry {row.sequence} moves {_money(prev.balance_after)} "
+                f"by {_money(row.amount)} to {_money(row.balance_after)}"
+            )
+        prev = row
+    return prev
+
+def verify_ledger(session, account_id=None, full=False, chunk_size=LEDGER_VERIFY_CHUNK_SIZE,
+                  max_errors=100) -> LedgerReport:
+    """
+    Verify the journal for one account, or the whole bank, from where the
+    last clean run stopped (or from the start with ``full``).
+
+    Checks that each touched account's entries are gapless, that every
+    running balance follows from the one before, that its last entry
+    matches Account.balance, and that every transfer journal sums to zero.
+    The checkpoint only advances when nothing is wrong. Stops collecting
+    after ``max_errors`` errors.
+    """
+    name = CHECKPOINT if account_id is None else f"{CHECKPOINT}:{account_id}"
+    checkpoint = session.get(LedgerCheckpoint, name)
+    since = 0 if full or checkpoint is None else checkpoint.last_entry_id
+    scope = [JournalEntry.account_id == account_id] if account_id is not None else []
+
+    report = LedgerReport(through_entry_id=since)
+    if session.get_bind().dialect.name != "sqlite":
+        # Entries that committed after the last run may have ids below its checkpoint
+        since = max(0, since - LEDGER_VERIFY_MARGIN)
+    high = session.execute(select(func.max(JournalEntry.id)).where(*scope)).scalar()
+    if not high or high <= since:
+        return report
+    new = [JournalEntry.id > since, JournalEntry.id <= high, *scope]
+
+    after = None
+    while True:
+        # The next chunk of touched accounts, with the first new sequence of each
+        stmt = (
+            select(JournalEntry.account_id, func.min(JournalEntry.sequence))
+            .where(*new)
+            .group_by(JournalEntry.account_id)
+            .order_by(JournalEntry.account_id)
+            .limit(chunk_size)
+        )
+        if after is not None:
+            stmt = stmt.where(JournalEntry.account_id > after)
+        chunk = dict(session.execute(stmt).all())
+        if not chunk:
+            break
+        ids = list(chunk)
+        after = ids[-1]
+
+        # Each account's new entries plus the verified one before them, in index order
+        rows = session.execute(
+            select(JournalEntry.account_id, JournalEntry.sequence, JournalEntry.amount, JournalEntry.balance_after)
+            .where(JournalEntry.id <= high, or_(*(
+                and_(JournalEntry.account_id == a, JournalEntry.sequence >= first - 1) for a, first in chunk.items()
+            )))
+            .order_by(JournalEntry.account_id, JournalEntry.sequence)
+            .execution_options(yield_per=STREAM_ROWS)
+        )
+        last = {a: _check_account(report, a, entries, chunk[a]) for a, entries in groupby(rows, key=attrgetter("account_id"))}
+        report.accounts += len(chunk)
+
+        # Accounts posted to since the run began have moved on; their next run checks them
+        moved = set(session.execute(
+            select(JournalEntry.account_id).where(JournalEntry.id > high, JournalEntry.account_id.in_(ids)).distinct()
+        ).scalars())
+        for a, balance in session.execute(select(Account.id, Account.balance).where(Account.id.in_(ids))):
+            if a not in moved and a in last and _money(balance) != _money(last[a].balance_after):
+                report.errors.append(
+                    f"account {a}: balance is {_money(balance)} but its last entry leaves {_money(last[a].balance_after)}"
+                )
+        if len(report.errors) >= max_errors:
+            break
+
+    # Transfers must balance: both legs are written in the same database transaction
+    new_journals = select(JournalEntry.journal_id).where(*new).distinct().subquery()
+    report.journals = session.execute(select(func.count()).select_from(new_journals)).scalar()
+    unbalanced = session.execute(
+        select(JournalEntry.journal_id, func.sum(JournalEntry.amount))
+        .join(Journal, Journal.id == JournalEntry.journal_id)
+        .where(JournalEntry.journal_id.in_(select(new_journals.c.journal_id)), Journal.kind == TransactionType.TRANSFER)
+        .group_by(JournalEntry.journal_id)
+        .having(func.sum(JournalEntry.amount) != 0)
+    ).all()
+    for journal_id, total in unbalanced:
+        report.errors.append(f"transfer journal {journal_id} sums to {_money(total)}, not 0")
+
+    del report.errors[max_errors:]
+    if report.ok:
+        report.through_entry_id = high
+        if checkpoint is None:
+            session.add(LedgerCheckpoint(name=name, last_entry_id=high))
+        else:
+            checkpoint.last_entry_id = high
+        session.commit()
+    return report
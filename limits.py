@@ -0,0 +1,439 @@
+"""
+Velocity limits on withdrawals and outgoing transfers.
+
+Every debit a user initiates (postings.withdraw() and the sending side of
+postings.transfer()) is checked against sliding-window limits on its
+account (ACCOUNT_LIMITS) and on the account's owner across all their
+accounts (USER_LIMITS): at most so many debits, and so much money, in the
+last minute, hour and day. A posting over a limit raises
+LimitExceededError before anything is written.
+
+Counters live in memory. Each account and user has a _Window: the times
+and amounts (in cents) of its debits over the last day, in two flat
+arrays, with a start offset and running total per window. Expired debits
+are dropped from the front as the windows slide, so a check is a few
+comparisons, not a query. The counters are rebuilt from the ledger (the
+last day of WITHDRAWAL and TRANSFER rows) the first time a process needs
+them.
+
+A posting calls prepare() before it takes its account locks: that is
+where the counters are loaded, the first time, so the check made under
+the locks touches nothing but memory. Limits are off unless
+LIMITS_ENABLED is set.
+
+With LIMITS_STORE set, debits are also appended to a small SQLite file
+that every process shares. Only the first process to find the store
+without recent debits rebuilds it from the ledger. After loading, a
+background thread talks to the store every STORE_INTERVAL seconds: it
+appends the debits this process recorded since its last round and
+applies the rows other processes added, by rowid, skipping its own.
+Postings never wait on the store, so an event loop running them
+(AsyncBank) is not stalled by it; debits from other processes are seen
+up to STORE_INTERVAL late.
+
+Within a process, check() holds the debit it admits against the account
+and the user (counted in every window) until the posting commits, when
+record() turns it into a debit in the windows, or rolls back, when
+release() drops it. So two postings in flight at once, on different
+accounts of one user say, cannot both pass a limit that only one fits
+under. Two processes can still both admit a debit that only one of them
+should have.
+"""
+from __future__ import annotations
+import atexit
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal
+from sqlalchemy import String, select, type_coerce
+from config import ACCOUNT_LIMITS, LIMITS_ENABLED, LIMITS_STORE, USER_LIMITS
+from models import Account, Transaction, TransactionType
+
+WINDOWS = (("minute", 60), ("hour", 3600), ("day", 86400))
+SPANS = tuple(span for _, span in WINDOWS)
+DAY = SPANS[-1]
+DEBIT_TYPES = (TransactionType.WITHDRAWAL, TransactionType.TRANSFER)
+# Windows idle for a day are swept out of memory (and the store) this often
+SWEEP_INTERVAL = 3600
+# Seconds between the store thread's rounds (append our debits, read everyone else's)
+STORE_INTERVAL = 0.2
+STREAM_ROWS = 10_000
+
+_CREATED = type_coerce(Transaction.created_at, String)
+_SPEC = re.compile(r"(minute|hour|day)=(\d*)(?:/(\d+(?:\.\d{1,2})?))?")
+
+@dataclass(frozen=True)
+class Limit:
+    window: str
+    span: int
+    count: int | None  # most debits in the window
+    cents: int | None  # most money in the window
+
+def parse_limits(spec) -> tuple:
+    """Limits from 'minute=5/200000,day=/1000000' (count/amount per window; either may be omitted)."""
+    limits = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        match = _SPEC.fullmatch(part)
+        if match is None:
+            raise ValueError(f"Invalid limit {part!r}; expected window=count/amount, e.g. hour=20/500000.")
+        window, count, amount = match.groups()
+        limits.append(Limit(
+            window, dict(WINDOWS)[window],
+            int(count) if count else None,
+            int(Decimal(amount) * 100) if amount else None,
+        ))
+    return tuple(limits)
+
+def _cents(amount) -> int:
+    return int(Decimal(str(amount)) * 100)
+
+def _timestamp(value) -> float:
+    """A stored created_at (naive UTC, text on SQLite) as a Unix time."""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+class _Window:
+    """One account's or user's debits over the last day, with a running count and total per window."""
+    __slots__ = ("times", "cents", "starts", "totals")
+
+    def __init__(self):
+        self.times = array("d")
+        self.cents = array("q")
+        self.starts = [0] * len(SPANS)
+        self.totals = [0] * len(SPANS)
+
+    def add(self, at, cents):
+        if self.times and at < self.times[-1]:
+            # Another process's debit read late: keep the arrays in time order
+            at = self.times[-1]
+        self.times.append(at)
+        self.cents.append(cents)
+        for i in range(len(SPANS)):
+            self.totals[i] += cents
+
+    def slide(self, now):
+        """Drop debits that have left each window."""
+        times, cents, starts, totals = self.times, self.cents, self.starts, self.totals
+        end = len(times)
+        for i, span in enumerate(SPANS):
+            start, cutoff = starts[i], now - span
+            while start < end and times[start] <= cutoff:
+                totals[i] -= cents[start]
+                start += 1
+            starts[i] = start
+        # The day window starts earliest; reclaim what it has left behind
+        dropped = starts[-1]
+        if dropped > 64 and dropped * 2 > end:
+            del times[:dropped]
+            del cents[:dropped]
+            self.starts = [s - dropped for s in starts]
+
+    def usage(self, i) -> tuple:
+        """(debits, cents) in window ``i``."""
+        return len(self.times) - self.starts[i], self.totals[i]
+
+    def idle(self, now) -> bool:
+        return not self.times or self.times[-1] <= now - DAY
+
+@dataclass(frozen=True)
+class Debit:
+    """A debit that passed its checks and is held until it is recorded or released."""
+    account_id: str
+    owner_id: str
+    cents: int
+
+class Limiter:
+    """Sliding-window counters per account and per user, optionally shared through a SQLite store."""
+
+    def __init__(self, account_limits, user_limits, store=None):
+        self.account_limits = account_limits
+        self.user_limits = user_limits
+        self.accounts = {}
+        self.users = {}
+        # Admitted but not yet committed: {account or user id: [debits, cents]}
+        self.held_accounts = {}
+        self.held_users = {}
+        self.store = store
+        self.origin = uuid.uuid4().hex  # marks this process's rows in the store
+        self._db = None
+        self._seen = 0  # highest store rowid applied
+        self._outbox = []  # recorded debits not yet appended to the store
+        self._swept = time.time()
+        self._sweep_store = False
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()  # the store connection, used by one thread at a time
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    # ---- loading ----
+    def _apply(self, rows):
+        for account_id, owner_id, at, cents in rows:
+            self._window(self.accounts, account_id).add(at, cents)
+            self._window(self.users, owner_id).add(at, cents)
+
+    @staticmethod
+    def _window(windows, key) -> _Window:
+        window = windows.get(key)
+        if window is None:
+            window = windows[key] = _Window()
+        return window
+
+    @staticmethod
+    def _ledger(session, since):
+        """(account_id, owner_id, time, cents) of debits posted since ``since``, oldest first."""
+        cutoff = datetime.fromtimestamp(since, timezone.utc).replace(tzinfo=None).isoformat(" ")
+        rows = session.execute(
+            select(Transaction.account_id, Account.owner_id, Transaction.created_at, Transaction.amount)
+            .join(Account, Account.id == Transaction.account_id)
+            .where(Transaction.type.in_(DEBIT_TYPES), _CREATED >= cutoff)
+            .order_by(Transaction.created_at)
+            .execution_options(yield_per=STREAM_ROWS)
+        )
+        for account_id, owner_id, created, amount in rows:
+            yield account_id, owner_id, _timestamp(created), _cents(amount)
+
+    def _connect(self):
+        db = sqlite3.connect(self.store, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS debits ("
+            "id INTEGER PRIMARY KEY, account_id TEXT NOT NULL, owner_id TEXT NOT NULL, "
+            "at REAL NOT NULL, cents INTEGER NOT NULL, origin TEXT)"
+        )
+        if "origin" not in {column[1] for column in db.execute("PRAGMA table_info(debits)")}:
+            # A store written before debits were tagged with their process
+            db.execute("ALTER TABLE debits ADD COLUMN origin TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS ix_debits_at ON debits (at)")
+        return db
+
+    def load(self, session):
+        """Build the counters from the store, or from the ledger when there is no recent store."""
+        since = time.time() - DAY
+        if self.store:
+            db = self._db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if db.execute("SELECT 1 FROM debits WHERE at > ? LIMIT 1", (since,)).fetchone() is None:
+                    # First process here today: seed the store from the ledger
+                    db.execute("DELETE FROM debits")
+                    db.executemany(
+                        "INSERT INTO debits (account_id, owner_id, at, cents) VALUES (?, ?, ?, ?)",
+                        self._ledger(session, since),
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self._apply(self._read(since))
+            self._thread = threading.Thread(target=self._run, name="limits-store", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        else:
+            self._apply(self._ledger(session, since))
+
+    def _read(self, since=None) -> list:
+        """(account_id, owner_id, at, cents) of debits other processes added to the store since the last read."""
+        stmt = "SELECT id, account_id, owner_id, at, cents FROM debits WHERE id > ? AND (origin IS NULL OR origin != ?)"
+        params = (self._seen, self.origin)
+        if since is not None:
+            stmt += " AND at > ?"
+            params += (since,)
+        rows = self._db.execute(stmt + " ORDER BY id", params).fetchall()
+        if rows:
+            self._seen = rows[-1][0]
+        return [row[1:] for row in rows]
+
+    def sync(self):
+        """One round trip to the store: append this process's recorded debits, apply everyone else's."""
+        if self._db is None:
+            return
+        with self._store_lock:
+            with self._lock:
+                rows, self._outbox = self._outbox, []
+                sweep, self._sweep_store = self._sweep_store, False
+            if rows or sweep:
+                self._append(rows, sweep)
+            found = self._read()
+        if found:
+            with self._lock:
+                self._apply(found)
+
+    def _append(self, rows, sweep):
+        db = self._db
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT INTO debits (account_id, owner_id, at, cents, origin) VALUES (?, ?, ?, ?, ?)",
+                [row + (self.origin,) for row in rows],
+            )
+            if sweep:
+                db.execute("DELETE FROM debits WHERE at <= ?", (time.time() - DAY,))
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            with self._lock:
+                # Appended on the next round instead
+                self._outbox[:0] = rows
+                self._sweep_store = self._sweep_store or sweep
+            raise
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(STORE_INTERVAL)
+            try:
+                self.sync()
+            except sqlite3.Error:
+                pass  # a busy or locked store; the next round tries again
+
+    def close(self):
+        """Stop the store thread after appending what is left to the store."""
+        if self._thread is None or self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.sync()
+
+    # ---- decisions ----
+    @staticmethod
+    def _exceeded(window, held, limits, cents, now, scope):
+        if window is not None:
+            window.slide(now)
+        held_count, held_cents = held or (0, 0)
+        for limit in limits:
+            count, total = window.usage(SPANS.index(limit.span)) if window is not None else (0, 0)
+            count, total = count + held_count, total + held_cents
+            if limit.count is not None and count + 1 > limit.count:
+                return f"{scope} {limit.window} limit of {limit.count} withdrawals and transfers. Try again later."
+            if limit.cents is not None and total + cents > limit.cents:
+                return f"{scope} {limit.window} limit of {Decimal(limit.cents) / 100:.2f}. Try a smaller amount or try again later."
+        return None
+
+    def check(self, account_id, owner_id, amount) -> Debit:
+        """
+        Admit a debit of ``amount`` and hold it until record() or release(),
+        or raise LimitExceededError. Reads memory only.
+        """
+        account_id, owner_id = str(account_id), str(owner_id)
+        cents = _cents(amount)
+        now = time.time()
+        with self._lock:
+            reason = (
+                self._exceeded(self.accounts.get(account_id), self.held_accounts.get(account_id),
+                               self.account_limits, cents, now, "the account's")
+                or self._exceeded(self.users.get(owner_id), self.held_users.get(owner_id),
+                                  self.user_limits, cents, now, "your")
+            )
+            if not reason:
+                for held, key in ((self.held_accounts, account_id), (self.held_users, owner_id)):
+                    counts = held.setdefault(key, [0, 0])
+                    counts[0] += 1
+                    counts[1] += cents
+        if reason:
+            from postings import LimitExceededError
+            raise LimitExceededError(f"This would exceed {reason}")
+        return Debit(account_id, owner_id, cents)
+
+    def _unhold(self, debit):
+        for held, key in ((self.held_accounts, debit.account_id), (self.held_users, debit.owner_id)):
+            counts = held[key]
+            counts[0] -= 1
+            counts[1] -= debit.cents
+            if not counts[0]:
+                del held[key]
+
+    def release(self, debit):
+        """Drop a held debit whose posting rolled back."""
+        with self._lock:
+            self._unhold(debit)
+
+    def record(self, debit):
+        """Count a held debit whose posting committed, here and (with a store) for other processes."""
+        now = time.time()
+        with self._lock:
+            self._unhold(debit)
+            self._window(self.accounts, debit.account_id).add(now, debit.cents)
+            self._window(self.users, debit.owner_id).add(now, debit.cents)
+            if self._db is not None:
+                self._outbox.append((debit.account_id, debit.owner_id, now, debit.cents))
+            if now - self._swept > SWEEP_INTERVAL:
+                self._sweep(now)
+
+    def _sweep(self, now):
+        self._swept = now
+        for windows in (self.accounts, self.users):
+            for key in [key for key, window in windows.items() if window.idle(now)]:
+                del windows[key]
+        self._sweep_store = self._db is not None
+
+    def usage(self, account_id, owner_id=None) -> dict:
+        """{window: (account debits, account cents, user debits, user cents)}."""
+        self.sync()
+        now = time.time()
+        with self._lock:
+            found = {}
+            for i, (name, _) in enumerate(WINDOWS):
+                row = ()
+                for windows, key in ((self.accounts, account_id), (self.users, owner_id)):
+                    window = windows.get(key)
+                    if window is not None:
+                        window.slide(now)
+                    row += window.usage(i) if window is not None else (0, 0)
+                found[name] = row
+            return found
+
+    def stats(self) -> dict:
+        return {"accounts": len(self.accounts), "users": len(self.users), "store": self.store or None}
+
+_settings = {"enabled": LIMITS_ENABLED, "account_limits": ACCOUNT_LIMITS, "user_limits": USER_LIMITS, "store": LIMITS_STORE}
+_limiter = None
+_loading = threading.Lock()
+
+def configure(enabled=None, account_limits=None, user_limits=None, store=None):
+    """
+    Replace, for this process, whether limits are enforced, the configured
+    limits (specs as in ACCOUNT_LIMITS) or the store ('' for none).
+    """
+    settings = (("enabled", enabled), ("account_limits", account_limits), ("user_limits", user_limits), ("store", store))
+    for name, value in settings:
+        if value is not None:
+            _settings[name] = value
+    reset()
+
+def limiter(session) -> Limiter:
+    """This process's Limiter, loaded on first use."""
+    global _limiter
+    if _limiter is None:
+        with _loading:
+            if _limiter is None:
+                found = Limiter(parse_limits(_settings["account_limits"]), parse_limits(_settings["user_limits"]),
+                                _settings["store"])
+                found.load(session)
+                _limiter = found
+    return _limiter
+
+def prepare(session) -> Limiter | None:
+    """
+    This process's Limiter, loaded on first use, or None while limits are
+    disabled. Call it before taking a posting's locks; the Limiter's
+    check() then only reads memory.
+    """
+    if not _settings["enabled"]:
+        return None
+    return limiter(session)
+
+def reset():
+    """Forget the loaded counters; the next check loads them again."""
+    global _limiter
+    if _limiter is not None:
+        _limiter.close()
+    _limiter = None
@@ -0,0 +1,517 @@
+"""
+Hot-path instrumentation: operation latency, SQL statements per operation,
+rows returned and the slowest statements.
+
+Every engine built by database.py gets before/after_cursor_execute
+listeners (instrument_engine()) that time each statement and file it under
+its normalized text: literals replaced by ?, IN lists and multi-row VALUES
+collapsed, whitespace squeezed. Rows are counted as the result is fetched.
+The menus in app.py run inside operation(), so each statement is also
+charged to the operation that issued it: deposit, transfer and so on.
+
+Per operation there are fixed-bucket histograms of latency and of
+statements per call, plus rows and errors. Time spent waiting for the user
+(inside paused()) does not count as latency. When one normalized statement
+runs METRICS_REPEAT_THRESHOLD or more times in a single call, that is
+recorded as a repeated statement: the shape of an N+1 query.
+
+The cost is some tens of microseconds per statement, most of it
+SQLAlchemy's event dispatch: small next to a posting's commit, so it can
+stay on in production. Numbers build up
+in memory. With METRICS_FILE set they are merged into it (JSON, shared by
+every process) at exit and every METRICS_FLUSH_INTERVAL seconds; each
+flush also rewrites METRICS_PROMETHEUS_FILE, if set, in the Prometheus
+text format, for node_exporter's textfile collector. Without it nothing
+is written. ``python app.py stats`` prints the totals.
+"""
+from __future__ import annotations
+import atexit
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from config import (
+    METRICS_ENABLED,
+    METRICS_FILE,
+    METRICS_FLUSH_INTERVAL,
+    METRICS_PROMETHEUS_FILE,
+    METRICS_REPEAT_THRESHOLD,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: flushes from concurrent processes are not serialized
+    fcntl = None
+
+# Upper bounds; each histogram also has a +Inf bucket
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# Distinct statements tracked per process, and kept in METRICS_FILE
+STATEMENT_LIMIT = 500
+OTHER_STATEMENT = "(other statements)"
+NORMALIZE_CACHE_SIZE = 2000
+PROMETHEUS_STATEMENTS = 20
+
+class Histogram:
+    """Counts per fixed bucket, plus the sum of observed values."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds, counts=None, total=0.0):
+        self.bounds = tuple(bounds)
+        self.counts = list(counts) if counts else [0] * (len(self.bounds) + 1)
+        self.sum = total
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        if other.bounds != self.bounds:
+            raise ValueError("Cannot merge histograms with different buckets.")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile ``q`` (inf if beyond the last), or None if empty."""
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {"bounds": list(self.bounds), "counts": self.counts, "sum": self.sum}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["bounds"], data["counts"], data["sum"])
+
+class _Operation:
+    """Totals for one operation name."""
+
+    __slots__ = ("latency", "statements", "rows", "sql_seconds", "errors")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.rows = 0
+        self.sql_seconds = 0.0
+        self.errors = 0
+
+class _Run:
+    """One call of an operation, while it runs."""
+
+    __slots__ = ("name", "parent", "statements", "rows", "sql_seconds", "paused", "counts")
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.statements = 0
+        self.rows = 0
+        self.sql_seconds = 0.0
+        self.paused = 0.0
+        self.counts = {}  # normalized statement -> executions in this call
+
+class Registry:
+    """Everything recorded in this process since the last flush."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.operations = {}
+        # normalized statement -> [calls, seconds, max seconds, rows]
+        self.sql = {}
+        # (operation, normalized statement) -> [calls with repeats, most repeats in one call]
+        self.repeats = {}
+
+    def statement(self, text, seconds):
+        """Record one execution of a normalized statement; returns its entry (for rows fetched later)."""
+        with self.lock:
+            entry = self.sql.get(text)
+            if entry is None:
+                if len(self.sql) >= STATEMENT_LIMIT:
+                    text = OTHER_STATEMENT
+                entry = self.sql.setdefault(text, [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+            return entry
+
+    def rows(self, entry, count):
+        with self.lock:
+            entry[3] += count
+
+    def finish(self, run, seconds, failed):
+        with self.lock:
+            op = self.operations.get(run.name)
+            if op is None:
+                op = self.operations[run.name] = _Operation()
+            op.latency.observe(seconds)
+            op.statements.observe(run.statements)
+            op.rows += run.rows
+            op.sql_seconds += run.sql_seconds
+            op.errors += failed
+            for text, count in run.counts.items():
+                if count >= METRICS_REPEAT_THRESHOLD:
+                    entry = self.repeats.setdefault((run.name, text), [0, 0])
+                    entry[0] += 1
+                    entry[1] = max(entry[1], count)
+
+    def snapshot(self) -> dict:
+        """The recorded numbers in METRICS_FILE's layout, and start afresh."""
+        with self.lock:
+            data = {
+                "operations": {
+                    name: {
+                        "latency": op.latency.to_dict(),
+                        "statements": op.statements.to_dict(),
+                        "rows": op.rows,
+                        "sql_seconds": op.sql_seconds,
+                        "errors": op.errors,
+                    }
+                    for name, op in self.operations.items()
+                },
+                "sql": {text: list(entry) for text, entry in self.sql.items()},
+                "repeats": [[name, text, calls, most] for (name, text), (calls, most) in self.repeats.items()],
+            }
+            self.clear()
+        return data
+
+registry = Registry()
+_current = contextvars.ContextVar("metrics_operation", default=None)
+
+# --- SQL normalization -------------------------------------------------------
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS = re.compile(r"(\(\?(?:, \?)*\))(?:\s*,\s*\(\?(?:, \?)*\))+")
+_SPACE = re.compile(r"\s+")
+_normalized = {}
+
+def normalize(statement) -> str:
+    """``statement`` with literals as ?, IN lists and VALUES rows collapsed and whitespace squeezed."""
+    text = _normalized.get(statement)
+    if text is None:
+        text = _SPACE.sub(" ", statement).strip()
+        text = _NUMBER.sub("?", _STRING.sub("?", text))
+        text = _ROWS.sub(r"\1, ...", text)
+        text = _LIST.sub("(?, ...)", text)
+        if len(_normalized) >= NORMALIZE_CACHE_SIZE:
+            _normalized.clear()
+        _normalized[statement] = text
+    return text
+
+# --- engine events -----------------------------------------------------------
+
+class _CountingCursor:
+    """A DBAPI cursor that counts the rows fetched through it."""
+
+    __slots__ = ("_cursor", "_entry", "_run")
+
+    def __init__(self, cursor, entry, run):
+        self._cursor = cursor
+        self._entry = entry
+        self._run = run
+
+    def _count(self, n):
+        if n:
+            registry.rows(self._entry, n)
+            if self._run is not None:
+                self._run.rows += n
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_metrics_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    text = normalize(statement)
+    entry = registry.statement(text, seconds)
+    run = _current.get()
+    if run is not None:
+        run.statements += 1
+        run.sql_seconds += seconds
+        run.counts[text] = run.counts.get(text, 0) + 1
+    if cursor.description is not None:
+        # Rows are fetched after this event, through context.cursor
+        context.cursor = _CountingCursor(cursor, entry, run)
+    elif cursor.rowcount and cursor.rowcount > 0:
+        registry.rows(entry, cursor.rowcount)
+        if run is not None:
+            run.rows += cursor.rowcount
+
+def instrument_engine(engine):
+    """Time every statement ``engine`` runs (a sync Engine, or an AsyncEngine's sync_engine)."""
+    from sqlalchemy import event
+
+    if METRICS_ENABLED:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+# --- operations --------------------------------------------------------------
+
+@contextmanager
+def operation(name):
+    """Charge the statements run inside to operation ``name``, and time it. Nests."""
+    if not METRICS_ENABLED:
+        yield None
+        return
+    parent = _current.get()
+    run = _Run(name, parent)
+    token = _current.set(run)
+    failed = False
+    started = time.perf_counter()
+    try:
+        yield run
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started - run.paused
+        _current.reset(token)
+        registry.finish(run, seconds, failed)
+        if parent is not None:
+            parent.statements += run.statements
+            parent.rows += run.rows
+            parent.sql_seconds += run.sql_seconds
+            for text, count in run.counts.items():
+                parent.counts[text] = parent.counts.get(text, 0) + count
+        else:
+            _maybe_flush()
+
+def timed(name):
+    """Decorator form of operation()."""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with operation(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def paused():
+    """Leave the time spent inside (waiting for input, say) out of the running operations' latency."""
+    run = _current.get()
+    if run is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        while run is not None:
+            run.paused += seconds
+            run = run.parent
+
+# --- METRICS_FILE and the Prometheus file -----------------------------------
+
+def _empty() -> dict:
+    return {"operations": {}, "sql": {}, "repeats": []}
+
+def merge(total, delta) -> dict:
+    """Add the snapshot ``delta`` into ``total`` (both in METRICS_FILE's layout)."""
+    for name, op in delta["operations"].items():
+        into = total["operations"].get(name)
+        if into is None:
+            total["operations"][name] = op
+            continue
+        for key in ("latency", "statements"):
+            histogram = Histogram.from_dict(into[key])
+            histogram.merge(Histogram.from_dict(op[key]))
+            into[key] = histogram.to_dict()
+        for key in ("rows", "sql_seconds", "errors"):
+            into[key] += op[key]
+    for text, (calls, seconds, longest, rows) in delta["sql"].items():
+        into = total["sql"].setdefault(text, [0, 0.0, 0.0, 0])
+        into[0] += calls
+        into[1] += seconds
+        into[2] = max(into[2], longest)
+        into[3] += rows
+    if len(total["sql"]) > STATEMENT_LIMIT:
+        kept = sorted(total["sql"].items(), key=lambda item: item[1][1], reverse=True)[:STATEMENT_LIMIT]
+        total["sql"] = dict(kept)
+    repeats = {(name, text): [calls, most] for name, text, calls, most in total["repeats"]}
+    for name, text, calls, most in delta["repeats"]:
+        into = repeats.setdefault((name, text), [0, 0])
+        into[0] += calls
+        into[1] = max(into[1], most)
+    total["repeats"] = [[name, text, calls, most] for (name, text), (calls, most) in repeats.items()]
+    return total
+
+def load(path=None) -> dict:
+    """The totals in METRICS_FILE (empty if there are none yet, or no file is set)."""
+    path = path or METRICS_FILE
+    if not path:
+        return _empty()
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _empty()
+
+def _write(path, text):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+@contextmanager
+def _file_lock(path):
+    with open(f"{path}.lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+_last_flush = time.monotonic()
+
+def flush(path=None, prometheus_path=None):
+    """
+    Merge what this process recorded into METRICS_FILE and rewrite the
+    Prometheus file; without a METRICS_FILE the numbers stay in memory.
+    """
+    global _last_flush
+    _last_flush = time.monotonic()
+    path = path or METRICS_FILE
+    if not path:
+        return
+    delta = registry.snapshot()
+    if not delta["operations"] and not delta["sql"]:
+        return
+    prometheus_path = prometheus_path or METRICS_PROMETHEUS_FILE
+    with _file_lock(path):
+        total = merge(load(path), delta)
+        _write(path, json.dumps(total, separators=(",", ":")))
+        if prometheus_path:
+            _write(prometheus_path, prometheus(total))
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except OSError:
+            pass  # metrics must never break an operation
+
+def reset(path=None, prometheus_path=None):
+    """Forget everything recorded, here and in the files."""
+    registry.snapshot()
+    for name in (path or METRICS_FILE, prometheus_path or METRICS_PROMETHEUS_FILE):
+        if name and os.path.exists(name):
+            os.remove(name)
+
+def _flush_at_exit():
+    try:
+        flush()
+    except OSError:
+        pass
+
+if METRICS_ENABLED:
+    atexit.register(_flush_at_exit)
+
+# --- reporting ---------------------------------------------------------------
+
+def _label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", " ").replace('"', '\\"')
+
+def _histogram_lines(metric, labels, data):
+    lines = []
+    seen = 0
+    for bound, count in zip(data["bounds"] + ["+Inf"], data["counts"]):
+        seen += count
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {seen}')
+    lines.append(f"{metric}_sum{{{labels}}} {data['sum']}")
+    lines.append(f"{metric}_count{{{labels}}} {seen}")
+    return lines
+
+def slowest(data, limit=10) -> list:
+    """(statement, calls, seconds, max seconds, rows) by total time, slowest first."""
+    ranked = sorted(data["sql"].items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    return [(text, *entry) for text, entry in ranked]
+
+def prometheus(data) -> str:
+    """``data`` (METRICS_FILE's layout) in the Prometheus text exposition format."""
+    lines = [
+        "# HELP bank_operation_seconds Operation latency, excluding time waiting for input.",
+        "# TYPE bank_operation_seconds histogram",
+    ]
+    operations = sorted(data["operations"].items())
+    for name, op in operations:
+        lines += _histogram_lines("bank_operation_seconds", f'operation="{_label(name)}"', op["latency"])
+    lines += [
+        "# HELP bank_operation_statements SQL statements per operation.",
+        "# TYPE bank_operation_statements histogram",
+    ]
+    for name, op in operations:
+        lines += _histogram_lines("bank_operation_statements", f'operation="{_label(name)}"', op["statements"])
+    for key, help_text in (
+        ("rows", "Rows returned or affected by the operation's statements."),
+        ("sql_seconds", "Time spent executing the operation's statements."),
+        ("errors", "Operations that raised an exception."),
+    ):
+        metric = f"bank_operation_{key}_total"
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        lines += [f'{metric}{{operation="{_label(name)}"}} {op[key]}' for name, op in operations]
+    lines += [
+        "# HELP bank_sql_statements_total Statements executed.",
+        "# TYPE bank_sql_statements_total counter",
+        f"bank_sql_statements_total {sum(entry[0] for entry in data['sql'].values())}",
+        "# HELP bank_sql_seconds_total Time spent executing statements.",
+        "# TYPE bank_sql_seconds_total counter",
+        f"bank_sql_seconds_total {sum(entry[1] for entry in data['sql'].values())}",
+        "# HELP bank_sql_statement_seconds_total Execution time of the slowest normalized statements.",
+        "# TYPE bank_sql_statement_seconds_total counter",
+    ]
+    top = slowest(data, PROMETHEUS_STATEMENTS)
+    lines += [f'bank_sql_statement_seconds_total{{statement="{_label(text)}"}} {seconds}' for text, _, seconds, _, _ in top]
+    lines += [
+        "# HELP bank_sql_statement_calls_total Executions of the slowest normalized statements.",
+        "# TYPE bank_sql_statement_calls_total counter",
+    ]
+    lines += [f'bank_sql_statement_calls_total{{statement="{_label(text)}"}} {calls}' for text, calls, _, _, _ in top]
+    return "\n".join(lines) + "\n"
@@ -2,22 +2,25 @@ from __future__ import annotations
 import enum
 import uuid
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime
 from sqlalchemy import (
-    create_engine,
     String,
     Integer,
     Column,
+    Date,
     DateTime,
     ForeignKey,
     Enum,
     Numeric,
     Boolean,
+    Index,
+    case,
     func,
     text,
 )
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column, sessionmaker
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column
 
 # ===========================================
 # BASE
@@ -47,6 +50,10 @@ class TransactionType(enum.Enum):
     TRANSFER = "transfer"
     FEE = "fee"
 
+# Types that add to the balance. Everything else is a debit, including the
+# outgoing TRANSFER leg (the incoming leg is recorded as a DEPOSIT).
+CREDIT_TYPES = (TransactionType.DEPOSIT,)
+
 # ===========================================
 # MODELS
 # ===========================================
@@ -82,6 +89,13 @@ class Account(Base):
     owner = relationship("User", back_populates="accounts")
     transactions = relationship("Transaction", back_populates="account", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Lets recipients.refresh() find accounts opened since its last look
+        Index("ix_accounts_created_at", "created_at"),
+        # A user's accounts, for the account menus and the dashboard
+        Index("ix_accounts_owner_id", "owner_id"),
+    )
+
     def deposit(self, amount: Decimal):
         self.balance += amount
 
@@ -105,6 +119,21 @@ class Transaction(Base):
 
     account = relationship("Account", back_populates="transactions")
 
+    __table_args__ = (
+        # Serves keyset pagination of an account's history, newest first
+        Index("ix_transactions_account_created_id", "account_id", "created_at", "id"),
+    )
+
+    @hybrid_property
+    def signed_amount(self) -> Decimal:
+        """Amount with the sign it had on the balance: positive for credits."""
+        return self.amount if self.type in CREDIT_TYPES else -self.amount
+
+    @signed_amount.inplace.expression
+    @classmethod
+    def _signed_amount_expression(cls):
+        return case((cls.type.in_(CREDIT_TYPES), cls.amount), else_=-cls.amount)
+
     def __repr__(self):
         return f"<Transaction {self.id} account={self.account_id} {self.type} {self.amount}>"
 
@@ -120,6 +149,10 @@ class Beneficiary(Base):
 
     owner = relationship("User", back_populates="beneficiaries")
 
+    __table_args__ = (
+        Index("ix_beneficiaries_owner_account", "owner_id", "account_number"),
+    )
+
     def __repr__(self):
         return f"<Beneficiary {self.name} {self.account_number}>"
 
@@ -137,6 +170,10 @@ class Card(Base):
 
     owner = relationship("User", back_populates="cards")
 
+    __table_args__ = (
+        Index("ix_cards_owner_id", "owner_id"),
+    )
+
     def __repr__(self):
         return f"<Card ****{self.last4} owner={self.owner_id}>"
 
@@ -150,14 +187,162 @@ class AuditLog(Base):
     payload: Mapped[str | None] = mapped_column(String(2000), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now())
 
+    __table_args__ = (
+        # "Everything that happened to this entity", newest first, and time-range scans
+        Index("ix_audit_logs_entity_created_id", "entity", "entity_id", "created_at", "id"),
+        Index("ix_audit_logs_created_id", "created_at", "id"),
+    )
+
     def __repr__(self):
         return f"<Audit {self.action} {self.entity} {self.entity_id}>"
 
-# ===========================================
-# DATABASE SETUP
-# ===========================================
-engine = create_engine("sqlite+pysqlite:///./bank.db", echo=True, future=True)
-Session = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+class BalanceSnapshot(Base):
+    __tablename__ = "balance_snapshots"
+
+    account_id: Mapped[str] = mapped_column(UUID(as_uuid=False), ForeignKey("accounts.id"), primary_key=True)
+    snapshot_date: Mapped[date] = mapped_column(Date, primary_key=True)
+    closing_balance: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False)
+    # Running totals from the account's first transaction through snapshot_date
+    total_credits: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False)
+    total_debits: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False)
+    transaction_count: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<BalanceSnapshot {self.account_id} {self.snapshot_date} {self.closing_balance}>"
+
+class SnapshotCheckpoint(Base):
+    __tablename__ = "snapshot_checkpoints"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    completed_through: Mapped[date] = mapped_column(Date, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now(), onupdate=func.now())
 
-# Create tables if they don't exist
-Base.metadata.create_all(engine)
+    def __repr__(self):
+        return f"<SnapshotCheckpoint {self.name} through={self.completed_through}>"
+
+class Journal(Base):
+    __tablename__ = "journals"
+
+    id: Mapped[str] = mapped_column(UUID(as_uuid=False), primary_key=True, default=gen_uuid)
+    kind: Mapped[TransactionType] = mapped_column(Enum(TransactionType), nullable=False)
+    reference: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now())
+
+    entries = relationship("JournalEntry", back_populates="journal", order_by="JournalEntry.id")
+
+    def __repr__(self):
+        return f"<Journal {self.id} {self.kind}>"
+
+class JournalEntry(Base):
+    __tablename__ = "journal_entries"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    journal_id: Mapped[str] = mapped_column(UUID(as_uuid=False), ForeignKey("journals.id"), nullable=False)
+    account_id: Mapped[str] = mapped_column(UUID(as_uuid=False), ForeignKey("accounts.id"), nullable=False)
+    # Not a foreign key: archive.archive() moves old transactions out of the
+    # transactions table while their entries stay in the journal
+    transaction_id: Mapped[str] = mapped_column(UUID(as_uuid=False), nullable=False)
+    # Position in the account's ledger, counting from 1 with no gaps
+    sequence: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Signed: positive for credits, negative for debits
+    amount: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False)
+    balance_after: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False)
+
+    journal = relationship("Journal", back_populates="entries")
+
+    __table_args__ = (
+        Index("ux_journal_entries_account_sequence", "account_id", "sequence", unique=True),
+    )
+
+    def __repr__(self):
+        return f"<JournalEntry {self.account_id}#{self.sequence} {self.amount} -> {self.balance_after}>"
+
+class LedgerCheckpoint(Base):
+    __tablename__ = "ledger_checkpoints"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    last_entry_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<LedgerCheckpoint {self.name} through={self.last_entry_id}>"
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    key: Mapped[str] = mapped_column(String(128), primary_key=True)
+    operation: Mapped[str] = mapped_column(String(32), nullable=False)
+    # sha256 of the operation and its arguments, to refuse a key reused for another request
+    request_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    journal_id: Mapped[str | None] = mapped_column(UUID(as_uuid=False), nullable=True)
+    # The PostingResult as JSON, returned again to retries
+    result: Mapped[str] = mapped_column(String(2000), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} {self.operation}>"
+
+class ArchivePartition(Base):
+    __tablename__ = "archive_partitions"
+
+    # 'YYYY-MM'; the month's transactions live in a per-month SQLite file or table (see archive.py)
+    month: Mapped[str] = mapped_column(String(7), primary_key=True)
+    location: Mapped[str] = mapped_column(String(255), nullable=False)
+    transaction_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    first_created: Mapped[datetime] = mapped_column(DateTime(timezone=False), nullable=False)
+    last_created: Mapped[datetime] = mapped_column(DateTime(timezone=False), nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ArchivePartition {self.month} rows={self.transaction_count}>"
+
+class ArchivedRange(Base):
+    __tablename__ = "archived_ranges"
+
+    # Which archive months hold an account's transactions, and their time span,
+    # so reads skip partitions that cannot match
+    account_id: Mapped[str] = mapped_column(UUID(as_uuid=False), ForeignKey("accounts.id"), primary_key=True)
+    month: Mapped[str] = mapped_column(String(7), primary_key=True)
+    first_created: Mapped[datetime] = mapped_column(DateTime(timezone=False), nullable=False)
+    last_created: Mapped[datetime] = mapped_column(DateTime(timezone=False), nullable=False)
+    transaction_count: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<ArchivedRange {self.account_id} {self.month} rows={self.transaction_count}>"
+
+class JobRun(Base):
+    __tablename__ = "job_runs"
+
+    # One row per job and period ('YYYY-MM'): a period is only ever posted once
+    job: Mapped[str] = mapped_column(String(32), primary_key=True)
+    period: Mapped[str] = mapped_column(String(7), primary_key=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False)  # running or completed
+    # Accounts are processed in id order; everything up to here is posted
+    last_account_id: Mapped[str | None] = mapped_column(UUID(as_uuid=False), nullable=True)
+    accounts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False, default=Decimal("0.00"))
+    started_at: Mapped[datetime] = mapped_column(DateTime(timezone=False), server_default=func.now())
+    completed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=False), nullable=True)
+
+    def __repr__(self):
+        return f"<JobRun {self.job} {self.period} {self.status}>"
+
+class JobPosting(Base):
+    __tablename__ = "job_postings"
+
+    # Staging for one chunk of a job run; rows only exist inside the chunk's transaction
+    transaction_id: Mapped[str] = mapped_column(UUID(as_uuid=False), primary_key=True)
+    run: Mapped[str] = mapped_column(String(48), nullable=False)
+    account_id: Mapped[str] = mapped_column(UUID(as_uuid=False), nullable=False)
+    amount: Mapped[Decimal] = mapped_column(Numeric(18,2), nullable=False)
+
+    __table_args__ = (
+        Index("ix_job_postings_run", "run"),
+    )
+
+    def __repr__(self):
+        return f"<JobPosting {self.run} {self.account_id} {self.amount}>"
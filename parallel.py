@@ -0,0 +1,198 @@
+"""
+Multi-process bulk posting.
+
+parallel_post() spreads a posting file over a ProcessPoolExecutor. Rows are
+partitioned so that every row touching a given account lands in the same
+partition: accounts linked by a transfer are merged into one group
+(union-find), and each group goes to partition crc32(smallest account
+number) % partitions. Inside a partition rows keep their file order and are
+applied with ingest.post_batch(); the file is processed in windows, each
+finished before the next begins. Postings to an account therefore happen
+in the same order as in a single-process run, while partitions share no
+accounts and never wait on each other's row locks.
+
+Transfers among a few hundred accounts can chain a whole window into one
+group, which one worker then posts alone. A window whose largest
+partition holds more than SKEW times its share of the rows is halved
+and each half partitioned again, down to MIN_WINDOW_ROWS rows; windows
+that still end up in a single partition are counted in the report.
+
+Each worker process builds its own engine (connections are never shared
+across a fork). On PostgreSQL throughput grows close to linearly with
+workers until the server is saturated; SQLite allows one writer at a time,
+so there extra workers only take turns.
+"""
+from __future__ import annotations
+import os
+import time
+import zlib
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from config import BULK_BATCH_SIZE
+from ingest import RowError, parse_row, read_rows, write_rejects
+
+# A window is split again while its largest partition holds more than SKEW
+# times len(rows) / partitions rows and it has at least 2 * MIN_WINDOW_ROWS rows
+SKEW = 2
+MIN_WINDOW_ROWS = 200
+
+@dataclass
+class ParallelPostReport:
+    posted: int = 0
+    rejected: int = 0
+    partitions: int = 0  # partition tasks run, over all windows
+    windows: int = 0  # rounds posted, after splitting skewed windows
+    collapsed: int = 0  # rounds whose rows all landed in one partition
+    elapsed: float = 0.0
+    # {pid: {"partitions", "posted", "rejected", "seconds"}}
+    workers: dict = field(default_factory=dict)
+
+    @property
+    def rate(self) -> float:
+        """Postings per second."""
+        return self.posted / self.elapsed if self.elapsed else 0.0
+
+def _root(parent, number):
+    while parent[number] != number:
+        parent[number] = parent[parent[number]]
+        number = parent[number]
+    return number
+
+def partition_rows(rows, partitions) -> list:
+    """
+    Split parsed rows ((line_number, raw_row, parsed_row) tuples) into
+    ``partitions`` lists such that no account appears in two of them.
+    The same rows always produce the same partitions, in file order.
+    """
+    parent = {}
+    for _, _, (_, number, to_number, _, _) in rows:
+        parent.setdefault(number, number)
+        if to_number:
+            parent.setdefault(to_number, to_number)
+            a, b = _root(parent, number), _root(parent, to_number)
+            if a != b:
+                # The smaller number stays the root, so groups are named deterministically
+                parent[max(a, b)] = min(a, b)
+
+    parts = [[] for _ in range(partitions)]
+    slots = {}
+    for row in rows:
+        root = _root(parent, row[2][1])
+        slot = slots.get(root)
+        if slot is None:
+            slot = slots[root] = zlib.crc32(root.encode()) % partitions
+        parts[slot].append(row)
+    return parts
+
+def split_window(rows, partitions) -> list:
+    """
+    partition_rows() for each piece of ``rows``, in file order: a window
+    whose largest partition is more than SKEW times its share is halved
+    and each half split again, so linked accounts do not serialize it.
+    """
+    parts = [part for part in partition_rows(rows, partitions) if part]
+    largest = max((len(part) for part in parts), default=0)
+    if largest * partitions <= SKEW * len(rows) or len(rows) < 2 * MIN_WINDOW_ROWS:
+        return [parts]
+    half = len(rows) // 2
+    return split_window(rows[:half], partitions) + split_window(rows[half:], partitions)
+
+def _init_worker(url):
+    import database
+
+    # Connections inherited through fork belong to the parent; leave them alone
+    database.engine.dispose(close=False)
+    database.configure(url)
+
+def _post_partition(rows, batch_size):
+    """Worker side: post one partition in batches; returns (pid, posted, rejects, seconds)."""
+    import database
+    from ingest import post_batch
+
+    rejects = []
+
+    def reject(line_no, raw, reason):
+        rejects.append({"line": line_no, "reason": reason, "row": raw})
+
+    started = time.perf_counter()
+    posted = 0
+    with database.Session() as session:
+        for i in range(0, len(rows), batch_size):
+            try:
+                posted += post_batch(session, rows[i:i + batch_size], reject)
+            except Exception:
+                session.rollback()
+                raise
+    return os.getpid(), posted, rejects, time.perf_counter() - started
+
+def parallel_post(path, workers=None, partitions=None, batch_size=BULK_BATCH_SIZE,
+                  window_size=None, rejects_path=None, fmt=None, url=None) -> ParallelPostReport:
+    """
+    Post ``path`` with ``workers`` processes (default: one per CPU).
+
+    The file is read in windows of ``window_size`` rows (default: one batch
+    per partition), each split into ``partitions`` (default: four per
+    worker) so that a large group of linked accounts does not leave the
+    other workers idle. Smaller windows mean fewer transfers chaining
+    accounts into one group, at the cost of more rounds; split_window()
+    shrinks the windows where that happens.
+    """
+    import audit
+    import cache
+    import database
+
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or workers * 4
+    window_size = window_size or batch_size * partitions
+    url = url or database.engine.url.render_as_string(hide_password=False)
+    rejects_path = rejects_path or f"{path}.rejects.jsonl"
+    report = ParallelPostReport()
+    started = time.perf_counter()
+
+    with open(rejects_path, "w", encoding="utf-8") as rejects:
+        pending = []
+
+        def reject(entry):
+            report.rejected += 1
+            pending.append(entry)
+
+        source = read_rows(path, fmt)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(url,)) as pool:
+            while True:
+                window = list(islice(source, window_size))
+                if not window:
+                    break
+                rows = []
+                for line_no, raw in window:
+                    try:
+                        rows.append((line_no, raw, parse_row(raw)))
+                    except RowError as e:
+                        reject({"line": line_no, "reason": str(e), "row": raw})
+
+                # Each piece is posted before the next one starts, which keeps each account's rows in order
+                for parts in split_window(rows, partitions):
+                    report.windows += 1
+                    report.partitions += len(parts)
+                    if len(parts) == 1 and partitions > 1:
+                        report.collapsed += 1
+                    futures = [pool.submit(_post_partition, part, batch_size) for part in parts]
+                    for future in as_completed(futures):
+                        pid, posted, failed, seconds = future.result()
+                        report.posted += posted
+                        for entry in failed:
+                            reject(entry)
+                        stats = report.workers.setdefault(pid, {"partitions": 0, "posted": 0, "rejected": 0, "seconds": 0.0})
+                        stats["partitions"] += 1
+                        stats["posted"] += posted
+                        stats["rejected"] += len(failed)
+                        stats["seconds"] += seconds
+                # Partitions finish in any order; the window's rejects are written in line order
+                write_rejects(rejects, pending)
+
+    report.elapsed = time.perf_counter() - started
+    # Balances changed in other processes
+    cache.clear()
+    audit.record("BulkPost", os.path.basename(path)[:64], "POST", posted=report.posted, rejected=report.rejected,
+                 workers=workers, partitions=report.partitions, windows=report.windows, seconds=round(report.elapsed, 3))
+    return report
@@ -0,0 +1,227 @@
+"""
+Password hashing and verification.
+
+Hashes are self-describing strings that record their scheme and cost
+parameters next to a per-password random salt:
+
+    scrypt$n=16384,r=8,p=1$<salt>$<hash>
+    pbkdf2_sha256$i=600000$<salt>$<hash>
+
+New hashes use PASSWORD_HASH_SCHEME and the cost settings in config.py.
+Existing hashes verify with whatever parameters they were made with, and
+needs_rehash() reports those that no longer match the settings, so
+authenticate() can upgrade them on the next successful login. Rows from
+before hashing, which hold the password itself, are treated the same way.
+PASSWORD_SALT is a pepper: it keys an HMAC of the password before the
+derivation, so hashes are useless without it.
+
+Deriving a key is deliberately slow and hashlib releases the GIL while
+it runs, so verification can be moved to a small thread pool
+(submit_verify(), verify_user_async()) to keep the event loop and batch
+workers responsive.
+"""
+from __future__ import annotations
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    PASSWORD_HASH_SCHEME,
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_SALT,
+    PASSWORD_VERIFY_CACHE_TTL,
+    PBKDF2_ITERATIONS,
+    SCRYPT_N,
+    SCRYPT_P,
+    SCRYPT_R,
+)
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+def default_params(scheme=PASSWORD_HASH_SCHEME) -> dict:
+    """Cost parameters for new hashes of ``scheme``, from config.py."""
+    if scheme == "scrypt":
+        return {"n": SCRYPT_N, "r": SCRYPT_R, "p": SCRYPT_P}
+    if scheme == "pbkdf2_sha256":
+        return {"i": PBKDF2_ITERATIONS}
+    raise ValueError(f"Unknown password hash scheme {scheme!r}.")
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def _derive(scheme, params, password, salt) -> bytes:
+    secret = hmac.new(PASSWORD_SALT.encode(), password.encode(), hashlib.sha256).digest()
+    if scheme == "scrypt":
+        n, r, p = params["n"], params["r"], params["p"]
+        # hashlib's default 32 MiB limit is too small for n >= 2**15
+        maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+        return hashlib.scrypt(secret, salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=KEY_BYTES)
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", secret, salt, params["i"], dklen=KEY_BYTES)
+    raise ValueError(f"Unknown password hash scheme {scheme!r}.")
+
+def hash_password(password: str, scheme=PASSWORD_HASH_SCHEME, **params) -> str:
+    """Hash ``password`` with ``scheme``; keyword arguments override the configured costs."""
+    params = {**default_params(scheme), **params}
+    salt = os.urandom(SALT_BYTES)
+    key = _derive(scheme, params, password, salt)
+    encoded = ",".join(f"{name}={value}" for name, value in params.items())
+    return f"{scheme}${encoded}${_b64encode(salt)}${_b64encode(key)}"
+
+def _parse(stored: str):
+    """Split a stored hash into (scheme, params, salt, key), or None if it is not one."""
+    parts = stored.split("$")
+    if len(parts) != 4:
+        return None
+    scheme, encoded, salt, key = parts
+    try:
+        params = {name: int(value) for name, value in (item.split("=") for item in encoded.split(","))}
+        default_params(scheme)
+        return scheme, params, _b64decode(salt), _b64decode(key)
+    except ValueError:
+        return None
+
+def is_hashed(stored: str) -> bool:
+    return _parse(stored) is not None
+
+def needs_rehash(stored: str) -> bool:
+    """True for plaintext and for hashes made with other than the current settings."""
+    parsed = _parse(stored)
+    if parsed is None:
+        return True
+    scheme, params, _, _ = parsed
+    return scheme != PASSWORD_HASH_SCHEME or params != default_params(scheme)
+
+# Successful verifications, so repeat logins skip the key derivation. Keys
+# are an HMAC under a per-process secret, never the password itself.
+_verified = None
+_verified_key = os.urandom(32)
+_verified_lock = threading.Lock()
+
+def _verified_cache():
+    global _verified
+    if _verified is None:
+        with _verified_lock:
+            if _verified is None:
+                from cache import TTLCache
+                _verified = TTLCache(ttl=PASSWORD_VERIFY_CACHE_TTL)
+    return _verified
+
+def _cache_key(password, stored) -> bytes:
+    return hmac.new(_verified_key, f"{stored}\0{password}".encode(), hashlib.sha256).digest()
+
+def verify_password(password: str, stored: str, cached=True) -> bool:
+    """
+    Check ``password`` against a stored hash (or a legacy plaintext value).
+    With ``cached``, a recent successful check of the same pair is reused.
+    """
+    if not stored:
+        return False
+    parsed = _parse(stored)
+    if parsed is None:
+        return hmac.compare_digest(stored.encode(), password.encode())
+
+    use_cache = cached and PASSWORD_VERIFY_CACHE_TTL > 0
+    if use_cache:
+        key = _cache_key(password, stored)
+        if _verified_cache().get(key):
+            return True
+    scheme, params, salt, expected = parsed
+    ok = hmac.compare_digest(_derive(scheme, params, password, salt), expected)
+    if ok and use_cache:
+        _verified_cache().set(key, True)
+    return ok
+
+def verify_and_update(password: str, stored: str):
+    """
+    Verify ``password`` and return (ok, new_hash). ``new_hash`` is set when
+    the password matched but ``stored`` should be replaced.
+    """
+    if not verify_password(password, stored):
+        return False, None
+    return True, hash_password(password) if needs_rehash(stored) else None
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def executor() -> ThreadPoolExecutor:
+    """The shared hashing pool, PASSWORD_HASH_WORKERS threads, started on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+    return _executor
+
+def verify_user(user, password: str):
+    """
+    verify_and_update() for a looked-up user row. A missing or inactive user
+    fails after the same work as a wrong password, so timing does not reveal
+    which emails exist.
+    """
+    if user is None or not user.is_active:
+        verify_password(password, _dummy_hash())
+        return False, None
+    return verify_and_update(password, user.hashed_password)
+
+def submit_verify(user, password: str):
+    """Run verify_user() on the hashing pool; returns a Future."""
+    return executor().submit(verify_user, user, password)
+
+async def verify_user_async(user, password: str):
+    """verify_user() without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(executor(), verify_user, user, password)
+
+def store_rehash(session, user_id, old_hash, new_hash) -> bool:
+    """
+    Replace a user's hash if it is still ``old_hash`` (a concurrent login
+    may have upgraded it already). Returns whether this call replaced it.
+    """
+    from sqlalchemy import update
+    from models import User
+
+    result = session.execute(
+        update(User)
+        .where(User.id == user_id, User.hashed_password == old_hash)
+        .values(hashed_password=new_hash)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return result.rowcount == 1
+
+def authenticate(session, email: str, password: str):
+    """
+    Return the user row for ``email`` if ``password`` matches, else None.
+
+    The user is looked up by email alone (through the unique index and the
+    user cache) and the password is checked in Python. A matching password
+    stored with outdated parameters, or in plaintext, is rehashed.
+    """
+    import audit
+    import cache
+
+    user = cache.get_user_by_email(session, email)
+    ok, new_hash = verify_user(user, password)
+    if not ok:
+        audit.record("User", user.id if user else None, "LOGIN_FAILED", email=email)
+        return None
+    if new_hash:
+        store_rehash(session, user.id, user.hashed_password, new_hash)
+        cache.invalidate_user(email)
+    audit.record("User", user.id, "LOGIN", rehashed=bool(new_hash))
+    return user
+
+_dummy = None
+
+def _dummy_hash() -> str:
+    global _dummy
+    if _dummy is None:
+        _dummy = hash_password(os.urandom(16).hex())
+    return _dummy
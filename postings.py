@@ -0,0 +1,282 @@
+"""
+Posting service: applies deposits, withdrawals and transfers to the ledger.
+
+Every posting runs in a single database transaction. Balances change through
+single-statement UPDATEs (a debit only matches while the balance covers it),
+so concurrent writers can neither lose updates nor overdraw an account.
+Accounts are locked in id order so two transfers in opposite directions
+cannot deadlock. Each posting also writes its journal (see ledger.py) in
+the same transaction, and queues an audit event (see audit.py) once it
+has committed.
+
+deposit(), withdraw() and transfer() also accept an ``idempotency_key``.
+The key is checked once the accounts are locked and stored with the
+posting (see idempotency.py), so a retried request returns the first
+attempt's result instead of posting twice, even when the attempts race.
+
+Withdrawals and the sending side of transfers are also checked against
+velocity limits (see limits.py) once the accounts are locked. An admitted
+debit is held against the limits until the posting commits (and is
+counted) or rolls back (and is released). The counters are loaded and
+synced before the locks are taken, so the check itself does no I/O.
+"""
+from __future__ import annotations
+import functools
+import inspect
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from decimal import Decimal
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+import audit
+import cache
+import idempotency
+import ledger
+import limits
+from models import Account, Transaction, TransactionType, CREDIT_TYPES, gen_uuid
+
+class PostingError(Exception):
+    """Base class for postings that were rejected."""
+
+class AccountNotFoundError(PostingError, LookupError):
+    pass
+
+class InsufficientFundsError(PostingError, ValueError):
+    pass
+
+class InvalidAmountError(PostingError, ValueError):
+    pass
+
+class IdempotencyKeyReusedError(PostingError, ValueError):
+    """The idempotency key was already used for a different request."""
+
+class LimitExceededError(PostingError, ValueError):
+    """The debit would break a velocity limit (see limits.py)."""
+
+class _Replayed(Exception):
+    """Raised inside a posting whose key turns out to be stored already."""
+
+    def __init__(self, result):
+        self.result = result
+
+@dataclass
+class PostingResult:
+    """Transactions written by a posting, its journal and the resulting balances."""
+    transaction_ids: list = field(default_factory=list)
+    balances: dict = field(default_factory=dict)
+    journal_id: str | None = None
+
+def validate_amount(amount) -> Decimal:
+    """Coerce ``amount`` to a positive two-place Decimal."""
+    try:
+        amount = Decimal(str(amount))
+    except Exception:
+        raise InvalidAmountError("Invalid amount.")
+    if not amount.is_finite() or amount <= 0:
+        raise InvalidAmountError("Amount must be greater than zero.")
+    if amount != amount.quantize(Decimal("0.01")):
+        raise InvalidAmountError("Amount cannot have more than two decimal places.")
+    return amount
+
+def begin_write(session):
+    """
+    Open the session's write transaction.
+
+    pysqlite defers BEGIN until the first DML statement, which lets two writers
+    both start reading and then race to upgrade their locks. BEGIN IMMEDIATE
+    takes the write lock up front instead. Other backends lock rows explicitly
+    in lock_accounts().
+    """
+    conn = session.connection()
+    if conn.dialect.name == "sqlite" and not conn.connection.driver_connection.in_transaction:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    return conn
+
+def lock_accounts(session, account_ids) -> dict:
+    """
+    Lock the given accounts in id order and return {id: row}, each row
+    with the account's ``account_number`` and ``owner_id``.
+
+    Raises AccountNotFoundError if any of them does not exist.
+    """
+    ids = sorted(set(account_ids))
+    conn = begin_write(session)
+    stmt = select(Account.id, Account.account_number, Account.owner_id).where(Account.id.in_(ids)).order_by(Account.id)
+    if conn.dialect.name != "sqlite":
+        stmt = stmt.with_for_update()
+    locked = {row.id: row for row in session.execute(stmt)}
+    if len(locked) != len(ids):
+        raise AccountNotFoundError("Account not found.")
+    return locked
+
+def credit(session, account_id, amount: Decimal):
+    session.execute(
+        update(Account)
+        .where(Account.id == account_id)
+        .values(balance=Account.balance + amount)
+        .execution_options(synchronize_session=False)
+    )
+
+def debit(session, account_id, amount: Decimal):
+    """Debit ``account_id`` only if its balance covers ``amount``."""
+    result = session.execute(
+        update(Account)
+        .where(Account.id == account_id, Account.balance >= amount)
+        .values(balance=Account.balance - amount)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        raise InsufficientFundsError("Insufficient funds.")
+
+def _record(session, kind, reference, legs) -> PostingResult:
+    """Insert the transaction rows and journal for ``legs`` and read back the new balances."""
+    rows = [
+        {"id": gen_uuid(), "account_id": account_id, "amount": amount, "type": txn_type, "reference": reference}
+        for account_id, amount, txn_type, reference in legs
+    ]
+    session.execute(insert(Transaction), rows)
+    account_ids = [leg[0] for leg in legs]
+    balances = dict(session.execute(
+        select(Account.id, Account.balance).where(Account.id.in_(account_ids))
+    ).all())
+    [journal_id] = ledger.post_journals(session, [(kind, reference, [
+        (r["account_id"], r["id"], r["amount"] if r["type"] in CREDIT_TYPES else -r["amount"], balances[r["account_id"]])
+        for r in rows
+    ])])
+    result = PostingResult(transaction_ids=[r["id"] for r in rows], balances=balances, journal_id=journal_id)
+    pending = session.info.get(_PENDING_KEY)
+    if pending is not None:
+        idempotency.save(session, *pending, result)
+    return result
+
+_PENDING_KEY = "postings.idempotency_key"
+
+def _replay(found, request_hash):
+    stored_hash, result = found
+    if stored_hash != request_hash:
+        raise IdempotencyKeyReusedError("Idempotency key was already used for a different request.")
+    return result
+
+@contextmanager
+def _posting(session, account_ids):
+    """Lock ``account_ids`` (yielding lock_accounts()'s rows) and commit or roll back the posting."""
+    try:
+        locked = lock_accounts(session, account_ids)
+        pending = session.info.get(_PENDING_KEY)
+        if pending is not None:
+            # Under the account locks, so an attempt that committed first is visible here
+            key, _, request_hash = pending
+            found = idempotency.lookup(session, key)
+            if found is not None:
+                raise _Replayed(_replay(found, request_hash))
+        yield locked
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    cache.invalidate_accounts(account_ids)
+
+@contextmanager
+def _limited(limiter):
+    """
+    Yield admit(account_id, owner_id, amount), which checks a debit against
+    ``limiter`` (None while limits are off). Debits admitted inside are
+    recorded if the block completes and released if it raises; put the
+    _posting() block inside, so that is after its commit or rollback.
+    """
+    admitted = []
+
+    def admit(account_id, owner_id, amount):
+        if limiter is not None:
+            admitted.append(limiter.check(account_id, owner_id, amount))
+
+    try:
+        yield admit
+    except BaseException:
+        for debit in admitted:
+            limiter.release(debit)
+        raise
+    for debit in admitted:
+        limiter.record(debit)
+
+def _idempotent(post):
+    """Give ``post`` an ``idempotency_key`` keyword: repeats of a keyed request return the first result."""
+    signature = inspect.signature(post)
+
+    @functools.wraps(post)
+    def wrapper(session, *args, idempotency_key=None, **kwargs):
+        if idempotency_key is None:
+            return post(session, *args, **kwargs)
+        bound = signature.bind(session, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = {name: value for name, value in bound.arguments.items() if name != "session"}
+        # "10", 10 and "10.00" are the same request
+        arguments["amount"] = validate_amount(arguments["amount"]).quantize(Decimal("0.01"))
+        request_hash = idempotency.fingerprint(post.__name__, arguments)
+
+        found = idempotency.cached(idempotency_key)
+        if found is not None:
+            return _replay(found, request_hash)
+        session.info[_PENDING_KEY] = (idempotency_key, post.__name__, request_hash)
+        try:
+            result = post(session, *args, **kwargs)
+        except _Replayed as replayed:
+            return replayed.result
+        except IntegrityError:
+            # Another attempt inserted the key between our check and our insert
+            found = idempotency.lookup(session, idempotency_key)
+            if found is None:
+                raise
+            return _replay(found, request_hash)
+        finally:
+            session.info.pop(_PENDING_KEY, None)
+        idempotency.remember(idempotency_key, request_hash, result)
+        return result
+
+    return wrapper
+
+@_idempotent
+def deposit(session, account_id, amount, reference="deposit") -> PostingResult:
+    amount = validate_amount(amount)
+    with _posting(session, [account_id]):
+        credit(session, account_id, amount)
+        result = _record(session, TransactionType.DEPOSIT, reference, [
+            (account_id, amount, TransactionType.DEPOSIT, reference),
+        ])
+    audit.record("Account", account_id, "DEPOSIT", amount=amount, balance=result.balances[account_id], journal_id=result.journal_id)
+    return result
+
+@_idempotent
+def withdraw(session, account_id, amount, reference="withdraw") -> PostingResult:
+    amount = validate_amount(amount)
+    with _limited(limits.prepare(session)) as admit, _posting(session, [account_id]) as locked:
+        admit(account_id, locked[account_id].owner_id, amount)
+        debit(session, account_id, amount)
+        result = _record(session, TransactionType.WITHDRAWAL, reference, [
+            (account_id, amount, TransactionType.WITHDRAWAL, reference),
+        ])
+    audit.record("Account", account_id, "WITHDRAWAL", amount=amount, balance=result.balances[account_id], journal_id=result.journal_id)
+    return result
+
+@_idempotent
+def transfer(session, from_account_id, to_account_id, amount) -> PostingResult:
+    """Move ``amount`` between two accounts as one atomic posting."""
+    amount = validate_amount(amount)
+    if from_account_id == to_account_id:
+        raise PostingError("Cannot transfer to the same account.")
+    with _limited(limits.prepare(session)) as admit, _posting(session, [from_account_id, to_account_id]) as locked:
+        admit(from_account_id, locked[from_account_id].owner_id, amount)
+        numbers = {account_id: row.account_number for account_id, row in locked.items()}
+        debit(session, from_account_id, amount)
+        credit(session, to_account_id, amount)
+        reference = f"transfer {numbers[from_account_id]} to {numbers[to_account_id]}"
+        result = _record(session, TransactionType.TRANSFER, reference, [
+            (from_account_id, amount, TransactionType.TRANSFER, f"transfer to {numbers[to_account_id]}"),
+            (to_account_id, amount, TransactionType.DEPOSIT, f"transfer from {numbers[from_account_id]}"),
+        ])
+    # One event per account, so each account's audit trail is a single index range
+    audit.record("Account", from_account_id, "TRANSFER_OUT", amount=amount, to=numbers[to_account_id],
+                 balance=result.balances[from_account_id], journal_id=result.journal_id)
+    audit.record("Account", to_account_id, "TRANSFER_IN", amount=amount, **{"from": numbers[from_account_id]},
+                 balance=result.balances[to_account_id], journal_id=result.journal_id)
+    return result
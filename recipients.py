@@ -0,0 +1,302 @@
+"""
+Recipient resolution for transfers.
+
+resolve() turns the account number a user typed into a Recipient: an
+internal account (with its id, ready for postings.transfer()) or one of
+the user's external beneficiaries, which cannot be paid from here. Unknown
+or malformed numbers raise AccountNotFoundError.
+
+Long-running processes (the interactive menus, batch mode) call
+start_preload() once. It loads every internal account number into an
+AccountIndex in the background: numbers and ids packed into sorted byte
+arrays, about 40 bytes per account instead of the few hundred a dict of
+strings costs, searched by bisection (ids that are not UUIDs are kept in
+a plain dict beside the arrays). Beneficiaries are loaded alongside,
+grouped by owner. Once loaded, resolving a recipient does not touch the
+database. Accounts opened in this process are added as they are created
+(note_account()); those opened elsewhere are picked up by an incremental
+refresh, at most every RECIPIENT_REFRESH_INTERVAL seconds, when a lookup
+misses. A number that is neither an internal account nor a beneficiary in
+the index is looked up once more among the user's beneficiaries, which
+are only saved outside this process. Until the index is ready, resolve()
+falls back to the lookup cache.
+"""
+from __future__ import annotations
+import heapq
+import re
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from sqlalchemy import String, select, type_coerce
+from config import RECIPIENT_REFRESH_INTERVAL
+from models import Account, Beneficiary
+from postings import AccountNotFoundError
+
+# Account numbers are up to 34 characters (the column width, as for an IBAN) without spaces
+_VALID_NUMBER = re.compile(r"\S{1,34}")
+# Recently added accounts stay in a dict until there are this many, then are merged into the arrays
+MERGE_THRESHOLD = 10_000
+STREAM_ROWS = 10_000
+# created_at is set before commit, so a refresh also re-reads accounts a little older than the last one seen
+REFRESH_LOOKBACK = timedelta(minutes=1)
+
+_ACCOUNT_ID = type_coerce(Account.id, String)
+_CREATED = type_coerce(Account.created_at, String)
+
+@dataclass(frozen=True)
+class Recipient:
+    account_number: str
+    internal: bool
+    account_id: str | None = None  # internal accounts only
+    name: str | None = None  # from the user's beneficiaries, when saved there
+    bank_name: str | None = None
+
+def _pack_id(account_id) -> bytes | None:
+    """The 16 bytes of a UUID id (dashed or 32 hex digits), or None for an id in any other format."""
+    text = str(account_id).replace("-", "")
+    if len(text) != 32:
+        return None
+    try:
+        return bytes.fromhex(text)
+    except ValueError:
+        return None
+
+def _unpack_id(data) -> str:
+    h = data.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+def _canonical(account_id) -> str:
+    packed = _pack_id(account_id)
+    return _unpack_id(packed) if packed is not None else str(account_id)
+
+def _pack(pairs, others):
+    """
+    (numbers, offsets, ids) for (account_number, account_id) pairs, and
+    whether they came sorted by number. Pairs whose id is not a UUID go
+    into the dict ``others`` instead.
+    """
+    numbers = bytearray()
+    offsets = array("I", [0])
+    ids = bytearray()
+    previous = b""
+    in_order = True
+    for number, account_id in pairs:
+        packed = _pack_id(account_id)
+        if packed is None:
+            others[number] = str(account_id)
+            continue
+        key = number.encode()
+        in_order = in_order and key >= previous
+        previous = key
+        numbers += key
+        offsets.append(len(numbers))
+        ids += packed
+    return (bytes(numbers), offsets, bytes(ids)), in_order
+
+def _byte_order(pair):
+    return pair[0].encode()
+
+class AccountIndex:
+    """
+    Account number -> id, as sorted packed arrays plus a dict of recent
+    additions and one of ids that are not UUIDs.
+    """
+
+    def __init__(self, pairs=()):
+        """``pairs`` are (account_number, account_id), ideally already sorted by number."""
+        self._others = {}
+        # Replaced as one tuple, so a reader never sees arrays from two builds
+        self._packed, in_order = _pack(pairs, self._others)
+        if not in_order:
+            # e.g. a PostgreSQL collation that does not sort bytewise
+            self._packed, _ = _pack(sorted(self._pairs(), key=_byte_order), self._others)
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._packed[1]) - 1 + len(self._recent) + len(self._others)
+
+    def get(self, number):
+        """The id of account ``number``, or None."""
+        account_id = self._recent.get(number) or self._others.get(number)
+        if account_id is not None:
+            return account_id
+        numbers, offsets, ids = self._packed
+        key = number.encode()
+        lo, hi = 0, len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if numbers[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(offsets) - 1 and numbers[offsets[lo]:offsets[lo + 1]] == key:
+            return _unpack_id(ids[lo * 16:lo * 16 + 16])
+        return None
+
+    def add(self, number, account_id):
+        if self.get(number) is not None:
+            return
+        self._recent[number] = _canonical(account_id)  # the same form whatever the source
+        if len(self._recent) >= MERGE_THRESHOLD:
+            with self._lock:
+                if len(self._recent) >= MERGE_THRESHOLD:
+                    self._merge()
+
+    def _pairs(self):
+        numbers, offsets, ids = self._packed
+        for i in range(len(offsets) - 1):
+            yield numbers[offsets[i]:offsets[i + 1]].decode(), _unpack_id(ids[i * 16:i * 16 + 16])
+
+    def _merge(self):
+        recent = dict(self._recent)
+        self._packed, _ = _pack(
+            heapq.merge(self._pairs(), sorted(recent.items(), key=_byte_order), key=_byte_order), self._others
+        )
+        # Only now drop what was merged; additions made meanwhile stay in the dict
+        for number in recent:
+            self._recent.pop(number, None)
+
+class _Directory:
+    """The loaded account index, beneficiaries by owner and the refresh watermark."""
+
+    def __init__(self, accounts, beneficiaries, watermark):
+        self.accounts = accounts
+        self.beneficiaries = beneficiaries
+        self.watermark = watermark
+        self.refreshed = time.monotonic()
+
+_directory = None
+_loading = None
+_lock = threading.Lock()
+
+def load(session) -> _Directory:
+    """Build the index from the database and make it the one resolve() uses."""
+    global _directory
+    watermark = session.execute(select(_CREATED).order_by(Account.created_at.desc()).limit(1)).scalar()
+    rows = session.execute(
+        select(Account.account_number, _ACCOUNT_ID)
+        .order_by(Account.account_number)
+        .execution_options(yield_per=STREAM_ROWS)
+    )
+    accounts = AccountIndex((number, account_id) for number, account_id in rows)
+
+    beneficiaries = {}
+    for owner_id, number, name, bank_name in session.execute(
+        select(Beneficiary.owner_id, Beneficiary.account_number, Beneficiary.name, Beneficiary.bank_name)
+    ):
+        beneficiaries.setdefault(owner_id, {})[number] = (name, bank_name)
+    _directory = _Directory(accounts, beneficiaries, watermark)
+    return _directory
+
+def start_preload():
+    """Load the index on a background thread, once per process."""
+    global _loading
+    with _lock:
+        if _directory is not None or _loading is not None:
+            return
+
+        def run():
+            from database import Session
+
+            with Session() as session:
+                load(session)
+
+        _loading = threading.Thread(target=run, name="recipient-index", daemon=True)
+        _loading.start()
+
+def refresh(session, force=False) -> int:
+    """
+    Add accounts created since the last load or refresh (by another process,
+    say). Skipped if the last refresh was under RECIPIENT_REFRESH_INTERVAL
+    seconds ago, unless ``force``. Returns how many accounts were added.
+    """
+    directory = _directory
+    if directory is None:
+        return 0
+    if not force and time.monotonic() - directory.refreshed < RECIPIENT_REFRESH_INTERVAL:
+        return 0
+    directory.refreshed = time.monotonic()
+    stmt = select(Account.account_number, _ACCOUNT_ID, _CREATED)
+    if directory.watermark:
+        watermark = directory.watermark
+        if not isinstance(watermark, datetime):
+            watermark = datetime.fromisoformat(watermark)
+        stmt = stmt.where(_CREATED >= (watermark - REFRESH_LOOKBACK).isoformat(" "))
+    added = 0
+    for number, account_id, created in session.execute(stmt):
+        if directory.accounts.get(number) is None:
+            directory.accounts.add(number, account_id)
+            added += 1
+        if directory.watermark is None or created > directory.watermark:
+            directory.watermark = created
+    return added
+
+def note_account(account_number, account_id):
+    """Make an account opened in this process resolvable immediately."""
+    if _directory is not None:
+        _directory.accounts.add(account_number, account_id)
+
+def _beneficiary(session, owner_id, number, internal):
+    """
+    (name, bank_name) if ``owner_id`` saved ``number`` as a beneficiary.
+    From the index when loaded; a number that is not an internal account
+    and is missing there is looked up again, as it may have been saved
+    since (by another process, say).
+    """
+    directory = _directory
+    if directory is not None:
+        saved = directory.beneficiaries.get(owner_id, {}).get(number)
+        if saved is not None or internal:
+            return saved
+    row = session.execute(
+        select(Beneficiary.name, Beneficiary.bank_name)
+        .where(Beneficiary.owner_id == owner_id, Beneficiary.account_number == number)
+        .limit(1)
+    ).first()
+    if row is None:
+        return None
+    if directory is not None:
+        directory.beneficiaries.setdefault(owner_id, {})[number] = tuple(row)
+    return tuple(row)
+
+def _account_id(session, number):
+    directory = _directory
+    if directory is None:
+        import cache
+        return cache.get_account_id(session, number)
+    account_id = directory.accounts.get(number)
+    if account_id is None and refresh(session):
+        account_id = directory.accounts.get(number)
+    return account_id
+
+def resolve(session, account_number, owner_id=None) -> Recipient:
+    """
+    Route ``account_number`` for a transfer by ``owner_id``: an internal
+    account, or one of that user's external beneficiaries. Raises
+    AccountNotFoundError for anything else.
+    """
+    number = str(account_number).strip()
+    if not _VALID_NUMBER.fullmatch(number):
+        raise AccountNotFoundError(f"{account_number!r} is not a valid account number.")
+    account_id = _account_id(session, number)
+    saved = _beneficiary(session, owner_id, number, account_id is not None) if owner_id is not None else None
+    name, bank_name = saved or (None, None)
+
+    if account_id is not None:
+        return Recipient(number, internal=True, account_id=account_id, name=name, bank_name=bank_name)
+    if saved is not None:
+        return Recipient(number, internal=False, name=name, bank_name=bank_name)
+    raise AccountNotFoundError(f"Recipient account {number} not found.")
+
+def stats() -> dict:
+    directory = _directory
+    if directory is None:
+        return {"loaded": False}
+    return {
+        "loaded": True,
+        "accounts": len(directory.accounts),
+        "beneficiary_owners": len(directory.beneficiaries),
+    }
@@ -2,10 +2,21 @@
 Seed script to populate the database with test data.
 Run this script to add sample users, accounts, and transactions for testing.
 """
+import argparse
+import random
+import time
+import uuid
+from contextlib import contextmanager
 from decimal import Decimal
+from itertools import accumulate
 from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, text
+import archive
+from config import SQLITE_SYNCHRONOUS
+from database import Session, init_db
+from passwords import hash_password
 from models import (
-    Session,
+    Base,
     User,
     Account,
     Transaction,
@@ -20,12 +31,14 @@ from models import (
 def clear_all_data():
     """Clear all existing data from the database."""
     with Session() as session:
-        session.query(Transaction).delete()
-        session.query(Beneficiary).delete()
-        session.query(Card).delete()
-        session.query(Account).delete()
-        session.query(AuditLog).delete()
-        session.query(User).delete()
+        archive.clear(session)  # partition files/tables are not in the metadata
+        tables = Base.metadata.sorted_tables
+        if session.get_bind().dialect.name == "postgresql":
+            session.execute(text(f"TRUNCATE {', '.join(t.name for t in tables)} CASCADE"))
+        else:
+            # Children first, so foreign keys never point at deleted rows
+            for table in reversed(tables):
+                session.execute(delete(table))
         session.commit()
         print("✓ Cleared all existing data")
 
@@ -36,31 +49,31 @@ def create_users():
             "email": "sylvia.malala@example.com",
             "full_name": "Sylvia Malala",
             "phone": "+254712345678",
-            "hashed_password": "password123"
+            "password": "password123"
         },
         {
             "email": "mathew.august@example.com",
             "full_name": "Mathew August",
             "phone": "+254723456789",
-            "hashed_password": "password123"
+            "password": "password123"
         },
         {
             "email": "bob.wilson@example.com",
             "full_name": "Bob Wilson",
             "phone": "+254734567890",
-            "hashed_password": "password123"
+            "password": "password123"
         },
         {
             "email": "alice.johnson@example.com",
             "full_name": "Alice Johnson",
             "phone": "+254745678901",
-            "hashed_password": "password123"
+            "password": "password123"
         },
         {
             "email": "test@test.com",
             "full_name": "Test User",
             "phone": "+254756789012",
-            "hashed_password": "test123"
+            "password": "test123"
         }
     ]
     
@@ -72,7 +85,7 @@ def create_users():
                 email=user_data["email"],
                 full_name=user_data["full_name"],
                 phone=user_data["phone"],
-                hashed_password=user_data["hashed_password"],
+                hashed_password=hash_password(user_data["password"]),
                 is_active=True
             )
             session.add(user)
@@ -242,22 +255,253 @@ def create_audit_logs():
         session.commit()
         print(f"✓ Created {len(audit_data)} audit logs")
 
-def main():
+# Relative weights for the synthetic data
+ACCOUNT_TYPE_WEIGHTS = {
+    AccountType.CHECKING: 6,
+    AccountType.SAVINGS: 3,
+    AccountType.CREDIT: 1,
+}
+TRANSACTION_TYPE_WEIGHTS = {
+    TransactionType.DEPOSIT: 35,
+    TransactionType.WITHDRAWAL: 25,
+    TransactionType.TRANSFER: 30,
+    TransactionType.FEE: 10,
+}
+REFERENCES = {
+    TransactionType.DEPOSIT: "Salary deposit",
+    TransactionType.WITHDRAWAL: "ATM withdrawal",
+    TransactionType.TRANSFER: "Transfer",
+    TransactionType.FEE: "Monthly maintenance fee",
+}
+
+def _id_factory(rng):
+    """
+    UUID4s (as 32 hex digits) derived from a row's index, so related rows can
+    name each other without a lookup. The random part comes from ``rng``; the
+    low 48 bits hold the index.
+    """
+    base = uuid.UUID(int=rng.getrandbits(128) >> 48 << 48, version=4).int
+    return lambda i: f"{base + i:032x}"
+
+def _opened_fraction(i, seed) -> float:
+    """A fraction in (0, 1] fixed by account index and seed, so no per-account state has to be kept."""
+    x = ((i + 1) * 0x9E3779B97F4A7C15 + seed) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 31
+    x = (x * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 29
+    return (x + 1) / 2 ** 64
+
+def _insert_chunked(session, table, columns, chunks, progress=None):
+    """
+    Insert column-oriented chunks (one list of values per name in
+    ``columns``) with one executemany per chunk, committing after each. On
+    SQLite a chunk goes straight to the driver, converted column by column
+    by the column types, which skips statement compilation and per-row
+    parameter processing.
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name == "sqlite":
+        processors = [table.c[name].type.dialect_impl(dialect).bind_processor(dialect) for name in columns]
+        sql = f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+        def write(chunk):
+            raw = session.connection().connection.driver_connection
+            raw.executemany(sql, zip(*(map(p, values) if p else values for p, values in zip(processors, chunk))))
+    else:
+        stmt = insert(table)
+
+        def write(chunk):
+            session.execute(stmt, [dict(zip(columns, row)) for row in zip(*chunk)])
+
+    done = 0
+    for chunk in chunks:
+        write(chunk)
+        session.commit()
+        done += len(chunk[0])
+        if progress:
+            progress(table.name, done)
+    return done
+
+@contextmanager
+def _bulk_load(session, tables):
+    """
+    Drop the secondary indexes of ``tables`` for the duration of a load and
+    build them once at the end; on SQLite also stop syncing every commit.
+    """
+    bind = session.connection()
+    indexes = [index for table in tables for index in table.indexes]
+    for index in indexes:
+        index.drop(bind, checkfirst=True)
+    sqlite = bind.dialect.name == "sqlite"
+    if sqlite:
+        session.execute(text("PRAGMA synchronous=OFF"))
+    session.commit()
+    try:
+        yield
+    finally:
+        session.rollback()
+        bind = session.connection()
+        for index in indexes:
+            index.create(bind, checkfirst=True)
+        if sqlite:
+            session.execute(text(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}"))
+        session.commit()
+
+def generate_data(session, users, accounts, transactions, seed=0, skew=2.0,
+                  days=365, chunk_size=10_000, progress=None):
+    """
+    Insert synthetic users, accounts and transactions for load testing.
+
+    Rows are generated a chunk at a time, so memory stays flat however many
+    are asked for, and the same seed always produces the same data. Every
+    user gets at least one account while ``accounts >= users``; extra
+    accounts, and transactions, go to owners and accounts picked with
+    ``skew`` (1.0 is uniform, higher values give a few very busy accounts
+    and a long tail of quiet ones). Accounts are opened over the last
+    ``days`` days, and each account's transactions fall between its opening
+    and now; users are registered before the window starts.
+    ``progress(table_name, rows_done)`` is called after each chunk.
+    """
+    rng = random.Random(seed)
+    rand = rng.random
+    user_id = _id_factory(rng)
+    account_id = _id_factory(rng)
+    transaction_id = _id_factory(rng)
+    now = datetime.utcnow().replace(microsecond=0)
+    account_types = list(ACCOUNT_TYPE_WEIGHTS)
+    account_weights = list(accumulate(ACCOUNT_TYPE_WEIGHTS.values()))
+    txn_types = list(TRANSACTION_TYPE_WEIGHTS)
+    txn_weights = list(accumulate(TRANSACTION_TYPE_WEIGHTS.values()))
+    window = days * 24 * 3600
+    registered = now - timedelta(seconds=window + 86400)
+
+    def age(i):
+        """Seconds between account ``i`` opening and now; skewed towards older accounts."""
+        return int(window * _opened_fraction(i, seed) ** 0.5)
+
+    def spans(total):
+        for start in range(0, total, chunk_size):
+            yield range(start, min(start + chunk_size, total))
+
+    # One hash for every synthetic user: deriving millions of keys would dominate the load
+    password = hash_password("password123")
+
+    def user_chunks():
+        for span in spans(users):
+            yield (
+                [user_id(i) for i in span],
+                [f"user{i}@example.com" for i in span],
+                [f"User {i}" for i in span],
+                [password] * len(span),
+                [True] * len(span),
+                [registered] * len(span),
+            )
+
+    def account_chunks():
+        for span in spans(accounts):
+            yield (
+                [account_id(i) for i in span],
+                [user_id(i if i < users else min(users - 1, int(users * rand() ** skew))) for i in span],
+                [f"ACC{i:012d}" for i in span],
+                rng.choices(account_types, cum_weights=account_weights, k=len(span)),
+                [int(rand() * 10_000_000) / 100 for _ in span],
+                ["KES"] * len(span),
+                # A second early, so no transaction (microseconds included) predates it
+                [now - timedelta(seconds=age(i) + 1) for i in span],
+            )
+
+    def transaction_chunks():
+        for span in spans(transactions):
+            types = rng.choices(txn_types, cum_weights=txn_weights, k=len(span))
+            owners = [min(accounts - 1, int(accounts * rand() ** skew)) for _ in span]
+            yield (
+                [transaction_id(i) for i in span],
+                [account_id(a) for a in owners],
+                # Log-uniform from 1.00 to 100,000.00: mostly small, occasionally large
+                [round(10 ** (5 * rand()), 2) for _ in span],
+                types,
+                [REFERENCES[t] for t in types],
+                [now - timedelta(seconds=int(rand() * age(a)), microseconds=int(rand() * 1_000_000)) for a in owners],
+            )
+
+    load = [
+        (User.__table__, ("id", "email", "full_name", "hashed_password", "is_active", "created_at"), user_chunks()),
+        (Account.__table__, ("id", "owner_id", "account_number", "type", "balance", "currency", "created_at"), account_chunks()),
+        (Transaction.__table__, ("id", "account_id", "amount", "type", "reference", "created_at"), transaction_chunks()),
+    ]
+    with _bulk_load(session, [table for table, _, _ in load]):
+        for table, columns, chunks in load:
+            _insert_chunked(session, table, columns, chunks, progress)
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Seed the database. With no options, loads the small sample data set; "
+                    "with --users/--accounts/--transactions, generates synthetic data at scale."
+    )
+    parser.add_argument("--users", type=int, help="synthetic users to generate")
+    parser.add_argument("--accounts", type=int, help="synthetic accounts (default: 3 per user)")
+    parser.add_argument("--transactions", type=int, help="synthetic transactions (default: 30 per account)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same data")
+    parser.add_argument("--skew", type=float, default=2.0, help="activity skew, 1.0 for uniform (default: 2.0)")
+    parser.add_argument("--days", type=int, default=365, help="spread transactions over this many days")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="rows per insert batch")
+    parser.add_argument("-y", "--yes", action="store_true", help="do not ask before clearing existing data")
+    return parser
+
+def _report_progress(started):
+    last = {}
+
+    def progress(table, done):
+        # One line when a table starts and then one per million rows
+        if table not in last or done // 1_000_000 > last[table] // 1_000_000:
+            last[table] = done
+            elapsed = time.perf_counter() - started
+            print(f"  {table}: {done:,} rows ({elapsed:.0f}s)", flush=True)
+    return progress
+
+def generate(args):
+    users = args.users or 1_000
+    accounts = args.accounts if args.accounts is not None else users * 3
+    transactions = args.transactions if args.transactions is not None else accounts * 30
+    print(f"Generating {users:,} users, {accounts:,} accounts and {transactions:,} transactions (seed {args.seed})...\n")
+    started = time.perf_counter()
+    with Session() as session:
+        generate_data(
+            session, users, accounts, transactions,
+            seed=args.seed, skew=args.skew, days=args.days,
+            chunk_size=args.chunk_size, progress=_report_progress(started),
+        )
+    elapsed = time.perf_counter() - started
+    rows = users + accounts + transactions
+    print(f"\n✓ Generated {rows:,} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)")
+    print("  Synthetic users log in as userN@example.com with password123")
+
+def main(argv=None):
     """Main function to seed all data."""
+    args = build_parser().parse_args(argv)
+    synthetic = any(n is not None for n in (args.users, args.accounts, args.transactions))
+
     print("\n" + "="*50)
     print("  DATABASE SEEDING - Test Data Generation")
     print("="*50 + "\n")
     
     # Ask for confirmation
-    response = input("This will clear all existing data and create new test data. Continue? (yes/no): ")
-    if response.lower() not in ['yes', 'y']:
-        print("Seeding cancelled.")
-        return
+    if not args.yes:
+        response = input("This will clear all existing data and create new test data. Continue? (yes/no): ")
+        if response.lower() not in ['yes', 'y']:
+            print("Seeding cancelled.")
+            return
     
     print("\nStarting database seeding...\n")
+
+    init_db()
     
     # Clear existing data
     clear_all_data()
+
+    if synthetic:
+        generate(args)
+        return
     
     # Create test data
     user_ids = create_users()
@@ -0,0 +1,197 @@
+"""
+End-of-day balance snapshots for point-in-time balance queries.
+
+refresh_snapshots() is an incremental job. It walks accounts in id-ordered
+chunks, aggregates every day of activity since the last completed run with
+one GROUP BY per chunk, and stores one snapshot per account per active day,
+holding the closing balance and running credit/debit/count totals. Days
+without activity need no row: the latest earlier snapshot still holds.
+
+balance_at() answers "balance of an account at time T" from the nearest
+snapshot plus a scan of the transactions between that snapshot and T,
+which the (account_id, created_at, id) index keeps to a bounded range.
+That scan also covers archived months (archive.py) that overlap it.
+"""
+from __future__ import annotations
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import String, and_, case, delete, func, insert, select, type_coerce
+import archive
+from config import SNAPSHOT_CHUNK_SIZE
+from models import (
+    Account,
+    BalanceSnapshot,
+    SnapshotCheckpoint,
+    Transaction,
+    CREDIT_TYPES,
+    now_utc,
+)
+
+CHECKPOINT = "balance_snapshots"
+ZERO = Decimal("0.00")
+
+# Compare created_at as stored: SQLite keeps it as text, and rows written by
+# CURRENT_TIMESTAMP have no microseconds, so ISO date strings are exact bounds.
+_CREATED = type_coerce(Transaction.created_at, String)
+
+def _money(value) -> Decimal:
+    return Decimal(str(value or 0)).quantize(Decimal("0.01"))
+
+def _as_date(value) -> date:
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+def _latest_snapshots(session, account_ids) -> dict:
+    latest = (
+        select(BalanceSnapshot.account_id, func.max(BalanceSnapshot.snapshot_date).label("snapshot_date"))
+        .where(BalanceSnapshot.account_id.in_(account_ids))
+        .group_by(BalanceSnapshot.account_id)
+        .subquery()
+    )
+    stmt = select(BalanceSnapshot).join(latest, and_(
+        BalanceSnapshot.account_id == latest.c.account_id,
+        BalanceSnapshot.snapshot_date == latest.c.snapshot_date,
+    ))
+    return {
+        s.account_id: [s.closing_balance, s.total_credits, s.total_debits, s.transaction_count]
+        for s in session.scalars(stmt)
+    }
+
+def refresh_snapshots(session, through=None, chunk_size=SNAPSHOT_CHUNK_SIZE) -> int:
+    """
+    Snapshot every day up to and including ``through`` (default: yesterday,
+    UTC) that the previous run did not cover. Returns the rows written.
+    """
+    through = through or now_utc().date() - timedelta(days=1)
+    checkpoint = session.get(SnapshotCheckpoint, CHECKPOINT)
+    start = checkpoint.completed_through + timedelta(days=1) if checkpoint else None
+    if start and start > through:
+        return 0
+
+    # An interrupted run may have left rows past the checkpoint
+    cleanup = delete(BalanceSnapshot)
+    if checkpoint:
+        cleanup = cleanup.where(BalanceSnapshot.snapshot_date > checkpoint.completed_through)
+    session.execute(cleanup)
+    session.commit()
+
+    is_credit = Transaction.type.in_(CREDIT_TYPES)
+    day = func.date(Transaction.created_at)
+    written = 0
+    last_id = None
+    while True:
+        stmt = select(Account.id, Account.balance).order_by(Account.id).limit(chunk_size)
+        if last_id is not None:
+            stmt = stmt.where(Account.id > last_id)
+        accounts = session.execute(stmt).all()
+        if not accounts:
+            break
+        last_id = accounts[-1].id
+        ids = [a.id for a in accounts]
+
+        state = _latest_snapshots(session, ids)
+        fresh = [a for a in accounts if a.id not in state]
+        if fresh:
+            # No snapshot yet: the opening balance is whatever the ledger does not explain
+            totals = dict(session.execute(
+                select(Transaction.account_id, func.sum(Transaction.signed_amount))
+                .where(Transaction.account_id.in_([a.id for a in fresh]))
+                .group_by(Transaction.account_id)
+            ).all())
+            for a in fresh:
+                state[a.id] = [_money(a.balance) - _money(totals.get(a.id)), ZERO, ZERO, 0]
+
+        daily = (
+            select(
+                Transaction.account_id,
+                day.label("day"),
+                func.sum(case((is_credit, Transaction.amount), else_=0)),
+                func.sum(case((is_credit, 0), else_=Transaction.amount)),
+                func.count(),
+            )
+            .where(Transaction.account_id.in_(ids), _CREATED < (through + timedelta(days=1)).isoformat())
+            .group_by(Transaction.account_id, day)
+            .order_by(Transaction.account_id, day)
+        )
+        if start:
+            daily = daily.where(_CREATED >= start.isoformat())
+
+        rows = []
+        for account_id, txn_day, credits, debits, count in session.execute(daily):
+            s = state[account_id]
+            credits, debits = _money(credits), _money(debits)
+            s[0] += credits - debits
+            s[1] += credits
+            s[2] += debits
+            s[3] += count
+            rows.append({
+                "account_id": account_id,
+                "snapshot_date": _as_date(txn_day),
+                "closing_balance": s[0],
+                "total_credits": s[1],
+                "total_debits": s[2],
+                "transaction_count": s[3],
+            })
+        if rows:
+            session.execute(insert(BalanceSnapshot.__table__), rows)
+            written += len(rows)
+        session.commit()
+
+    if checkpoint is None:
+        session.add(SnapshotCheckpoint(name=CHECKPOINT, completed_through=through))
+    else:
+        checkpoint.completed_through = through
+    session.commit()
+    return written
+
+def _signed_sum(session, account_id, since=None, until=None) -> Decimal:
+    """Signed total of the account's transactions created in [since, until), live and archived."""
+    total = ZERO
+    months = archive.months_for(session, account_id, since, until)
+    for table in [archive.LIVE, *(archive.partition(session, month) for month in months)]:
+        created = type_coerce(table.c.created_at, String)
+        stmt = select(func.sum(case((table.c.type.in_(CREDIT_TYPES), table.c.amount), else_=-table.c.amount)))
+        stmt = stmt.where(table.c.account_id == account_id)
+        if since is not None:
+            stmt = stmt.where(created >= since)
+        if until is not None:
+            stmt = stmt.where(created < until)
+        total += _money(session.execute(stmt).scalar())
+    return total
+
+def balance_at(session, account_id, at) -> Decimal:
+    """
+    Balance of ``account_id`` as of ``at``: the end of the day for a date,
+    or including transactions created at or before a datetime.
+    """
+    if isinstance(at, datetime):
+        last_full_day = at.date() - timedelta(days=1)
+        # Exclusive bound one microsecond later, in the format DateTime stores
+        cutoff = (at + timedelta(microseconds=1)).isoformat(" ", "microseconds")
+    else:
+        last_full_day = at
+        cutoff = (at + timedelta(days=1)).isoformat()
+
+    before = session.scalars(
+        select(BalanceSnapshot)
+        .where(BalanceSnapshot.account_id == account_id, BalanceSnapshot.snapshot_date <= last_full_day)
+        .order_by(BalanceSnapshot.snapshot_date.desc())
+        .limit(1)
+    ).first()
+    if before is not None:
+        since = (before.snapshot_date + timedelta(days=1)).isoformat()
+        return _money(before.closing_balance) + _signed_sum(session, account_id, since, cutoff)
+
+    later = session.scalars(
+        select(BalanceSnapshot)
+        .where(BalanceSnapshot.account_id == account_id, BalanceSnapshot.snapshot_date > last_full_day)
+        .order_by(BalanceSnapshot.snapshot_date.asc())
+        .limit(1)
+    ).first()
+    if later is not None:
+        until = (later.snapshot_date + timedelta(days=1)).isoformat()
+        return _money(later.closing_balance) - _signed_sum(session, account_id, cutoff, until)
+
+    current = session.execute(select(Account.balance).where(Account.id == account_id)).scalar()
+    if current is None:
+        return None
+    return _money(current) - _signed_sum(session, account_id, cutoff)